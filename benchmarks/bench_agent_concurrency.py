@@ -0,0 +1,100 @@
+"""
+Benchmark: agent requests/second versus concurrency limit.
+
+Starts a local aiohttp stub server that answers after a fixed delay and feeds
+`proxy_request` frames through the agent's Dispatcher with a fake WebSocket,
+measuring throughput for each concurrency limit.
+
+Usage:
+    python benchmarks/bench_agent_concurrency.py [--requests 200] [--delay-ms 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+# Appended, not prepended: client/secrets.py would shadow the stdlib module
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "client"))
+from aiohttp import web  # noqa: E402
+import tunnel_agent  # noqa: E402
+
+
+class FakeWebSocket:
+    """Collects sent frames and signals when every response has ended."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.ended = 0
+        self.done = asyncio.Event()
+
+    async def send(self, message):
+        if isinstance(message, bytes):
+            ended = tunnel_agent.protocol.unpack_frame(message)[1] == tunnel_agent.protocol.RESPONSE_END
+        else:
+            ended = json.loads(message)["action"] == "http_response_end"
+        if ended:
+            self.ended += 1
+            if self.ended == self.expected:
+                self.done.set()
+
+
+async def start_stub(delay, port):
+    async def handler(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def run_once(session, concurrency, requests):
+    ws = FakeWebSocket(requests)
+    writer = tunnel_agent.FrameWriter(ws, tunnel_agent.protocol.FRAMING_BINARY)
+    dispatcher = tunnel_agent.Dispatcher(writer, "BENCH1", session, concurrency)
+    start = time.perf_counter()
+    for _ in range(requests):
+        dispatcher.dispatch({
+            "action":  "proxy_request",
+            "id":      str(uuid.uuid4()),
+            "method":  "GET",
+            "path":    "api/status",
+            "headers": {},
+            "body":    "",
+        })
+    await ws.done.wait()
+    elapsed = time.perf_counter() - start
+    await dispatcher.close()
+    return requests / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--delay-ms", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=18181)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    runner = await start_stub(args.delay_ms / 1000.0, args.port)
+    tunnel_agent.LOCAL_API = f"http://127.0.0.1:{args.port}"
+    session = tunnel_agent.create_session({})
+    results = {"requests": args.requests, "upstream_delay_ms": args.delay_ms, "rps": {}}
+    try:
+        for concurrency in args.concurrency:
+            rps = await run_once(session, concurrency, args.requests)
+            results["rps"][str(concurrency)] = round(rps, 1)
+    finally:
+        await session.close()
+        await runner.cleanup()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""
+Benchmark: per-request overhead of the pure-ASGI /homes/ route versus Django.
+
+Connects a TunnelConsumer through channels' WebsocketCommunicator with a fake
+agent answering every request, then drives the same /homes/<id>/... requests
+through the hub's HTTP app twice: with /homes/ handled by Django (request
+construction, URL resolution, the MIDDLEWARE stack) and by the pure-ASGI
+route of hub/asgi.py. Both modes run the same proxy_to_home, so the
+difference is the overhead the ASGI route saves.
+
+Requests are handed to the ASGI app directly, as a server would, so the
+numbers hold no network time. Requires daphne (pulled in by channels.testing).
+
+Usage:
+    python benchmarks/bench_asgi.py [--requests 2000] [--body-kb 0]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import hubenv
+from bench_dispatch import percentile
+
+MODES = ("django", "asgi_proxy")
+
+
+async def request(application, scope, body):
+    """
+    Calls the ASGI app with one request the way a server would; returns the status.
+    """
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = None
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Future()  # the client stays connected
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await application(scope, receive, send)
+    return status
+
+
+async def run_mode(application, args):
+    body = b"x" * (args.body_kb * 1024)
+    path = f"/homes/{hubenv.HOUSE_ID}/api/status"
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST" if body else "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"hub.example.com"), (b"accept", b"application/json"),
+                    (b"cookie", b"sessionid=0123456789abcdef"),
+                    (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000),
+    }
+    latencies = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        status = await request(application, scope, body)
+        latencies.append((time.perf_counter() - start) * 1e6)
+        assert status == 200, status
+    return {
+        "p50_us": round(statistics.median(latencies), 1),
+        "p99_us": round(percentile(latencies, 99), 1),
+        "mean_us": round(statistics.fmean(latencies), 1),
+    }
+
+
+async def bench(args, auth_hash):
+    from channels.testing import WebsocketCommunicator
+    from tunnel.consumers import TunnelConsumer
+
+    communicator = WebsocketCommunicator(TunnelConsumer.as_asgi(), "/ws/tunnel/")
+    await communicator.connect()
+    await communicator.send_to(text_data=json.dumps({
+        "action": "authenticate", "house_id": hubenv.HOUSE_ID, "auth_hash": auth_hash,
+    }))
+    await communicator.receive_from()
+    agent = asyncio.create_task(hubenv.fake_agent(communicator))
+
+    results = {"requests": args.requests, "body_kb": args.body_kb}
+    for mode in MODES:
+        application = hubenv.asgi_application(proxy=mode == "asgi_proxy")
+        await run_mode(application, argparse.Namespace(**{**vars(args), "requests": 50}))  # warm up
+        results[mode] = await run_mode(application, args)
+    results["saved_us_per_request"] = round(results["django"]["mean_us"] - results["asgi_proxy"]["mean_us"], 1)
+
+    agent.cancel()
+    await communicator.disconnect()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--body-kb", type=int, default=0, help="POST a body of this size instead of a GET")
+    args = parser.parse_args()
+
+    auth_hash = hubenv.setup()
+    print(json.dumps(asyncio.run(bench(args, auth_hash)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Micro-benchmark: cost of encoding and parsing tunnel frames with each codec.
+
+For request frames with bodies of several sizes, encodes the proxy_request
+frame as the hub's consumer would (one pass, base64 body for the JSON codecs,
+raw bytes in a REQUEST frame for msgpack) and parses it as the agent would,
+then does the same for a response head. Reports bytes on the wire and
+microseconds per frame for each codec available here (see protocol.CODECS).
+
+Usage:
+    python benchmarks/bench_codec.py [--sizes 0,1024,65536,1048576] [--repeat 200]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+
+# Appended, not prepended: client/secrets.py would shadow the stdlib module
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "client"))
+import protocol  # noqa: E402
+
+HEADERS = {
+    "Host": "hub.example.com",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Cookie": "sessionid=0123456789abcdef; csrftoken=fedcba9876543210",
+    "X-Request-ID": str(uuid.uuid4()),
+}
+
+
+def encode_request(codec, frame):
+    if codec.binary:
+        return protocol.pack_json_frame(frame["id"], protocol.REQUEST, frame, codec=codec)
+    if isinstance(frame.get("body"), bytes):
+        frame = {**frame, "body": base64.b64encode(frame["body"]).decode("ascii"), "is_base64": True}
+    return codec.dumps_text(frame)
+
+
+def decode_request(codec, message):
+    if isinstance(message, bytes):
+        frame = protocol.frame_to_dict(message, codec)
+    else:
+        frame = codec.loads(message)
+    body = frame.get("body", b"")
+    return base64.b64decode(body) if frame.get("is_base64") else body
+
+
+def encode_head(codec, req_id, head):
+    return protocol.pack_json_frame(req_id, protocol.RESPONSE_START, head, codec=codec)
+
+
+def decode_head(codec, message):
+    return protocol.frame_to_dict(message, codec)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return result, round(best * 1e6, 2)
+
+
+def bench_codec(codec, sizes, repeat):
+    req_id = str(uuid.uuid4())
+    out = {}
+    for size in sizes:
+        body = os.urandom(size)
+        frame = {"action": "proxy_request", "id": req_id, "method": "POST",
+                 "path": "api/items/?page=2", "headers": HEADERS, "body": body,
+                 "priority": "interactive"}
+        message, encode_us = timed(lambda: encode_request(codec, frame), repeat)
+        decoded, decode_us = timed(lambda: decode_request(codec, message), repeat)
+        assert decoded == body
+        out[str(size)] = {
+            "wire_bytes": len(message if isinstance(message, bytes) else message.encode("utf-8")),
+            "encode_us": encode_us,
+            "decode_us": decode_us,
+        }
+    head = {"status": 200, "headers": {**HEADERS, "Content-Type": "application/json"}}
+    message, encode_us = timed(lambda: encode_head(codec, req_id, head), repeat)
+    _, decode_us = timed(lambda: decode_head(codec, message), repeat)
+    out["response_head"] = {"wire_bytes": len(message), "encode_us": encode_us, "decode_us": decode_us}
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="0,1024,65536,1048576",
+                        type=lambda s: [int(n) for n in s.split(",") if n])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    results = {"codecs": list(protocol.SUPPORTED_CODECS), "body_sizes": args.sizes}
+    for name, codec in protocol.CODECS.items():
+        results[name] = bench_codec(codec, args.sizes, args.repeat)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark: send_and_wait latency through the in-process fast path versus the
+channel layer.
+
+Connects a TunnelConsumer through channels' WebsocketCommunicator with a fake
+agent answering every request, then times full request/response round trips
+with TUNNEL_LOCAL_FASTPATH on ("local") and off ("remote").
+
+Requires daphne (pulled in by channels.testing).
+
+Usage:
+    python benchmarks/bench_dispatch.py [--requests 2000]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import hubenv
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_mode(house_id, requests):
+    from tunnel.utils import send_and_wait
+
+    latencies = []
+    for _ in range(requests):
+        frame = {"action": "proxy_request", "id": str(uuid.uuid4()),
+                 "method": "GET", "path": "api/status", "headers": {}, "body": ""}
+        start = time.perf_counter()
+        stream = await send_and_wait(house_id, frame)
+        async for _ in stream.body():
+            pass
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return {
+        "p50_us": round(statistics.median(latencies), 1),
+        "p99_us": round(percentile(latencies, 99), 1),
+        "mean_us": round(statistics.fmean(latencies), 1),
+    }
+
+
+async def bench(args, auth_hash):
+    from channels.testing import WebsocketCommunicator
+    from django.conf import settings
+    from tunnel.consumers import TunnelConsumer
+    from tunnel.utils import dispatch_counts
+
+    communicator = WebsocketCommunicator(TunnelConsumer.as_asgi(), "/ws/tunnel/")
+    await communicator.connect()
+    await communicator.send_to(text_data=json.dumps({
+        "action": "authenticate", "house_id": hubenv.HOUSE_ID, "auth_hash": auth_hash,
+    }))
+    await communicator.receive_from()
+    agent = asyncio.create_task(hubenv.fake_agent(communicator))
+
+    results = {"requests": args.requests}
+    for mode, fastpath in (("local", True), ("remote", False)):
+        settings.TUNNEL_LOCAL_FASTPATH = fastpath
+        results[mode] = await run_mode(hubenv.HOUSE_ID, args.requests)
+    results["dispatch_counts"] = dict(dispatch_counts)
+
+    agent.cancel()
+    await communicator.disconnect()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    auth_hash = hubenv.setup()
+    print(json.dumps(asyncio.run(bench(args, auth_hash)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Benchmark: end-to-end proxy path, client → hub → agent → local server and back.
+
+Boots the hub's ASGI app under uvicorn with the in-memory channel layer, runs
+one tunnel_agent per house against a local aiohttp stub upstream, and drives
+load through /homes/<id>/... with an aiohttp client. Workloads:
+
+    small_json     GET of a ~200 byte JSON document
+    large_binary   GET of a --large-mb random binary body
+    hls            viewers fetching a playlist, then its segments in order
+    concurrent     --concurrency x 4 clients, 90% small JSON / 10% large binary,
+                   spread over every house
+
+Each workload reports requests/s, p50/p99 latency, body bytes, bytes on the
+tunnel websocket (both directions) and peak Python heap per in-flight request
+(from a second, shorter pass under tracemalloc).
+
+Requires uvicorn. Prints JSON (or writes it to --output) so runs can be
+compared across commits.
+
+Usage:
+    python benchmarks/bench_e2e.py [--houses 2] [--requests 500] [--concurrency 16]
+                                   [--workloads small_json,hls] [--output result.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import hubenv
+
+# Appended, not prepended: client/secrets.py would shadow the stdlib module
+sys.path.append(os.path.join(hubenv.ROOT, "client"))
+
+WORKLOADS = ("small_json", "large_binary", "hls", "concurrent")
+
+SEGMENTS = 10               # segments per HLS playlist
+SEGMENT_BYTES = 512 * 1024
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=hubenv.ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class WireCounter:
+    """Counts the bytes written to the tunnel websocket in each direction."""
+
+    def __init__(self):
+        self.up = 0     # agent → hub
+        self.down = 0   # hub → agent
+
+    def install(self, tunnel_agent, consumer_class):
+        counter = self
+        agent_send = tunnel_agent.FrameWriter.send
+        hub_send = consumer_class.send
+
+        async def count_agent(writer, message, *args, **kwargs):
+            counter.up += len(message)
+            await agent_send(writer, message, *args, **kwargs)
+
+        async def count_hub(consumer, text_data=None, bytes_data=None, close=False):
+            counter.down += len(bytes_data if bytes_data is not None else (text_data or "").encode())
+            await hub_send(consumer, text_data=text_data, bytes_data=bytes_data, close=close)
+
+        tunnel_agent.FrameWriter.send = count_agent
+        consumer_class.send = count_hub
+
+    def snapshot(self):
+        return self.up, self.down
+
+
+async def start_stub(port, large):
+    from aiohttp import web
+
+    small = json.dumps({"status": "ok", "items": list(range(40))}).encode()
+    segment = os.urandom(SEGMENT_BYTES)
+    playlist = "#EXTM3U\n#EXT-X-TARGETDURATION:2\n" + "".join(
+        f"#EXTINF:2.0,\nseg{i}.ts\n" for i in range(SEGMENTS)) + "#EXT-X-ENDLIST\n"
+
+    async def handler(request):
+        tail = request.match_info["tail"]
+        if tail.startswith("large"):
+            return web.Response(body=large, content_type="application/octet-stream")
+        if tail.endswith(".m3u8"):
+            return web.Response(text=playlist, content_type="application/vnd.apple.mpegurl")
+        if tail.endswith(".ts"):
+            return web.Response(body=segment, content_type="video/mp2t")
+        return web.Response(body=small, content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def start_hub(port):
+    import uvicorn
+
+    config = uvicorn.Config(hubenv.asgi_application(), host="127.0.0.1", port=port,
+                            log_level="warning", lifespan="off")
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def start_agents(tunnel_agent, houses, hub_port, upstream_port, log_level, connections):
+    from tunnel.utils import local_tunnels
+
+    tunnel_agent.LOCAL_API = f"http://127.0.0.1:{upstream_port}"
+    tunnel_agent.CENTRAL_WS = f"ws://127.0.0.1:{hub_port}/ws/tunnel/"
+    configs = iter([{"house_id": h, "secret_key": hubenv.SECRET_KEY, "log_level": log_level,
+                     "tunnel_connections": connections} for h in houses])
+    tunnel_agent.load = lambda: next(configs)  # each run() loads its config once
+    agents = [asyncio.create_task(tunnel_agent.run()) for _ in houses]
+    deadline = time.monotonic() + 10
+    while not all(h in local_tunnels for h in houses):
+        if time.monotonic() > deadline:
+            raise RuntimeError("agents did not connect to the hub")
+        await asyncio.sleep(0.05)
+    return agents
+
+
+def plan(workload, houses, requests, concurrency):
+    """
+    Returns the request paths of each client of a workload, one list per client.
+    """
+    if workload == "hls":
+        viewers = concurrency
+        plays = max(requests // (SEGMENTS + 1), viewers)
+        jobs = [[] for _ in range(viewers)]
+        for i in range(plays):
+            house = houses[i % len(houses)]
+            jobs[i % viewers].extend([f"{house}/vod/{i}/index.m3u8"] +
+                                     [f"{house}/vod/{i}/seg{n}.ts" for n in range(SEGMENTS)])
+        return jobs
+    clients = concurrency * 4 if workload == "concurrent" else concurrency
+    jobs = [[] for _ in range(clients)]
+    for i in range(requests):
+        house = houses[i % len(houses)]
+        if workload == "large_binary" or (workload == "concurrent" and i % 10 == 9):
+            path = f"{house}/large/{i}"
+        else:
+            path = f"{house}/api/items/{i}"
+        jobs[i % clients].append(path)
+    return jobs
+
+
+async def drive(session, base, jobs):
+    latencies, body_bytes, errors = [], 0, 0
+
+    async def client(paths):
+        nonlocal body_bytes, errors
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                async with session.get(f"{base}/homes/{path}") as resp:
+                    body = await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+                        continue
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+            body_bytes += len(body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(paths) for paths in jobs))
+    return latencies, body_bytes, errors, time.perf_counter() - started
+
+
+async def run_workload(session, base, workload, args, houses, wire):
+    jobs = plan(workload, houses, args.requests, args.concurrency)
+    total = sum(len(paths) for paths in jobs)
+
+    up, down = wire.snapshot()
+    latencies, body_bytes, errors, elapsed = await drive(session, base, jobs)
+    up, down = wire.up - up, wire.down - down
+
+    # Second, shorter pass under tracemalloc for the memory figure
+    short = [paths[:max(1, args.memory_requests // len(jobs))] for paths in jobs]
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    await drive(session, base, short)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    done = len(latencies)
+    return {
+        "requests": total,
+        "errors": errors,
+        "clients": len(jobs),
+        "rps": round(done / elapsed, 1) if elapsed else None,
+        "p50_ms": round(statistics.median(latencies), 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 2) if latencies else None,
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else None,
+        "body_bytes": body_bytes,
+        "wire_bytes_up": up,
+        "wire_bytes_down": down,
+        "wire_bytes_per_request": round((up + down) / done) if done else None,
+        "peak_heap_kb_per_request": round((peak - baseline) / 1024 / len(jobs), 1),
+    }
+
+
+async def bench(args):
+    import aiohttp
+    import tunnel_agent
+    from tunnel.cache import response_cache
+    from tunnel.coalesce import coalescer
+    from tunnel.consumers import TunnelConsumer
+    from tunnel.utils import dispatch_counts
+
+    houses = hubenv.house_ids(args.houses)
+    if args.no_hub_cache:
+        response_cache.config["ENABLED"] = False
+        coalescer.config["ENABLED"] = False
+
+    wire = WireCounter()
+    wire.install(tunnel_agent, TunnelConsumer)
+
+    hub_port, upstream_port = free_port(), free_port()
+    stub = await start_stub(upstream_port, os.urandom(int(args.large_mb * 1024 * 1024)))
+    server, server_task = await start_hub(hub_port)
+    agents = await start_agents(tunnel_agent, houses, hub_port, upstream_port,
+                                "INFO" if args.verbose else "WARNING", args.tunnel_connections)
+
+    results = {}
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        base = f"http://127.0.0.1:{hub_port}"
+        for workload in args.workloads:
+            results[workload] = await run_workload(session, base, workload, args, houses, wire)
+
+    for agent in agents:
+        agent.cancel()
+    await asyncio.gather(*agents, return_exceptions=True)
+    server.should_exit = True
+    await server_task
+    await stub.cleanup()
+
+    return {
+        "benchmark": "e2e",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "houses": args.houses,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "large_mb": args.large_mb,
+            "hub_cache": not args.no_hub_cache,
+            "tunnel_connections": args.tunnel_connections,
+        },
+        "workloads": results,
+        "hub": {
+            "dispatch_counts": dict(dispatch_counts),
+            "cache": response_cache.info(),
+            "coalesce": dict(coalescer.stats),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--houses", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--large-mb", type=float, default=4)
+    parser.add_argument("--memory-requests", type=int, default=64,
+                        help="requests in the tracemalloc pass of each workload")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        type=lambda s: [w for w in s.split(",") if w])
+    parser.add_argument("--no-hub-cache", action="store_true",
+                        help="disable the hub response cache and coalescing")
+    parser.add_argument("--tunnel-connections", type=int, default=2,
+                        help="tunnel connections per agent (the last one carries media)")
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep hub and agent logs")
+    args = parser.parse_args()
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    hubenv.setup(args.houses)
+    # The hub and the agents log every request; keep the JSON readable
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            logging.getLogger("tunnel").setLevel(logging.WARNING)
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        results = asyncio.run(bench(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark: JSON + base64 frames versus binary frames for response bodies.
+
+Encodes a body as the agent would (64 KiB chunks) and decodes it as the hub
+would, reporting bytes on the wire and CPU time per MB for both encodings.
+
+Usage:
+    python benchmarks/bench_framing.py [--size-mb 16] [--repeat 5]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+
+# Appended, not prepended: client/secrets.py would shadow the stdlib module
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "client"))
+import protocol  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+
+
+def json_roundtrip(req_id, chunks):
+    wire = 0
+    out = []
+    for chunk in chunks:
+        msg = json.dumps({
+            "action":    "http_response_chunk",
+            "id":        req_id,
+            "body":      base64.b64encode(chunk).decode("ascii"),
+            "is_base64": True,
+        })
+        wire += len(msg.encode("utf-8"))
+        data = json.loads(msg)
+        out.append(base64.b64decode(data["body"]))
+    return wire, out
+
+
+def binary_roundtrip(req_id, chunks):
+    wire = 0
+    out = []
+    for chunk in chunks:
+        msg = protocol.pack_frame(req_id, protocol.RESPONSE_CHUNK, chunk)
+        wire += len(msg)
+        out.append(protocol.frame_to_dict(msg)["body"])
+    return wire, out
+
+
+def measure(fn, req_id, chunks, repeat):
+    best = None
+    wire = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        wire, out = fn(req_id, chunks)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert b"".join(out) == b"".join(chunks)
+    return wire, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    body = os.urandom(args.size_mb * 1024 * 1024)
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    req_id = str(uuid.uuid4())
+
+    results = {"payload_bytes": len(body), "chunk_size": CHUNK_SIZE}
+    for name, fn in (("json_base64", json_roundtrip), ("binary", binary_roundtrip)):
+        wire, cpu = measure(fn, req_id, chunks, args.repeat)
+        results[name] = {
+            "wire_bytes":       wire,
+            "overhead_pct":     round(100.0 * (wire - len(body)) / len(body), 2),
+            "cpu_ms_per_mb":    round(1000.0 * cpu / args.size_mb, 3),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Benchmark: reconnect storm after a hub restart.
+
+Boots the hub under uvicorn, connects --agents simulated agents (websocket +
+authenticate handshake, no request handling), then stops the hub for
+--downtime seconds and starts it again. Every agent runs the real agent's
+reconnect loop (tunnel_agent.keep_connected) with the chosen policy:
+
+    jitter   the agent's Backoff (exponential with full jitter), honouring
+             the hub's retry_after hint when turned away as busy
+    fixed    a constant --fixed-delay between attempts (the old behaviour)
+
+Reports the time from the restart until every agent was authenticated again,
+per-agent reconnect p50/p99, connection attempts, authentications the hub
+turned away and the peak number of concurrent authentications.
+
+Requires uvicorn. Prints JSON (or writes it to --output).
+
+Usage:
+    python benchmarks/bench_reconnect.py [--agents 200] [--policy jitter,fixed]
+                                         [--max-auth 32] [--output result.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import platform
+import statistics
+import time
+
+import hubenv
+from bench_e2e import free_port, git_revision, percentile, start_hub
+
+POLICIES = ("jitter", "fixed")
+
+
+class FixedDelay:
+    """The old policy, shaped like tunnel_agent.Backoff."""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def next(self, retry_after=None):
+        return self.delay
+
+    def reset(self):
+        pass
+
+
+class Fleet:
+    """Simulated agents sharing counters."""
+
+    def __init__(self, url, houses, policy, args):
+        self.url = url
+        self.houses = houses
+        self.policy = policy
+        self.args = args
+        self.up = set()
+        self.attempts = 0
+        self.busy = 0
+        self.connected_at = {}     # house_id → monotonic time of its last authentication
+        self.changed = asyncio.Event()
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"{len(self.up)}/{len(self.houses)} agents connected")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.changed.wait(), remaining)
+
+    async def agent(self, house_id, tunnel_agent):
+        import websockets
+
+        if self.policy == "fixed":
+            backoff = FixedDelay(self.args.fixed_delay)
+        else:
+            backoff = tunnel_agent.Backoff(self.args.base, self.args.cap)
+        auth = json.dumps({"action": "authenticate", "house_id": house_id,
+                           "auth_hash": hubenv.auth_hash(house_id)})
+
+        async def connect(connected):
+            self.attempts += 1
+            try:
+                async with websockets.connect(self.url, open_timeout=30) as ws:
+                    await ws.send(auth)
+                    reply = json.loads(await ws.recv())
+                    if reply.get("status") == "busy":
+                        self.busy += 1
+                        raise tunnel_agent.HubBusy(reply.get("retry_after"))
+                    connected()
+                    self.up.add(house_id)
+                    self.connected_at[house_id] = time.monotonic()
+                    self._wake()
+                    await ws.wait_closed()
+            finally:
+                if house_id in self.up:
+                    self.up.discard(house_id)
+                    self._wake()
+
+        await tunnel_agent.keep_connected(connect, backoff, house=house_id)
+
+
+async def storm(policy, args, houses):
+    import tunnel_agent
+    from tunnel import consumers
+    from tunnel.utils import auth_admission
+
+    consumers.AUTH["MAX_CONCURRENT"] = args.max_auth or float("inf")
+    port = free_port()
+    server, task = await start_hub(port)
+    fleet = Fleet(f"ws://127.0.0.1:{port}/ws/tunnel/", houses, policy, args)
+    agents = [asyncio.create_task(fleet.agent(h, tunnel_agent)) for h in houses]
+    await fleet.wait(lambda: len(fleet.up) == len(houses), args.timeout)
+
+    # Restart the hub; every tunnel drops at once
+    server.should_exit = True
+    await task
+    await fleet.wait(lambda: not fleet.up, args.timeout)
+    await asyncio.sleep(args.downtime)
+    attempts, busy = fleet.attempts, fleet.busy
+    auth_admission.update(peak=0, admitted=0, rejected=0)
+    server, task = await start_hub(port)
+    restarted = time.monotonic()
+    await fleet.wait(lambda: len(fleet.up) == len(houses), args.timeout)
+    recovery = time.monotonic() - restarted
+
+    reconnect = [(fleet.connected_at[h] - restarted) * 1000 for h in houses]
+    result = {
+        "recovery_s": round(recovery, 3),
+        "reconnect_p50_ms": round(statistics.median(reconnect), 1),
+        "reconnect_p99_ms": round(percentile(reconnect, 99), 1),
+        "attempts": fleet.attempts - attempts,
+        "busy_rejections": fleet.busy - busy,
+        "auth_admitted": auth_admission["admitted"],
+        "auth_peak_concurrency": auth_admission["peak"],
+    }
+
+    for agent in agents:
+        agent.cancel()
+    await asyncio.gather(*agents, return_exceptions=True)
+    server.should_exit = True
+    await task
+    return result
+
+
+async def bench(args):
+    houses = hubenv.house_ids(args.agents)
+    results = {}
+    for policy in args.policy:
+        results[policy] = await storm(policy, args, houses)
+    return {
+        "benchmark": "reconnect",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "agents": args.agents,
+            "downtime_s": args.downtime,
+            "max_auth": args.max_auth,
+            "backoff_base_s": args.base,
+            "backoff_cap_s": args.cap,
+            "fixed_delay_s": args.fixed_delay,
+        },
+        "policies": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--policy", default=",".join(POLICIES),
+                        type=lambda s: [p for p in s.split(",") if p])
+    parser.add_argument("--max-auth", type=int, default=32,
+                        help="hub cap on concurrent authentications; 0 = no cap")
+    parser.add_argument("--downtime", type=float, default=1.0, help="seconds the hub stays down")
+    parser.add_argument("--base", type=float, default=1.0, help="backoff base in seconds")
+    parser.add_argument("--cap", type=float, default=60.0, help="backoff cap in seconds")
+    parser.add_argument("--fixed-delay", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep hub logs")
+    args = parser.parse_args()
+    unknown = set(args.policy) - set(POLICIES)
+    if unknown:
+        parser.error(f"unknown policies: {', '.join(sorted(unknown))}")
+
+    hubenv.setup(args.agents)
+    if not args.verbose:
+        logging.getLogger("tunnel").setLevel(logging.WARNING)
+        logging.getLogger("agent").setLevel(logging.ERROR)
+    results = asyncio.run(bench(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+Hub settings for the benchmarks: in-memory channel layer and a throwaway
+SQLite database, everything else as in hub/settings.py.
+"""
+import os
+import tempfile
+
+from hub.settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+ALLOWED_HOSTS = ["*"]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(tempfile.gettempdir(), "ghostport_bench.sqlite3"),
+    }
+}
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 1000},
+    },
+}
@@ -0,0 +1,101 @@
+"""
+Boots the hub's Django project for the benchmarks (see bench_settings.py).
+
+Functions:
+    setup: Configures Django, migrates a fresh database and creates houses.
+    house_ids: Ids of the houses created by setup.
+    auth_hash: The auth_hash an agent presents for a house.
+    asgi_application: The hub's HTTP + websocket ASGI app.
+    fake_agent: Answers proxy_request frames on a WebsocketCommunicator.
+"""
+import hashlib
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "hub"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+HOUSE_ID = "BENCH1"
+SECRET_KEY = "bench-secret"
+
+
+def house_ids(count):
+    """
+    Returns the ids of the first `count` bench houses, HOUSE_ID first.
+    """
+    return [HOUSE_ID] + [f"BENCH{i}" for i in range(2, count + 1)]
+
+
+def auth_hash(house_id=HOUSE_ID):
+    """
+    Returns the auth_hash an agent must present for a bench house.
+    """
+    return hashlib.sha256((house_id + SECRET_KEY).encode()).hexdigest()
+
+
+def setup(houses=1):
+    """
+    Configures Django with bench_settings, migrates a fresh database and
+    registers HOUSE_ID (and houses - 1 more, all with SECRET_KEY).
+
+    Returns:
+        str: The auth_hash an agent must present for HOUSE_ID.
+    """
+    os.environ["DJANGO_SETTINGS_MODULE"] = "bench_settings"
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    if os.path.exists(settings.DATABASES["default"]["NAME"]):
+        os.remove(settings.DATABASES["default"]["NAME"])
+    call_command("migrate", verbosity=0)
+
+    from tunnel.models import Clients, HouseTunnel
+    user = Clients.objects.create(email="bench@example.com", userid="bench", password="x")
+    for house_id in house_ids(houses):
+        HouseTunnel.objects.create(user=user, house_id=house_id, secret_key=SECRET_KEY)
+    return auth_hash()
+
+
+def asgi_application(proxy=True):
+    """
+    Returns the hub's ASGI app (hub/asgi.py) as a server like daphne or
+    uvicorn would run it; with proxy=False /homes/ requests go through
+    Django instead of the pure-ASGI route. Call after setup().
+    """
+    from channels.routing import ProtocolTypeRouter, URLRouter
+    from django.core.asgi import get_asgi_application
+    from tunnel.routing import websocket_urlpatterns
+
+    if proxy:
+        from hub.asgi import application
+        return application
+    return ProtocolTypeRouter({
+        "http": get_asgi_application(),
+        "websocket": URLRouter(websocket_urlpatterns),
+    })
+
+
+async def fake_agent(communicator, body=b'{"ok": true}'):
+    """
+    Plays the agent on a connected WebsocketCommunicator: answers every
+    proxy_request frame with a 200 JSON response until cancelled.
+    """
+    while True:
+        frame = json.loads(await communicator.receive_from(timeout=3600))
+        if frame.get("action") != "proxy_request":
+            continue
+        await communicator.send_to(text_data=json.dumps({
+            "action": "http_response_start", "id": frame["id"],
+            "status": 200, "headers": {"Content-Type": "application/json"},
+        }))
+        await communicator.send_to(text_data=json.dumps({
+            "action": "http_response_chunk", "id": frame["id"],
+            "body": body.decode(), "is_base64": False,
+        }))
+        await communicator.send_to(text_data=json.dumps({
+            "action": "http_response_end", "id": frame["id"],
+        }))
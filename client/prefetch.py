@@ -0,0 +1,228 @@
+# agent/prefetch.py
+"""
+Predictive HLS segment prefetch for the tunnel agent.
+
+When the agent proxies a playlist (.m3u8) it remembers the segments the
+playlist references. The segments a player is about to ask for next are then
+fetched from the local server in the background and kept in a bounded
+in-memory cache, so the hub's segment requests do not wait on the local
+encoder or nginx.
+
+Classes:
+    SegmentPrefetcher: Playlist tracking, background fetches and the segment cache.
+"""
+import asyncio
+import logging
+import posixpath
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+PLAYLIST_SUFFIXES = ('.m3u8',)
+SEGMENT_SUFFIXES = ('.ts', '.m4s', '.aac', '.mp4')
+
+logger = logging.getLogger("agent.prefetch")
+
+# Headers of the playlist request that are not reused for segment fetches
+DROP_HEADERS = {"range", "content-length", "content-type", "if-none-match", "if-modified-since"}
+
+# Headers that decide what a client may see; a prefetched segment is only
+# served to a request presenting the same ones as the playlist request
+CREDENTIAL_HEADERS = {"cookie", "authorization"}
+
+
+def credentials(headers: dict) -> tuple:
+    """
+    Returns the credential headers of a request in a comparable form.
+    """
+    return tuple(sorted((k.lower(), v) for k, v in headers.items() if k.lower() in CREDENTIAL_HEADERS))
+
+
+def parse_playlist(path: str, text: str):
+    """
+    Extracts the segment paths referenced by a media playlist.
+
+    Args:
+        path (str): Path of the playlist, used to resolve relative URIs.
+        text (str): Playlist body.
+
+    Returns:
+        tuple: (segment paths in playlist order, whether the playlist is complete (VOD))
+    """
+    base = posixpath.dirname(path.lstrip('/'))
+    segments = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if "://" in line:
+            continue  # Segments on another host are not ours to fetch
+        uri = line.split('?', 1)[0]
+        if line.startswith('/'):
+            segments.append(posixpath.normpath(uri.lstrip('/')))
+        else:
+            segments.append(posixpath.normpath(posixpath.join(base, uri)))
+    return segments, "#EXT-X-ENDLIST" in text
+
+
+class SegmentPrefetcher:
+    """
+    Tracks proxied playlists and prefetches the segments that follow the one a
+    player last requested.
+
+    Attributes:
+        depth (int): Number of segments fetched ahead.
+        max_bytes (int): Memory budget of the segment cache.
+        ttl (float): Seconds a prefetched segment stays valid.
+        stats (dict): hits, misses, prefetched and evictions counters.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, base_url: str,
+                 depth: int = 3, max_bytes: int = 32 * 1024 * 1024, ttl: float = 30):
+        self.session = session
+        self.base_url = base_url
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4
+        self.ttl = ttl
+        self.cache = OrderedDict()   # segment path → (status, headers, body, expires, credentials)
+        self.bytes = 0
+        self.inflight = {}           # segment path → fetch task
+        self.playlists = {}          # playlist path → (segment paths, request headers)
+        self.following = {}          # segment path → playlist path
+        self.position = {}           # playlist path → segment the player requested last
+        self.stats = {"hits": 0, "misses": 0, "prefetched": 0, "evictions": 0}
+
+    @staticmethod
+    def is_playlist(path: str) -> bool:
+        return path.split('?', 1)[0].endswith(PLAYLIST_SUFFIXES)
+
+    @staticmethod
+    def is_segment(path: str) -> bool:
+        return path.split('?', 1)[0].endswith(SEGMENT_SUFFIXES)
+
+    def observe_playlist(self, path: str, text: str, headers: dict) -> None:
+        """
+        Records the segments of a proxied playlist and prefetches the ones a
+        player will request first: the start of a VOD playlist, or the live edge.
+        """
+        segments, complete = parse_playlist(path, text)
+        if not segments:
+            return
+        headers = {k: v for k, v in headers.items() if k.lower() not in DROP_HEADERS}
+        path = path.lstrip('/')
+        previous = self.playlists.get(path)
+        if previous:
+            # Live playlists slide forward; forget segments that fell off
+            for segment in set(previous[0]) - set(segments):
+                if self.following.get(segment) == path:
+                    del self.following[segment]
+        self.playlists[path] = (segments, headers)
+        for segment in segments:
+            self.following[segment] = path
+        last = self.position.get(path)
+        if last in segments:
+            # Player is already walking this playlist; continue after its position
+            start = segments.index(last) + 1
+        elif complete:
+            start = 0
+        else:
+            start = max(len(segments) - self.depth, 0)
+        self._prefetch(segments[start:start + self.depth], headers)
+
+    def advance(self, path: str) -> None:
+        """
+        Called for every segment request: prefetches the segments that follow it.
+        """
+        segment = path.lstrip('/')
+        playlist = self.following.get(segment)
+        if playlist is None:
+            return
+        segments, headers = self.playlists[playlist]
+        self.position[playlist] = segment
+        index = segments.index(segment)
+        self._prefetch(segments[index + 1:index + 1 + self.depth], headers)
+
+    def _prefetch(self, segments, headers: dict) -> None:
+        for segment in segments:
+            if segment in self.cache or segment in self.inflight:
+                continue
+            task = asyncio.create_task(self._fetch(segment, headers))
+            self.inflight[segment] = task
+            task.add_done_callback(lambda _, s=segment: self.inflight.pop(s, None))
+
+    async def _fetch(self, segment: str, headers: dict):
+        try:
+            async with self.session.get(f"{self.base_url}/{segment}", headers=headers) as resp:
+                if resp.status != 200:
+                    return None
+                if resp.content_length and resp.content_length > self.max_entry_bytes:
+                    return None
+                # Not content.read(n): it returns what is buffered, not n bytes
+                body = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    body += chunk
+                    if len(body) > self.max_entry_bytes:
+                        return None
+                entry = (resp.status, dict(resp.headers), bytes(body), time.monotonic() + self.ttl,
+                         credentials(headers))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logger.warning(f"⚠️ Prefetch failed for {segment}: {exc!r}")
+            return None
+        self._store(segment, entry)
+        self.stats["prefetched"] += 1
+        return entry
+
+    def _store(self, segment: str, entry) -> None:
+        self._drop(segment)
+        self.cache[segment] = entry
+        self.bytes += len(entry[2])
+        while self.bytes > self.max_bytes and self.cache:
+            _, (_, _, body, _, _) = self.cache.popitem(last=False)
+            self.bytes -= len(body)
+            self.stats["evictions"] += 1
+
+    def _drop(self, segment: str):
+        entry = self.cache.pop(segment, None)
+        if entry:
+            self.bytes -= len(entry[2])
+        return entry
+
+    async def take(self, path: str, headers: dict):
+        """
+        Returns (status, headers, body) for a prefetched segment, waiting for an
+        in-flight prefetch of it, or None on a miss. A segment fetched with
+        other credentials than the request's `headers` carry is a miss and
+        stays cached for its player. Served segments leave the cache since
+        players request each segment once.
+        """
+        segment = path.lstrip('/')
+        if segment not in self.following and segment not in self.cache:
+            return None  # Not part of any playlist we have seen
+        task = self.inflight.get(segment)
+        if task:
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+        entry = self.cache.get(segment)
+        if entry and entry[4] != credentials(headers):
+            self.stats["misses"] += 1
+            return None
+        entry = self._drop(segment)
+        if entry and entry[3] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[:3]
+        self.stats["misses"] += 1
+        return None
+
+    def info(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.cache),
+            "bytes": self.bytes,
+            "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
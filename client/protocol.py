@@ -0,0 +1,295 @@
+# agent/protocol.py
+"""
+Binary frame format for the tunnel (mirrors hub/tunnel/protocol.py).
+
+Every binary WebSocket message is a fixed 22-byte header followed by the payload:
+
+    +-----------------+------+-------+------------+-----------------+
+    | request id (16) | type | flags | length (4) | payload ...     |
+    +-----------------+------+-------+------------+-----------------+
+
+The request id is the raw 16 bytes of the frame's uuid and all integers are
+big-endian. Body chunks travel as raw bytes; the few frames that carry metadata
+(status and headers) use a JSON payload.
+
+Metadata payloads of binary frames, and the proxied requests themselves, are
+encoded with the codec negotiated during `authenticate`: msgpack (when the
+`msgpack` package is installed) carries request bodies as raw bytes inside
+a REQUEST frame; orjson and the stdlib json send text frames with base64
+bodies. Peers that do not offer a codec use json.
+
+Body chunks may be compressed one frame at a time with the method negotiated
+during `authenticate` (zstd when the `zstandard` package is installed, else
+zlib). Binary frames mark it with a flag bit, JSON frames with a
+"compression" key next to the base64 body.
+
+Functions:
+    pack_frame: Builds a binary frame.
+    unpack_frame: Parses a binary frame.
+    compress: Compresses a body chunk.
+    decompress: Reverses compress.
+    get_codec: Returns the codec of a negotiated name.
+"""
+import json
+import struct
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib is always available
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # the fast codecs are optional; json is always available
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct("!16sBBI")
+
+# Framing modes offered during the `authenticate` handshake, preferred first
+FRAMING_BINARY = "binary"
+FRAMING_JSON = "json"
+SUPPORTED_FRAMING = (FRAMING_BINARY, FRAMING_JSON)
+
+# Frame types
+RESPONSE_START = 1  # payload: JSON {"status", "headers"}
+RESPONSE_CHUNK = 2  # payload: raw body bytes
+RESPONSE_END   = 3  # payload: empty, or JSON {"error"} when the stream was aborted
+REQUEST_CHUNK  = 4  # payload: raw request body bytes (hub → agent)
+REQUEST_END    = 5  # payload: empty
+WINDOW_UPDATE  = 6  # payload: JSON {"credit", "close"} (either direction)
+CANCEL         = 7  # payload: empty (hub → agent)
+REQUEST        = 8  # payload: the proxy_request frame, binary codecs only (hub → agent)
+
+# Flag bits
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+
+# Compression methods offered during the `authenticate` handshake, preferred first
+SUPPORTED_COMPRESSION = ("zstd", "zlib") if zstandard else ("zlib",)
+COMPRESSION_FLAGS = {"zlib": FLAG_ZLIB, "zstd": FLAG_ZSTD}
+
+# Content types worth compressing; media and archives are already compressed
+COMPRESSIBLE_TYPES = ("text/", "json", "javascript", "xml", "mpegurl", "svg", "csv")
+
+# JSON action name of each frame type
+ACTIONS = {
+    RESPONSE_START: "http_response_start",
+    RESPONSE_CHUNK: "http_response_chunk",
+    RESPONSE_END:   "http_response_end",
+    REQUEST_CHUNK:  "request_body_chunk",
+    REQUEST_END:    "request_body_end",
+    WINDOW_UPDATE:  "window_update",
+    CANCEL:         "cancel",
+    REQUEST:        "proxy_request",
+}
+
+
+class JsonCodec:
+    """
+    Encodes frames with the stdlib json module.
+
+    Attributes:
+        name (str): Name offered and negotiated during `authenticate`.
+        binary (bool): Whether the encoding is binary and carries raw bytes
+            (then frames go out as binary messages only).
+    """
+    name = "json"
+    binary = False
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    def dumps_text(self, obj) -> str:
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """Encodes frames as JSON with orjson."""
+    name = "orjson"
+    # Header dicts may have str subclass keys (aiohttp's istr)
+    options = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, option=self.options)
+
+    def dumps_text(self, obj) -> str:
+        return orjson.dumps(obj, option=self.options).decode("utf-8")
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """Encodes frames with msgpack; bytes values stay raw bytes."""
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Codecs offered during the `authenticate` handshake, preferred first
+CODECS = {codec.name: codec for codec in (
+    MsgpackCodec() if msgpack else None,
+    OrjsonCodec() if orjson else None,
+    JsonCodec(),
+) if codec}
+SUPPORTED_CODECS = tuple(CODECS)
+
+# Codec of the text messages (handshake, pings, and all frames when a JSON
+# codec is negotiated); any JSON codec reads what another one wrote
+TEXT_CODEC = CODECS.get("orjson") or CODECS["json"]
+
+
+def pack_frame(req_id: str, frame_type: int, payload: bytes = b"", flags: int = 0) -> bytes:
+    """
+    Builds a binary frame.
+
+    Args:
+        req_id (str): Request id (uuid string).
+        frame_type (int): One of the frame type constants.
+        payload (bytes): Frame payload.
+        flags (int): Flag bits.
+
+    Returns:
+        bytes: Header followed by the payload.
+    """
+    return HEADER.pack(uuid.UUID(req_id).bytes, frame_type, flags, len(payload)) + payload
+
+
+def pack_json_frame(req_id: str, frame_type: int, data: dict, flags: int = 0, codec=None) -> bytes:
+    """
+    Builds a binary frame whose payload is a JSON document, or `data`
+    encoded with `codec` once one was negotiated.
+    """
+    return pack_frame(req_id, frame_type, (codec or CODECS["json"]).dumps(data), flags)
+
+
+def unpack_frame(data: bytes):
+    """
+    Parses a binary frame.
+
+    Args:
+        data (bytes): Raw WebSocket message.
+
+    Returns:
+        tuple: (req_id, frame_type, flags, payload)
+
+    Raises:
+        ValueError: If the message is truncated or its length field is wrong.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("binary frame shorter than header")
+    raw_id, frame_type, flags, length = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+    if len(payload) != length:
+        raise ValueError(f"binary frame length mismatch ({len(payload)} != {length})")
+    return str(uuid.UUID(bytes=raw_id)), frame_type, flags, payload
+
+
+def frame_to_dict(data: bytes, codec=None) -> dict:
+    """
+    Parses a binary frame into the equivalent JSON-protocol frame, with the
+    body left as raw bytes. Metadata payloads are decoded with `codec`
+    (json by default).
+    """
+    req_id, frame_type, flags, payload = unpack_frame(data)
+    codec = codec or CODECS["json"]
+    if frame_type == REQUEST:
+        return codec.loads(payload)
+    out = {"action": ACTIONS.get(frame_type), "id": req_id}
+    if frame_type in (RESPONSE_CHUNK, REQUEST_CHUNK):
+        out["body"] = payload
+        for method, flag in COMPRESSION_FLAGS.items():
+            if flags & flag:
+                out["compression"] = method
+    elif payload:
+        out.update(codec.loads(payload))
+    return out
+
+
+def negotiate_framing(offered) -> str:
+    """
+    Picks the preferred framing mode out of those offered by the peer.
+    """
+    for mode in SUPPORTED_FRAMING:
+        if mode in (offered or ()):
+            return mode
+    return FRAMING_JSON
+
+
+def negotiate_compression(offered):
+    """
+    Picks the preferred compression method out of those offered by the peer,
+    or None when there is none in common.
+    """
+    for method in SUPPORTED_COMPRESSION:
+        if method in (offered or ()):
+            return method
+    return None
+
+
+def negotiate_codec(offered, binary_framing: bool = True) -> str:
+    """
+    Picks the preferred codec out of those offered by the peer; binary
+    codecs only go with binary framing.
+    """
+    for name, codec in CODECS.items():
+        if name in (offered or ()) and (binary_framing or not codec.binary):
+            return name
+    return "json"
+
+
+def get_codec(name: str):
+    """
+    Returns the codec of a negotiated name (json for unknown names and None).
+    """
+    return CODECS.get(name) or CODECS["json"]
+
+
+def text_codec(codec):
+    """
+    Returns the codec for the text messages of a connection using `codec`.
+    """
+    return TEXT_CODEC if codec.binary else codec
+
+
+def should_compress(content_type: str) -> bool:
+    """
+    Tells whether a body of this type is worth compressing on the tunnel.
+    """
+    content_type = (content_type or "").lower()
+    return any(t in content_type for t in COMPRESSIBLE_TYPES)
+
+
+def compress(data: bytes, method: str) -> bytes:
+    """
+    Compresses one body chunk as a standalone zlib or zstd frame.
+    """
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(data: bytes, method: str) -> bytes:
+    """
+    Reverses compress.
+    """
+    if method == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd frame received but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
@@ -13,18 +13,93 @@ Author: YourName
 
 import asyncio
 import base64
+import codecs
+import collections
+import contextlib
 import hashlib
+import heapq
+import itertools
 import json
-import traceback
+import logging
+import random
+import time
 import aiohttp
 import websockets
 import socket
 import os
+import logs
+import metrics
+import protocol
+from aiohttp import web
+from logs import kv, summarize
+from prefetch import SegmentPrefetcher
 from config import load  # Loads `house_id` and `secret_key` from local config
 
 # URL of the central WebSocket server (must be reachable by this agent)
 CENTRAL_WS = "ws://10.23.8.207:5090/ws/tunnel/"
 
+# Size of the body chunks streamed back to the central server
+CHUNK_SIZE = 64 * 1024
+
+# Default number of requests proxied to the local server at the same time
+# (override with "max_concurrency" in arhouse.json)
+MAX_CONCURRENCY = 16
+
+# Defaults for the pooled connection to the local server (override with the
+# "upstream_*" keys in arhouse.json)
+UPSTREAM_LIMIT          = 64   # total open connections
+UPSTREAM_LIMIT_PER_HOST = 32   # open connections per upstream host
+UPSTREAM_KEEPALIVE      = 30   # seconds an idle connection is kept
+UPSTREAM_DNS_TTL        = 300  # seconds a DNS answer is cached
+
+# Defaults for HLS segment prefetch (override with the "prefetch_*" keys in
+# arhouse.json; a depth of 0 turns prefetch off)
+PREFETCH_DEPTH     = 3                  # segments fetched ahead of the player
+PREFETCH_MAX_BYTES = 32 * 1024 * 1024   # memory budget of the segment cache
+PREFETCH_TTL       = 30                 # seconds a prefetched segment is kept
+
+# Largest playlist body inspected for prefetch
+MAX_PLAYLIST_BYTES = 1024 * 1024
+
+# Address of the optional Prometheus endpoint (enable with "metrics_port" in
+# arhouse.json)
+METRICS_HOST = "127.0.0.1"
+
+# Reconnect backoff: the delay before the n-th retry is drawn uniformly from
+# [0, min(RECONNECT_MAX, RECONNECT_BASE * 2**n)] seconds (override with
+# "reconnect_base" / "reconnect_max" in arhouse.json)
+RECONNECT_BASE = 1
+RECONNECT_MAX  = 60
+# Seconds a connection must stay up before the backoff starts over, so a hub
+# that accepts and then drops agents does not get a hot reconnect loop
+# (override with "reconnect_stable" in arhouse.json)
+RECONNECT_STABLE = 30
+
+# Priority classes of proxied requests and their weights: when both classes
+# wait, upstream slots and websocket bytes are shared 8:1 (override with
+# "priority_weights" in arhouse.json). Bulk requests may hold at most
+# BULK_SLOT_SHARE of the upstream slots, so interactive calls always find one.
+PRIORITY_WEIGHTS = {"interactive": 8, "bulk": 1}
+BULK_SLOT_SHARE  = 0.75
+
+# Requests for paths like these, or with a Range header, are bulk transfers
+# unless the hub set a priority
+BULK_SUFFIXES = ('.ts', '.m4s', '.mp4', '.webm', '.mkv', '.mov', '.aac', '.mp3')
+
+# Tunnel connections per house, and how many of them carry bulk (media)
+# transfers (override with "tunnel_connections" / "bulk_connections" in
+# arhouse.json; with one connection everything shares it)
+TUNNEL_CONNECTIONS = 2
+BULK_CONNECTIONS   = 1
+
+# Heartbeat pings missed in a row before the tunnel is considered dead and
+# reconnected (the hub chooses the ping interval)
+HEARTBEAT_MISSES = 3
+
+# Body chunks smaller than this are never compressed (override with
+# "compress_min_bytes" in arhouse.json; "compression": [] turns it off)
+COMPRESS_MIN_BYTES = 1024
+
 def get_local_api() -> str:
     """
     Returns the local API base URL using internal networking (e.g., Docker).
@@ -40,17 +115,501 @@ def get_local_api() -> str:
 
 # Local API base URL
 LOCAL_API = get_local_api()
-print(f"🌐 Local API base: {LOCAL_API}")
 
-async def handle_request(frame: dict, ws: websockets.WebSocketClientProtocol, house_id: str) -> None:
+logger = logging.getLogger("agent")
+
+class HubBusy(Exception):
+    """
+    The hub turned the authentication away (too many at once).
+
+    Attributes:
+        retry_after (float): Seconds the hub asked us to wait, or None.
+    """
+
+    def __init__(self, retry_after: float = None):
+        super().__init__(f"hub busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter for tunnel reconnects, so agents
+    cut off together (hub restart) do not come back in synchronized waves.
+
+    Attributes:
+        base (float): Upper bound of the first delay, in seconds.
+        cap (float): Largest upper bound, in seconds.
+        attempt (int): Failed attempts since the last successful connection.
+    """
+
+    def __init__(self, base: float = RECONNECT_BASE, cap: float = RECONNECT_MAX):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self, retry_after: float = None) -> float:
+        """
+        Returns the delay before the next attempt, at least `retry_after`
+        when the hub sent one.
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return max(delay, retry_after or 0)
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+
+async def keep_connected(connect, backoff: Backoff, stable_after: float = RECONNECT_STABLE,
+                         **log_fields) -> None:
+    """
+    Calls `connect(connected)` again and again, waiting `backoff.next()`
+    seconds in between however the attempt ended: turned away as busy (at
+    least the hub's retry_after), an error, or a clean close by the hub.
+    `connect` calls `connected()` once authenticated; the backoff only
+    starts over when that connection then stayed up `stable_after` seconds.
+
+    Args:
+        connect: Coroutine function holding one connection until it closes.
+        backoff (Backoff): Delays between attempts.
+        stable_after (float): Seconds of uptime that reset the backoff.
+        **log_fields: Extra fields of the reconnect log lines.
+    """
+    while True:
+        up_since = []
+        retry_after = None
+        try:
+            await connect(lambda: up_since.append(time.monotonic()))
+        except HubBusy as exc:
+            retry_after = exc.retry_after
+            level, message = logging.INFO, "⏳ Hub busy"
+        except Exception as exc:
+            level, message = logging.WARNING, f"❗ Tunnel error: {exc!r}"
+        else:
+            level, message = logging.INFO, "🔌 Tunnel closed"
+        if up_since and time.monotonic() - up_since[0] >= stable_after:
+            backoff.reset()
+        delay = backoff.next(retry_after)
+        logger.log(level, f"{message} → retrying in {delay:.1f}s…", extra=kv(**log_fields))
+        await asyncio.sleep(delay)
+
+
+def upstream_trace_config() -> aiohttp.TraceConfig:
+    """
+    Records how long traced requests spend opening a connection to the local
+    server in their trace dict ("connect_ms"; 0 when a pooled connection is reused).
+    """
+    async def on_start(session, ctx, params):
+        ctx.connect_started = time.perf_counter()
+
+    async def on_end(session, ctx, params):
+        if isinstance(ctx.trace_request_ctx, dict):
+            ctx.trace_request_ctx["connect_ms"] = round(
+                (time.perf_counter() - ctx.connect_started) * 1000, 3)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+
+def create_session(cfg: dict) -> aiohttp.ClientSession:
+    """
+    Creates the long-lived HTTP session used to reach the local server.
+
+    Connections are pooled and kept alive between requests, and DNS answers
+    for `nginx_server` are cached. When "upstream_unix_socket" is set the
+    local server is reached through that Unix domain socket instead of TCP.
+
+    Args:
+        cfg (dict): Agent configuration (arhouse.json).
+
+    Returns:
+        aiohttp.ClientSession: Session to share across all proxied requests.
+    """
+    limit = cfg.get("upstream_limit", UPSTREAM_LIMIT)
+    limit_per_host = cfg.get("upstream_limit_per_host", UPSTREAM_LIMIT_PER_HOST)
+    keepalive = cfg.get("upstream_keepalive", UPSTREAM_KEEPALIVE)
+
+    unix_socket = cfg.get("upstream_unix_socket")
+    if unix_socket:
+        connector = aiohttp.UnixConnector(
+            path=unix_socket,
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive,
+        )
+        logger.info(f"🧦 Local API via Unix socket: {unix_socket}")
+    else:
+        connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive,
+            use_dns_cache=True,
+            ttl_dns_cache=cfg.get("upstream_dns_ttl", UPSTREAM_DNS_TTL),
+        )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[upstream_trace_config()])
+
+
+def create_prefetcher(cfg: dict, session: aiohttp.ClientSession):
+    """
+    Creates the HLS segment prefetcher configured in arhouse.json.
+
+    Returns:
+        SegmentPrefetcher: The prefetcher, or None when "prefetch_depth" is 0.
+    """
+    depth = cfg.get("prefetch_depth", PREFETCH_DEPTH)
+    if depth <= 0:
+        return None
+    return SegmentPrefetcher(
+        session, LOCAL_API,
+        depth=depth,
+        max_bytes=cfg.get("prefetch_max_bytes", PREFETCH_MAX_BYTES),
+        ttl=cfg.get("prefetch_ttl", PREFETCH_TTL),
+    )
+
+
+class FlowControl:
+    """
+    Credit windows granted by the hub for response bodies.
+
+    Each request may have `stream_window` body bytes sent that the hub has
+    not credited back yet, and all requests together `tunnel_window`. A
+    request out of credit waits, which stops reading from the local server,
+    so a slow client only holds up its own response.
+
+    Attributes:
+        stream_window (int): Credit of each request.
+        tunnel_window (int): Credit shared by all requests on the tunnel.
+        outstanding (dict): Request id → body bytes sent and not yet credited.
+        total (int): Sum of `outstanding`.
+    """
+
+    def __init__(self, stream_window: int, tunnel_window: int):
+        self.stream_window = stream_window
+        self.tunnel_window = tunnel_window
+        self.outstanding = {}
+        self.total = 0
+        self.open = set()     # requests whose response is being sent
+        self.closed = set()   # open requests the hub stopped reading
+        self.changed = asyncio.Event()
+
+    def _wake(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def acquire(self, req_id: str, size: int) -> None:
+        """
+        Waits until both windows have room for `size` bytes and takes them.
+        A request with nothing outstanding may always send one chunk, however
+        large, so chunks bigger than a window cannot deadlock.
+        """
+        while req_id not in self.closed:
+            used = self.outstanding.get(req_id, 0)
+            if ((not used or used + size <= self.stream_window)
+                    and (not self.total or self.total + size <= self.tunnel_window)):
+                self.outstanding[req_id] = used + size
+                self.total += size
+                return
+            await self.changed.wait()
+
+    def credit(self, req_id: str, size: int, close: bool = False) -> None:
+        """
+        Applies a `window_update` from the hub. `close` means the hub dropped
+        the request, so all of its outstanding bytes are released.
+        """
+        used = self.outstanding.get(req_id, 0)
+        size = used if close else min(size, used)
+        self.total -= size
+        if close:
+            self.outstanding.pop(req_id, None)
+            if req_id in self.open:
+                self.closed.add(req_id)
+        elif used - size:
+            self.outstanding[req_id] = used - size
+        else:
+            self.outstanding.pop(req_id, None)
+        self._wake()
+
+    def finish(self, req_id: str) -> None:
+        """Called once the end frame of a response went out."""
+        self.open.discard(req_id)
+        self.closed.discard(req_id)
+
+
+class FrameWriter:
+    """
+    Sends response frames for the tunnel using the framing mode negotiated
+    during authentication: raw binary frames, or JSON frames with base64 bodies.
+
+    Writes from concurrent request tasks are serialized, so every message goes
+    out whole and the frames of one request keep their order. When writes
+    queue up they go out by weighted fair queuing over their bytes, using the
+    priority class of their request (`priorities`), so bulk bodies only get
+    the share of the uplink interactive responses leave them.
+
+    Body chunks of compressible responses are compressed with the negotiated
+    method when they are at least `min_compress` bytes and actually shrink.
+
+    With flow control negotiated, body chunks wait for credit (see FlowControl);
+    the bytes charged are the decoded body bytes the hub will hand on.
+
+    Attributes:
+        ws (websockets.WebSocketClientProtocol): Active WebSocket connection.
+        binary (bool): Whether the binary framing mode is in use.
+        compression (str): Negotiated compression method, or None.
+        codec: Negotiated codec of frame metadata (see protocol.CODECS).
+        text: Codec of the JSON text messages.
+        flow (FlowControl): Response credit windows, or None.
+        priorities (dict): Request id → priority class; other frames are interactive.
+        stats (dict): Compressed frames, raw and wire bytes, and CPU seconds.
+    """
+
+    def __init__(self, ws: websockets.WebSocketClientProtocol, framing: str = protocol.FRAMING_JSON,
+                 compression: str = None, min_compress: int = COMPRESS_MIN_BYTES,
+                 flow: FlowControl = None, weights: dict = PRIORITY_WEIGHTS, codec=None):
+        self.ws = ws
+        self.binary = framing == protocol.FRAMING_BINARY
+        self.compression = compression
+        self.codec = codec or protocol.get_codec("json")
+        self.text = protocol.text_codec(self.codec)
+        self.min_compress = min_compress
+        self.flow = flow
+        self.weights = weights
+        self.priorities = {}
+        self.sending = False
+        self.waiting = []        # heap of (virtual finish tag, seq, future)
+        self.seq = itertools.count()
+        self.vtime = 0.0         # tag of the message being sent
+        self.last_tag = {}       # priority class → tag of its last queued message
+        self.stats = {"frames": 0, "raw_bytes": 0, "wire_bytes": 0, "cpu_seconds": 0.0}
+        self.request_stats = {}  # req_id → stats of that response, sent with its end frame
+        self.progress = {}       # req_id → [body bytes sent, Content-Length or None]
+        self.encode_times = {}   # req_id → seconds spent encoding chunks (traced requests)
+
+    async def send(self, message, req_id: str = None) -> None:
+        """
+        Sends one message once it is its turn. Messages of one class keep
+        their order; between classes each message is tagged with its virtual
+        finish time (bytes / class weight) and the smallest tag goes first.
+        """
+        if self.sending:
+            cls = self.priorities.get(req_id, "interactive")
+            tag = max(self.vtime, self.last_tag.get(cls, 0.0)) + len(message) / self.weights.get(cls, 1)
+            self.last_tag[cls] = tag
+            turn = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (tag, next(self.seq), turn))
+            try:
+                await turn
+            except asyncio.CancelledError:
+                if turn.done() and not turn.cancelled():
+                    self._next()  # Our turn came as we were cancelled; pass it on
+                raise
+        else:
+            self.sending = True
+        try:
+            await self.ws.send(message)
+        finally:
+            self._next()
+
+    def _next(self) -> None:
+        while self.waiting:
+            tag, _, turn = heapq.heappop(self.waiting)
+            if not turn.done():
+                self.vtime = tag
+                turn.set_result(None)
+                return
+        self.sending = False
+
+    async def acquire(self, req_id: str, size: int) -> None:
+        if self.flow:
+            await self.flow.acquire(req_id, size)
+
+    async def start(self, req_id: str, status: int, headers: dict, trace: dict = None) -> None:
+        """
+        Sends the response head (status and headers). `trace` holds the agent's
+        timings so far for a traced request; its encode time is then tracked.
+        """
+        if self.flow:
+            self.flow.open.add(req_id)
+        length = next((v for k, v in headers.items() if k.lower() == "content-length"), None)
+        self.progress[req_id] = [0, int(length) if str(length).isdigit() else None]
+        head = {"status": status, "headers": headers}
+        if trace is not None:
+            self.encode_times[req_id] = 0.0
+            head["trace"] = {**trace, "head_sent": time.time()}
+        if self.binary:
+            await self.send(protocol.pack_json_frame(req_id, protocol.RESPONSE_START, head, codec=self.codec), req_id)
+            return
+        await self.send(self.text.dumps_text({"action": "http_response_start", "id": req_id, **head}), req_id)
+
+    def _compress(self, req_id: str, data: bytes):
+        started = time.process_time()
+        packed = protocol.compress(data, self.compression)
+        elapsed = time.process_time() - started
+        if len(packed) >= len(data):
+            return None
+        for stats in (self.stats, self.request_stats.setdefault(
+                req_id, {"raw_bytes": 0, "wire_bytes": 0, "cpu_seconds": 0.0})):
+            stats["raw_bytes"] += len(data)
+            stats["wire_bytes"] += len(packed)
+            stats["cpu_seconds"] += elapsed
+        self.stats["frames"] += 1
+        return packed
+
+    async def chunk(self, req_id: str, data: bytes, decoder=None, compress: bool = False) -> None:
+        """
+        Sends one body chunk. With `compress` the chunk is compressed when that
+        pays off. Otherwise, in JSON mode, the chunk is decoded with `decoder`
+        when given (text responses) and base64-encoded if not.
+        """
+        if req_id in self.progress:
+            self.progress[req_id][0] += len(data)
+        metrics.BYTES.inc("out", amount=len(data))
+        encode_started = time.perf_counter()
+        size = len(data)
+        packed = None
+        if compress and self.compression and len(data) >= self.min_compress:
+            packed = self._compress(req_id, data)
+        if self.binary:
+            flags = protocol.COMPRESSION_FLAGS[self.compression] if packed else 0
+            message = protocol.pack_frame(req_id, protocol.RESPONSE_CHUNK, packed or data, flags)
+        elif packed:
+            message = self.text.dumps_text({
+                "action":      "http_response_chunk",
+                "id":          req_id,
+                "body":        base64.b64encode(packed).decode('ascii'),
+                "is_base64":   True,
+                "compression": self.compression
+            })
+        else:
+            if decoder:
+                body = decoder.decode(data)
+                if not body:
+                    return
+                size = len(body.encode('utf-8'))
+                is_base64 = False
+            else:
+                body = base64.b64encode(data).decode('ascii')
+                is_base64 = True
+            message = self.text.dumps_text({
+                "action":    "http_response_chunk",
+                "id":        req_id,
+                "body":      body,
+                "is_base64": is_base64
+            })
+        if req_id in self.encode_times:
+            self.encode_times[req_id] += time.perf_counter() - encode_started
+        await self.acquire(req_id, size)
+        await self.send(message, req_id)
+
+    async def end(self, req_id: str, error: str = None, decoder=None, trace: dict = None) -> None:
+        """
+        Flushes any text held back by `decoder` and ends the response. `trace`
+        holds the agent's body timings of a traced request.
+        """
+        if decoder:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                await self.acquire(req_id, len(tail.encode('utf-8')))
+                await self.send(self.text.dumps_text({
+                    "action":    "http_response_chunk",
+                    "id":        req_id,
+                    "body":      tail,
+                    "is_base64": False
+                }), req_id)
+        extra = {"error": error} if error else {}
+        self.progress.pop(req_id, None)
+        encode_time = self.encode_times.pop(req_id, None)
+        if trace is not None:
+            extra["trace"] = {**trace, "encode_ms": round((encode_time or 0) * 1000, 3)}
+        stats = self.request_stats.pop(req_id, None)
+        if stats:
+            # Lets the hub account compression ratio and agent CPU per house
+            extra["compression"] = {
+                "raw_bytes":  stats["raw_bytes"],
+                "wire_bytes": stats["wire_bytes"],
+                "cpu_ms":     round(stats["cpu_seconds"] * 1000, 3),
+            }
+        if self.binary:
+            await self.send(protocol.pack_json_frame(req_id, protocol.RESPONSE_END, extra, codec=self.codec)
+                            if extra else protocol.pack_frame(req_id, protocol.RESPONSE_END), req_id)
+        else:
+            await self.send(self.text.dumps_text({"action": "http_response_end", "id": req_id, **extra}), req_id)
+        self.priorities.pop(req_id, None)
+        if self.flow:
+            self.flow.finish(req_id)
+
+    async def cancelled(self, req_id: str) -> int:
+        """
+        Ends a response the hub cancelled, reporting how much of its body
+        (when the length was known) was never sent.
+
+        Returns:
+            int: Body bytes saved.
+        """
+        sent, length = self.progress.pop(req_id, (0, None))
+        self.request_stats.pop(req_id, None)
+        self.encode_times.pop(req_id, None)
+        saved = max(length - sent, 0) if length else 0
+        extra = {"cancelled": True, "bytes_saved": saved}
+        if self.binary:
+            await self.send(protocol.pack_json_frame(req_id, protocol.RESPONSE_END, extra, codec=self.codec), req_id)
+        else:
+            await self.send(self.text.dumps_text({"action": "http_response_end", "id": req_id, **extra}), req_id)
+        self.priorities.pop(req_id, None)
+        if self.flow:
+            self.flow.finish(req_id)
+        return saved
+
+    async def window_update(self, req_id: str, credit: int) -> None:
+        """Returns upload credit for a streamed request body to the hub."""
+        if self.binary:
+            await self.send(protocol.pack_json_frame(req_id, protocol.WINDOW_UPDATE, {"credit": credit},
+                                                     codec=self.codec))
+            return
+        await self.send(self.text.dumps_text({"action": "window_update", "id": req_id, "credit": credit}))
+
+    async def error(self, req_id: str) -> None:
+        """
+        Sends a complete 502 response for a request that failed before any
+        part of the local response was forwarded.
+        """
+        await self.start(req_id, 502, {"Content-Type": "application/json"})
+        await self.chunk(req_id, json.dumps({"error": "proxy agent error"}).encode(),
+                         codecs.getincrementaldecoder("utf-8")())
+        await self.end(req_id)
+
+
+def add_cors(headers: dict) -> dict:
+    """
+    Adds the CORS headers media players need to a response header dict.
+    """
+    headers["Access-Control-Allow-Origin"] = "*"
+    headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+    headers["Access-Control-Allow-Headers"] = "*"
+    return headers
+
+
+async def handle_request(frame: dict, ws: FrameWriter, house_id: str,
+                         session: aiohttp.ClientSession,
+                         prefetcher: SegmentPrefetcher = None) -> None:
     """
     Handles a single HTTP request forwarded from the central server,
-    proxies it to the local API, and sends back the response.
+    proxies it to the local API, and streams the response back.
+
+    The response is sent as a start frame (status and headers), followed by
+    body chunk frames as the local server produces the body, and a final end frame.
 
     Args:
         frame (dict): The HTTP request frame from the central server.
-        ws (websockets.WebSocketClientProtocol): Active WebSocket connection.
+        ws (FrameWriter): Writer for the active WebSocket connection.
         house_id (str): Unique identifier for the house/site (used in routing).
+        session (aiohttp.ClientSession): Pooled session to the local server.
+        prefetcher (SegmentPrefetcher): HLS segment prefetcher, if enabled.
+
+    A frame carrying a `trace` gets the agent's timings (connect, time to first
+    byte, body read, encode) added to it and reported in the start and end frames.
     """
     if frame.get("action") != "proxy_request":
         return
@@ -64,110 +623,575 @@ async def handle_request(frame: dict, ws: websockets.WebSocketClientProtocol, ho
     headers["X-Script-Name"] = f"/var/homes/{house_id}"
 
     body = frame.get("body", "")
+    if frame.get("is_base64"):
+        body = base64.b64decode(body)
+    if isinstance(body, (bytes, str)):
+        metrics.BYTES.inc("in", amount=len(body))
     url = f"{LOCAL_API}/{path.lstrip('/')}"
 
     # Check if the request is for media (for CORS handling)
     is_media = path.endswith(('.m3u8', '.ts', '.mp4', '.webm'))
 
+    request_started = time.perf_counter()
+    trace = frame.get("trace")
+
+    def log_request(status, sent, **fields):
+        logger.info("request", extra=kv(
+            id=req_id, method=method, path=path, status=status, bytes=sent,
+            ms=round((time.perf_counter() - request_started) * 1000, 1), **fields,
+        ))
+
+    # Serve segments prefetched after an earlier playlist request
+    use_prefetch = (prefetcher and method == "GET"
+                    and not any(k.lower() == "range" for k in headers))
+    if use_prefetch and prefetcher.is_segment(path):
+        prefetcher.advance(path)
+        hit = await prefetcher.take(path, headers)
+        if hit:
+            status, resp_headers, data = hit
+            metrics.REQUESTS.inc(method, status)
+            await ws.start(req_id, status, add_cors(dict(resp_headers)), trace=trace)
+            for i in range(0, len(data), CHUNK_SIZE):
+                await ws.chunk(req_id, data[i:i + CHUNK_SIZE])
+            await ws.end(req_id, trace={} if trace is not None else None)
+            metrics.LATENCY.observe(time.perf_counter() - request_started, "total")
+            log_request(status, len(data), prefetched=True)
+            return
+
+    started = False
+    decoder = None
+    body_read = 0.0
+    sent = 0
+    status = None
+    if trace is not None:
+        trace["connect_ms"] = 0.0
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.request(method, url, headers=headers, data=body) as resp:
-                raw_body = await resp.read()
-                content_type = resp.headers.get("Content-Type", "")
-                is_text = "text" in content_type or "json" in content_type
+        async with session.request(method, url, headers=headers, data=body,
+                                   trace_request_ctx=trace) as resp:
+            upstream = time.perf_counter() - request_started
+            metrics.LATENCY.observe(upstream, "upstream")
+            if trace is not None:
+                trace["ttfb_ms"] = round(upstream * 1000, 3)
+            metrics.REQUESTS.inc(method, resp.status)
+            status = resp.status
+            content_type = resp.headers.get("Content-Type", "")
+            is_text = "text" in content_type or "json" in content_type
+
+            # Prepare response headers
+            resp_headers = dict(resp.headers)
+            if is_media:
+                add_cors(resp_headers)
 
-                if is_media:
-                    print(f"🎬 Media request → {method} {path} [{resp.status}]")
+            await ws.start(req_id, resp.status, resp_headers, trace=trace)
+            started = True
 
+            # Compress text-like bodies; media is already compressed
+            compress = bool(ws.compression) and protocol.should_compress(content_type)
+
+            # Text bodies go out as plain strings in JSON mode; the incremental
+            # decoder keeps multi-byte characters split across chunks intact
+            if is_text and not ws.binary and not compress:
+                decoder = codecs.getincrementaldecoder("utf-8")("ignore")
+            snippet_pending = resp.status >= 400 and not is_media
+
+            # Keep playlist bodies so the segments they list can be prefetched
+            playlist = ([] if use_prefetch and resp.status == 200
+                        and prefetcher.is_playlist(path) else None)
+            playlist_size = 0
+
+            read_started = time.perf_counter()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                body_read += time.perf_counter() - read_started
                 # Log error responses (non-media only)
-                if resp.status >= 400 and not is_media:
-                    print(f"⚠️ Local error {resp.status} → {url}")
-                    snippet = raw_body[:200].decode('utf-8', 'ignore')
-                    print("⚠️ Body snippet:", snippet)
-
-                # Prepare body based on content type
-                if is_text:
-                    out_body = raw_body.decode('utf-8', 'ignore')
-                    is_base64 = False
-                else:
-                    out_body = base64.b64encode(raw_body).decode('ascii')
-                    is_base64 = True
-
-                # Prepare response headers
-                resp_headers = dict(resp.headers)
-                if is_media:
-                    resp_headers["Access-Control-Allow-Origin"] = "*"
-                    resp_headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-                    resp_headers["Access-Control-Allow-Headers"] = "*"
-
-                # Final response payload to central server
-                out = {
-                    "action":    "http_response",
-                    "id":        req_id,
-                    "status":    resp.status,
-                    "headers":   resp_headers,
-                    "body":      out_body,
-                    "is_base64": is_base64
-                }
+                if snippet_pending:
+                    logger.warning(f"⚠️ Local error {resp.status}",
+                                   extra=kv(url=url, body=logs.preview(chunk, 200)))
+                    snippet_pending = False
+                sent += len(chunk)
+
+                if playlist is not None:
+                    playlist_size += len(chunk)
+                    if playlist_size > MAX_PLAYLIST_BYTES:
+                        playlist = None
+                    else:
+                        playlist.append(chunk)
+
+                await ws.chunk(req_id, chunk, decoder, compress)
+                read_started = time.perf_counter()
+            body_read += time.perf_counter() - read_started
 
+        await ws.end(req_id, decoder=decoder, trace=(
+            {"body_read_ms": round(body_read * 1000, 3)} if trace is not None else None))
+        metrics.LATENCY.observe(time.perf_counter() - request_started, "total")
+        log_request(status, sent)
+
+        if playlist:
+            prefetcher.observe_playlist(path, b"".join(playlist).decode('utf-8', 'ignore'), headers)
+
+    except websockets.ConnectionClosed:
+        raise
     except Exception:
-        print("🚨 Exception in handle_request:")
-        traceback.print_exc()
-        out = {
-            "action":    "http_response",
-            "id":        req_id,
-            "status":    502,
-            "headers":   {"Content-Type": "application/json"},
-            "body":      json.dumps({"error": "proxy agent error"}),
-            "is_base64": False
-        }
+        metrics.ERRORS.inc()
+        logger.exception("🚨 Exception in handle_request", extra=kv(id=req_id, method=method, path=path))
+        log_request(status or 502, sent, error=True)
+        if started:
+            # Headers already went out; terminate the stream so the hub
+            # does not wait for the rest of a body that will never come
+            await ws.end(req_id, error="proxy agent error")
+        else:
+            await ws.error(req_id)
 
-    # Send the response frame back over WebSocket
-    await ws.send(json.dumps(out))
 
+def priority_of(frame: dict) -> str:
+    """
+    Priority class of a `proxy_request` frame: the hub's "priority" field
+    when set, otherwise "bulk" for media files and range requests and
+    "interactive" for everything else.
+    """
+    if frame.get("priority") in PRIORITY_WEIGHTS:
+        return frame["priority"]
+    headers = {k.lower() for k in frame.get("headers") or {}}
+    path = frame.get("path", "").split("?", 1)[0].lower()
+    return "bulk" if path.endswith(BULK_SUFFIXES) or "range" in headers else "interactive"
 
-async def run() -> None:
+
+class SlotScheduler:
     """
-    Main loop: Connects to the central WebSocket, authenticates,
-    listens for incoming HTTP request frames, and proxies them locally.
+    Upstream concurrency slots handed out by priority class.
+
+    When a slot frees up and several classes wait, it goes to the class with
+    the least service so far relative to its weight (weighted fair queuing
+    over slot grants), and bulk requests never hold more than `bulk_share`
+    of the slots. A class that was idle resumes at the level of the others
+    instead of cashing in the time it did not use.
+
+    Attributes:
+        slots (int): Requests talking to the local server at once.
+        weights (dict): Priority class → weight.
+        bulk_limit (int): Slots bulk requests may hold at once.
+        busy (dict): Priority class → slots held.
+        waiting (dict): Priority class → futures of waiting requests, in order.
+        served (dict): Priority class → slot grants divided by weight.
     """
-    cfg = load()
-    if not cfg.get("house_id"):
-        print("❌ Please run `agent/register.py` first to register.")
-        return
 
+    def __init__(self, slots: int = MAX_CONCURRENCY, weights: dict = PRIORITY_WEIGHTS,
+                 bulk_share: float = BULK_SLOT_SHARE):
+        self.slots = slots
+        self.weights = weights
+        self.bulk_limit = max(1, int(slots * bulk_share))
+        self.busy = {cls: 0 for cls in weights}
+        self.waiting = {cls: collections.deque() for cls in weights}
+        self.served = {cls: 0.0 for cls in weights}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cls: str = "interactive"):
+        """Holds one slot of class `cls` for the duration of the block."""
+        await self._take(cls)
+        try:
+            yield
+        finally:
+            self._release(cls)
+
+    def _eligible(self, cls: str) -> bool:
+        return cls != "bulk" or self.busy[cls] < self.bulk_limit
+
+    async def _take(self, cls: str) -> None:
+        turn = asyncio.get_running_loop().create_future()
+        self.waiting[cls].append(turn)
+        self._dispatch()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                self._release(cls)  # Granted as we were cancelled; give it back
+            else:
+                self.waiting[cls].remove(turn)
+            raise
+
+    def _grant(self, cls: str) -> None:
+        active = [self.served[c] for c in self.weights if c != cls and (self.busy[c] or self.waiting[c])]
+        if not self.busy[cls] and not self.waiting[cls] and active:
+            self.served[cls] = max(self.served[cls], min(active))
+        self.busy[cls] += 1
+        self.served[cls] += 1 / self.weights.get(cls, 1)
+
+    def _release(self, cls: str) -> None:
+        self.busy[cls] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while sum(self.busy.values()) < self.slots:
+            ready = [c for c in self.weights if self.waiting[c] and self._eligible(c)]
+            if not ready:
+                return
+            cls = min(ready, key=lambda c: self.served[c] + 1 / self.weights.get(c, 1))
+            turn = self.waiting[cls].popleft()
+            self._grant(cls)
+            turn.set_result(None)
+
+
+class Dispatcher:
+    """
+    Runs each `proxy_request` frame as its own task so a slow local request
+    does not hold up the others on the same tunnel.
+
+    Requests whose body is streamed (`body_stream`) get an async body fed by
+    the `request_body_chunk` / `request_body_end` frames that follow them, so
+    the upload to the local server starts before the whole body has arrived.
+
+    A `cancel` frame (the client went away or timed out on the hub) cancels
+    the request's task, which aborts the local request and any chunks still
+    waiting to go out.
+
+    At most `max_concurrency` requests talk to the local server at once; the
+    rest wait for a slot, handed out by priority class (see SlotScheduler)
+    so API calls do not queue behind media downloads. In-flight tasks are tracked by request id so they
+    can be cancelled when the tunnel goes away.
+
+    Attributes:
+        writer (FrameWriter): Writer for the active WebSocket connection.
+        house_id (str): Unique identifier for the house/site.
+        session (aiohttp.ClientSession): Pooled session to the local server.
+        prefetcher (SegmentPrefetcher): HLS segment prefetcher, if enabled.
+        limit (SlotScheduler): Upstream concurrency slots, possibly shared by
+            the connections of a pool.
+        in_flight (dict): Request id → running task.
+        bodies (dict): Request id → queue of streamed request body chunks.
+        stats (dict): Requests cancelled by the hub and response bytes saved.
+    """
+
+    def __init__(self, writer: FrameWriter, house_id: str, session: aiohttp.ClientSession,
+                 max_concurrency: int = MAX_CONCURRENCY, prefetcher: SegmentPrefetcher = None,
+                 limit: SlotScheduler = None):
+        self.writer = writer
+        self.house_id = house_id
+        self.session = session
+        self.prefetcher = prefetcher
+        self.limit = limit or SlotScheduler(max_concurrency, writer.weights)
+        self.in_flight = {}
+        self.bodies = {}
+        self.cancelling = set()
+        self.stats = {"cancelled": 0, "bytes_saved": 0}
+
+    def dispatch(self, frame: dict) -> None:
+        """
+        Starts a task for a `proxy_request` frame and routes request body
+        frames to it; other frames are ignored.
+        """
+        action = frame.get("action")
+        req_id = frame.get("id")
+        if action == "request_body_chunk":
+            queue = self.bodies.get(req_id)
+            if queue:
+                body = frame.get("body", b"")
+                queue.put_nowait(base64.b64decode(body) if frame.get("is_base64") else body)
+            return
+        if action == "request_body_end":
+            queue = self.bodies.pop(req_id, None)
+            if queue:
+                queue.put_nowait(None)
+            return
+        if action == "window_update":
+            if self.writer.flow:
+                self.writer.flow.credit(req_id, frame.get("credit", 0), frame.get("close", False))
+            return
+        if action == "cancel":
+            self.cancel(req_id)
+            return
+        if action != "proxy_request":
+            return
+        if "trace" in frame:
+            frame = {**frame, "trace": {**frame["trace"], "received": time.time()}}
+        self.writer.priorities[req_id] = priority_of(frame)
+        if frame.get("body_stream"):
+            self.bodies[req_id] = asyncio.Queue()
+            frame = {**frame, "body": self._request_body(req_id, self.bodies[req_id])}
+        task = asyncio.create_task(self._run(frame))
+        self.in_flight[req_id] = task
+        task.add_done_callback(lambda _, rid=req_id: self._finished(rid))
+
+    def cancel(self, req_id: str) -> None:
+        """Aborts a request the hub no longer waits for."""
+        self.bodies.pop(req_id, None)
+        if self.writer.flow:
+            self.writer.flow.credit(req_id, 0, close=True)
+        task = self.in_flight.get(req_id)
+        if task and not task.done():
+            self.cancelling.add(req_id)
+            task.cancel()
+
+    def _finished(self, req_id: str) -> None:
+        self.in_flight.pop(req_id, None)
+        self.bodies.pop(req_id, None)
+        self.cancelling.discard(req_id)
+        self.writer.priorities.pop(req_id, None)
+
+    async def _request_body(self, req_id: str, queue: asyncio.Queue):
+        # With flow control the hub sends at most a window of body bytes
+        # ahead; credit goes back as the local server reads them
+        window = self.writer.flow.stream_window if self.writer.flow else 0
+        consumed = 0
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            metrics.BYTES.inc("in", amount=len(chunk))
+            yield chunk
+            consumed += len(chunk)
+            if window and consumed >= window // 2:
+                await self.writer.window_update(req_id, consumed)
+                consumed = 0
+
+    async def _run(self, frame: dict) -> None:
+        req_id = frame["id"]
+        metrics.IN_FLIGHT.inc()
+        queued = time.perf_counter()
+        try:
+            async with self.limit.slot(self.writer.priorities.get(req_id, "interactive")):
+                if "trace" in frame:
+                    frame["trace"]["queue_ms"] = round((time.perf_counter() - queued) * 1000, 3)
+                await handle_request(frame, self.writer, self.house_id, self.session, self.prefetcher)
+        except websockets.ConnectionClosed:
+            pass  # The receive loop notices the closed tunnel and reconnects
+        except asyncio.CancelledError:
+            if req_id not in self.cancelling:
+                raise  # The tunnel is going away
+            logger.info("🛑 Cancelled by hub",
+                        extra=kv(id=req_id, method=frame.get("method"), path=frame.get("path")))
+            self.stats["cancelled"] += 1
+            metrics.CANCELLED.inc()
+            try:
+                saved = await self.writer.cancelled(req_id)
+            except websockets.ConnectionClosed:
+                return
+            self.stats["bytes_saved"] += saved
+            metrics.BYTES_SAVED.inc(amount=saved)
+        finally:
+            metrics.IN_FLIGHT.dec()
+
+    async def close(self) -> None:
+        """Cancels every in-flight request and waits for them to finish."""
+        tasks = list(self.in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def heartbeat(ws: websockets.WebSocketClientProtocol, writer: FrameWriter,
+                    interval: float, last_pong: dict) -> None:
+    """
+    Pings the hub every `interval` seconds, which keeps the house's presence
+    and last_seen fresh, and closes the tunnel when HEARTBEAT_MISSES pongs in
+    a row did not come back (`last_pong["at"]`, updated by the receive loop).
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if time.monotonic() - last_pong["at"] > interval * HEARTBEAT_MISSES:
+            logger.warning("💔 No pong from hub → reconnecting")
+            await ws.close()
+            return
+        await writer.send(writer.text.dumps_text({"action": "ping", "ts": time.time()}))
+
+
+def agent_collector(prefetcher: SegmentPrefetcher, current: dict):
+    """
+    Returns a metrics collector for the prefetch cache and the flow control
+    state of the live tunnel connections (`current`: index → FrameWriter).
+    """
+    def collect():
+        if prefetcher:
+            info = prefetcher.info()
+            for key in ("hits", "misses", "prefetched", "evictions"):
+                yield (f"agent_prefetch_{key}_total", "counter", f"Segment prefetch {key}.", [({}, info[key])])
+            yield ("agent_prefetch_bytes", "gauge", "Bytes held by the segment prefetch cache.",
+                   [({}, info["bytes"])])
+        yield ("agent_tunnel_connections", "gauge", "Live tunnel connections.", [({}, len(current))])
+        yield ("agent_flow_outstanding_bytes", "gauge",
+               "Response bytes sent and not yet credited by the hub.",
+               [({"connection": index}, writer.flow.total)
+                for index, writer in list(current.items()) if writer.flow])
+    return collect
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Serves the agent's Prometheus metrics at http://host:port/metrics.
+    """
+    async def handler(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Metrics at http://{host}:{port}/metrics")
+    return runner
+
+
+async def tunnel(index: int, lane: str, cfg: dict, session: aiohttp.ClientSession,
+                 prefetcher: SegmentPrefetcher, limit: SlotScheduler, current: dict,
+                 negotiated: asyncio.Future = None) -> None:
+    """
+    Keeps one tunnel connection of the pool up: connects to the central
+    WebSocket, authenticates, listens for incoming HTTP request frames and
+    proxies them locally, reconnecting with backoff when the connection drops
+    or the hub closes it (see keep_connected).
+
+    Args:
+        index (int): Position in the pool; connection 0 is the house's primary.
+        lane (str): "interactive", "bulk", or None when the pool has one connection.
+        cfg (dict): Agent configuration (arhouse.json).
+        session (aiohttp.ClientSession): Pooled session to the local server.
+        prefetcher (SegmentPrefetcher): HLS segment prefetcher, if enabled.
+        limit (SlotScheduler): Upstream concurrency slots shared by the pool.
+        current (dict): Connection index → FrameWriter of the live connection.
+        negotiated (asyncio.Future): Set to the hub's "max_connections" (1 for
+            hubs that predate connection pools) on the first authentication.
+    """
     hid, sk = cfg["house_id"], cfg["secret_key"]
+    compression = [m for m in cfg.get("compression", protocol.SUPPORTED_COMPRESSION)
+                   if m in protocol.SUPPORTED_COMPRESSION]
+    min_compress = cfg.get("compress_min_bytes", COMPRESS_MIN_BYTES)
+    offered_codecs = [c for c in cfg.get("codecs", protocol.SUPPORTED_CODECS) if c in protocol.CODECS]
     auth_hash = hashlib.sha256((hid + sk).encode()).hexdigest()
+    backoff = Backoff(cfg.get("reconnect_base", RECONNECT_BASE), cfg.get("reconnect_max", RECONNECT_MAX))
 
-    while True:
-        try:
-            async with websockets.connect(CENTRAL_WS) as ws:
-                # Send authentication frame
-                await ws.send(json.dumps({
-                    "action":    "authenticate",
-                    "house_id":  hid,
-                    "auth_hash": auth_hash
-                }))
-                print("🔌 Tunnel connected as", hid)
-
-                # Set environment variable for Django routing
-                os.environ["DJANGO_SCRIPT_NAME"] = f"/var/homes/{hid}"
-                print(f"🌐 Set DJANGO_SCRIPT_NAME = /var/homes/{hid}")
-
-                # Main loop to receive and process messages
+    async def connect(connected):
+        # Per-frame compression replaces permessage-deflate, which would
+        # also spend CPU on already-compressed media
+        async with websockets.connect(CENTRAL_WS, compression=None if compression else "deflate") as ws:
+            # Send authentication frame
+            await ws.send(json.dumps({
+                "action":      "authenticate",
+                "house_id":    hid,
+                "auth_hash":   auth_hash,
+                "framing":     list(protocol.SUPPORTED_FRAMING),
+                "compression": compression,
+                "codecs":      offered_codecs,
+                "request_streaming": True,
+                "flow_control":      True,
+                "cancel":            True,
+                "heartbeat":         True,
+                "connection":        index,
+                "lane":              lane
+            }))
+            # Hubs that predate binary framing or compression reply without those keys
+            reply = json.loads(await ws.recv())
+            if reply.get("status") == "busy":
+                raise HubBusy(reply.get("retry_after"))
+            connected()
+            if negotiated and not negotiated.done():
+                negotiated.set_result(reply.get("max_connections", 1))
+            flow = reply.get("flow_control")
+            if flow:
+                flow = FlowControl(flow["stream_window"], flow["tunnel_window"])
+            writer = FrameWriter(ws, reply.get("framing", protocol.FRAMING_JSON),
+                                 reply.get("compression"), min_compress, flow, limit.weights,
+                                 protocol.get_codec(reply.get("codec")))
+            current[index] = writer
+            metrics.CONNECTS.inc()
+            logger.info(f"🔌 Tunnel connected as {hid}", extra=kv(
+                connection=index, lane=lane, framing="binary" if writer.binary else "json",
+                codec=writer.codec.name, compression=writer.compression, flow_control=bool(flow)))
+
+            # Set environment variable for Django routing
+            os.environ["DJANGO_SCRIPT_NAME"] = f"/var/homes/{hid}"
+
+            # Main loop to receive messages; requests run concurrently
+            dispatcher = Dispatcher(writer, hid, session, prefetcher=prefetcher, limit=limit)
+            last_pong = {"at": time.monotonic()}
+            pinger = None
+            if reply.get("heartbeat"):
+                pinger = asyncio.create_task(heartbeat(ws, writer, reply["heartbeat"], last_pong))
+            try:
                 async for msg in ws:
-                    print("📥 Received from central:", msg)
-                    frame = json.loads(msg)
+                    if isinstance(msg, bytes):
+                        # Binary frames carry streamed request bodies and,
+                        # with a binary codec, the requests themselves
+                        try:
+                            frame = protocol.frame_to_dict(msg, writer.codec)
+                        except ValueError as exc:
+                            # Like the hub: drop the frame, keep the tunnel
+                            logger.warning("⚠️ Dropping malformed binary frame", extra=kv(
+                                connection=index, error=repr(exc)))
+                            continue
+                        if frame.get("action") != "proxy_request":
+                            dispatcher.dispatch(frame)
+                            continue
+                    else:
+                        frame = writer.text.loads(msg)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("📥 Received from central", extra=kv(frame=summarize(frame)))
 
                     # Flatten nested frame if wrapped in 'type: forward.http'
                     if "type" in frame and frame["type"] == "forward.http" and "frame" in frame:
                         frame = frame["frame"]
 
-                    await handle_request(frame, ws, hid)
+                    if frame.get("action") == "pong":
+                        last_pong["at"] = time.monotonic()
+                        if frame.get("ts"):
+                            metrics.HEARTBEAT_RTT.observe(time.time() - frame["ts"])
+                        continue
+                    dispatcher.dispatch(frame)
+            finally:
+                current.pop(index, None)
+                if pinger:
+                    pinger.cancel()
+                await dispatcher.close()
 
-        except Exception as exc:
-            print("❗ Tunnel error:", exc, "→ retrying in 5s…")
-            await asyncio.sleep(5)
+    await keep_connected(connect, backoff, cfg.get("reconnect_stable", RECONNECT_STABLE), connection=index)
+
+
+async def run() -> None:
+    """
+    Main loop: keeps a pool of `tunnel_connections` tunnel connections to the
+    central server up, sharing one local session and `max_concurrency`
+    upstream slots. With more than one connection the last
+    `bulk_connections` carry media transfers, so a large download does not
+    hold up API responses queued behind it on the same TCP stream.
+    """
+    cfg = load()
+    logs.setup(cfg)
+    if not cfg.get("house_id"):
+        logger.error("❌ Please run `agent/register.py` first to register.")
+        return
+    logger.info(f"🌐 Local API base: {LOCAL_API}")
+
+    connections = max(1, cfg.get("tunnel_connections", TUNNEL_CONNECTIONS))
+    bulk = min(cfg.get("bulk_connections", BULK_CONNECTIONS), connections - 1)
+    limit = SlotScheduler(cfg.get("max_concurrency", MAX_CONCURRENCY),
+                          {**PRIORITY_WEIGHTS, **cfg.get("priority_weights", {})},
+                          cfg.get("bulk_slot_share", BULK_SLOT_SHARE))
+
+    # One pooled session to the local server for the agent's lifetime
+    session = create_session(cfg)
+    prefetcher = create_prefetcher(cfg, session)
+    current = {}
+    metrics.register_collector(agent_collector(prefetcher, current))
+    metrics_server = None
+    if cfg.get("metrics_port"):
+        metrics_server = await start_metrics_server(cfg.get("metrics_host", METRICS_HOST), cfg["metrics_port"])
+
+    # The primary connection goes first; the rest of the pool only once the
+    # hub said it takes more than one connection per house
+    negotiated = asyncio.get_running_loop().create_future()
+    tunnels = [asyncio.create_task(tunnel(
+        0, "interactive" if connections > 1 else None, cfg, session, prefetcher, limit, current, negotiated))]
+    try:
+        connections = min(connections, await negotiated)
+        bulk = min(bulk, connections - 1)
+        for index in range(1, connections):
+            lane = "bulk" if index >= connections - bulk else "interactive"
+            tunnels.append(asyncio.create_task(tunnel(index, lane, cfg, session, prefetcher, limit, current)))
+        await asyncio.gather(*tunnels)
+    finally:
+        for task in tunnels:
+            task.cancel()
+        await asyncio.gather(*tunnels, return_exceptions=True)
+        if metrics_server:
+            await metrics_server.cleanup()
+        await session.close()
 
 # Entrypoint
 if __name__ == "__main__":
@@ -1,7 +1,12 @@
 """
 ASGI config for hub project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``:
+
+* websocket /ws/tunnel/ goes to TunnelConsumer (tunnel/routing.py),
+* HTTP /homes/<house_id>/... goes straight to the proxy, skipping Django's
+  middleware (tunnel/asgi.py),
+* every other HTTP request goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -13,4 +18,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hub.settings')
 
-application = get_asgi_application()
+# Sets up Django before the tunnel modules import models and settings
+django_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from tunnel.asgi import ProxyRouter  # noqa: E402
+from tunnel.routing import websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    "http": ProxyRouter(django_application),
+    "websocket": URLRouter(websocket_urlpatterns),
+})
@@ -71,6 +71,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'hub.wsgi.application'
+ASGI_APPLICATION = 'hub.asgi.application'
 
 
 # Database
@@ -92,6 +93,101 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Hand frames straight to the TunnelConsumer when this worker holds the
+# house's websocket, instead of going through the channel layer
+TUNNEL_LOCAL_FASTPATH = True
+
+# Serve /homes/<house_id>/... from a pure-ASGI route in hub/asgi.py, skipping
+# Django's middleware and request construction (see tunnel/asgi.py)
+TUNNEL_ASGI_PROXY = True
+
+# Presence ("is this house online") cache used by proxy_to_home. Set
+# TUNNEL_PRESENCE_CACHE to a CACHES alias backed by Redis to share it
+# between workers; None keeps it per process.
+TUNNEL_PRESENCE_TTL = 30
+TUNNEL_PRESENCE_OFFLINE_TTL = 2
+TUNNEL_PRESENCE_CACHE = None
+
+# Seconds between bulk writes of HouseTunnel.connected/last_seen; updates
+# from authentications, disconnects and heartbeats are buffered until then
+TUNNEL_PRESENCE_FLUSH_INTERVAL = 1
+
+# Seconds between heartbeat pings from agents; each refreshes last_seen
+TUNNEL_HEARTBEAT_INTERVAL = 30
+
+# Tunnel connections an agent may open per house. Agents keep a pool and
+# split it into interactive and bulk (media) lanes; the hub sends each
+# request to the least loaded connection of its lane.
+TUNNEL_MAX_CONNECTIONS = 4
+
+# Hub-side response cache for HLS segments, playlists and static assets
+# (see tunnel/cache.py for every key and its default)
+TUNNEL_CACHE = {
+    "MAX_BYTES": 64 * 1024 * 1024,
+    "PLAYLIST_TTL": 1,
+    "SPILL_DIR": None,
+}
+
+# Single-flight coalescing of identical concurrent GETs per house
+# (see tunnel/coalesce.py for every key and its default)
+TUNNEL_COALESCE = {
+    "PATHS": [r".*"],
+    "KEY_HEADERS": ["accept", "accept-encoding", "accept-language"],
+}
+
+# Credit-based flow control on the tunnel, in body bytes. Each request may
+# have STREAM_WINDOW bytes in flight in either direction that the other side
+# has not consumed yet, and all responses of one tunnel TUNNEL_WINDOW
+# together. Set to None to disable.
+TUNNEL_FLOW_CONTROL = {
+    "STREAM_WINDOW": 256 * 1024,
+    "TUNNEL_WINDOW": 2 * 1024 * 1024,
+}
+
+# Admission control for tunnel authentications, per hub process. After a
+# restart every agent reconnects at once; authentications beyond
+# MAX_CONCURRENT are turned away at once with a retry_after hint between
+# RETRY_AFTER and twice that many seconds, spreading the retries out.
+TUNNEL_AUTH = {
+    "MAX_CONCURRENT": 32,
+    "RETRY_AFTER": 2,
+}
+
+# Admission limits for proxied requests, per hub process (see tunnel/limits.py
+# for every key and its default). Requests over a house's token bucket,
+# in-flight or queued body byte cap get a 429, over a global one a 503, both
+# with Retry-After. None disables a limit.
+TUNNEL_LIMITS = {
+    "HOUSE_RATE": 1000,
+    "HOUSE_BURST": 2000,
+    "HOUSE_MAX_IN_FLIGHT": 256,
+    "GLOBAL_MAX_IN_FLIGHT": 10000,
+}
+
+# Serve Prometheus metrics at /metrics to staff users and to scrapers sending
+# "Authorization: Bearer <TUNNEL_METRICS_TOKEN>" (house ids are metric labels)
+TUNNEL_METRICS = True
+TUNNEL_METRICS_TOKEN = None
+
+# Per-request timing breakdown across hub, channel layer, websocket and agent.
+# Sampled traces are kept in memory and listed at /api/admin/traces/;
+# SERVER_TIMING adds the breakdown to every proxied response as a header.
+TUNNEL_TRACING = {
+    "SAMPLE_RATE": 0.01,
+    "BUFFER_SIZE": 1000,
+    "SERVER_TIMING": False,
+}
+
+# Tunnel logging: one summary line per request at INFO; per-frame DEBUG lines
+# are sampled and rate limited. Records are written by a background thread
+# and dropped rather than waited on when it falls behind.
+TUNNEL_LOGGING = {
+    "LEVEL": "INFO",
+    "FORMAT": "text",            # or "json"
+    "DEBUG_SAMPLE_RATE": 0.01,
+    "DEBUG_RATE_LIMIT": 50,      # DEBUG lines per second at most
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
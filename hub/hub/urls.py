@@ -15,10 +15,16 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, re_path
-from tunnel.views import proxy_to_home
+from tunnel.views import proxy_to_home, metrics_view
+from tunnel.views import cache_stats, compression_stats, cancel_stats, traces
 
 
 urlpatterns = [
     re_path(r'^homes/(?P<house_id>[A-Z0-9]{6})/(?P<path>.*)$', proxy_to_home),
+    path('metrics', metrics_view),
+    path("api/admin/cache_stats/", cache_stats, name="cache_stats"),
+    path("api/admin/compression_stats/", compression_stats, name="compression_stats"),
+    path("api/admin/cancel_stats/", cancel_stats, name="cancel_stats"),
+    path("api/admin/traces/", traces, name="traces"),
     path('admin/', admin.site.urls),
 ]
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TunnelConfig(AppConfig):
     name = 'tunnel'
+
+    def ready(self):
+        from . import logs
+        logs.setup()
@@ -0,0 +1,160 @@
+"""
+Pure-ASGI route for proxied traffic.
+
+ProxyRouter sends HTTP requests for /homes/<house_id>/... straight to
+proxy_to_home, without Django's request construction, URL resolution and
+middleware stack (sessions, CSRF, auth, messages, clickjacking), none of
+which the proxy uses. Everything else goes to the Django application.
+
+The request body streams from the ASGI receive channel to the tunnel as it
+arrives (unless it is small and its size known up front), and the response
+body streams back to the client as the agent sends it. A client that
+disconnects cancels the request, which tells the agent to stop; mid-upload,
+the agent never sees the body end.
+
+TUNNEL_ASGI_PROXY = False sends /homes/ through Django as well.
+"""
+import asyncio
+import re
+from contextlib import aclosing
+from django.conf import settings
+from django.core.exceptions import RequestAborted
+from django.utils.datastructures import CaseInsensitiveMapping
+from .utils import BODY_CHUNK_SIZE
+from .views import proxy_to_home
+
+HOMES = re.compile(r"^/homes/(?P<house_id>[A-Z0-9]{6})/(?P<path>.*)$")
+
+
+class ProxyRequest:
+    """
+    The parts of a Django request proxy_to_home reads, built from an ASGI
+    scope. The Cookie header is forwarded as sent, so COOKIES stays empty.
+    """
+    COOKIES = {}
+
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        headers = {}
+        for name, value in scope["headers"]:
+            name, value = name.decode("latin1").title(), value.decode("latin1")
+            headers[name] = f"{headers[name]},{value}" if name in headers else value
+        self.headers = CaseInsensitiveMapping(headers)
+        self.META = {"CONTENT_LENGTH": headers.get("Content-Length", "")}
+        self.receive = receive
+        self.body = b""
+        self.streams_body = False  # proxy_to_home must stream it (see body_chunks)
+        self.received = b""        # read by read_body, not yet streamed
+        self.body_done = asyncio.Event()
+        self.gone = False
+
+    async def _message(self):
+        message = await self.receive()
+        if message["type"] == "http.disconnect":
+            self.gone = True
+            self.body_done.set()
+            raise RequestAborted()
+        if not message.get("more_body"):
+            self.body_done.set()
+        return message.get("body", b"")
+
+    async def read_body(self):
+        """
+        Reads the body into 'body' when it is known to be small: a
+        Content-Length of at most BODY_CHUNK_SIZE, or no Content-Length and
+        a single small message. Anything else (chunked uploads, HTTP/2
+        without a length) is left for proxy_to_home to stream.
+        """
+        length = self.META["CONTENT_LENGTH"]
+        if length:
+            if length.isdigit() and int(length) <= BODY_CHUNK_SIZE:
+                parts = []
+                while not self.body_done.is_set():
+                    parts.append(await self._message())
+                self.body = b"".join(parts)
+            return
+        first = await self._message()
+        if self.body_done.is_set() and len(first) <= BODY_CHUNK_SIZE:
+            self.body = first
+        else:
+            self.received, self.streams_body = first, True
+
+    async def body_chunks(self):
+        """
+        Yields the body in pieces of at most BODY_CHUNK_SIZE as the client
+        sends it. Raises RequestAborted if the client goes away first.
+        """
+        data, self.received = self.received, b""
+        while True:
+            for start in range(0, len(data), BODY_CHUNK_SIZE):
+                yield data[start:start + BODY_CHUNK_SIZE]
+            if self.body_done.is_set():
+                return
+            data = await self._message()
+
+    async def disconnected(self):
+        """
+        Returns once the client has gone away.
+        """
+        await self.body_done.wait()
+        while not self.gone:
+            try:
+                await self._message()
+            except RequestAborted:
+                return
+
+
+async def send_response(response, send):
+    """
+    Sends a Django response over ASGI, streaming a streaming one.
+    """
+    headers = [(k.encode("latin1"), v.encode("latin1")) for k, v in response.items()]
+    for cookie in response.cookies.values():
+        headers.append((b"Set-Cookie", cookie.output(header="").encode("ascii").strip()))
+    await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+    if not response.streaming:
+        await send({"type": "http.response.body", "body": response.content})
+        return
+    async with aclosing(aiter(response)) as content:
+        async for chunk in content:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body"})
+
+
+async def proxy(scope, receive, send, house_id, path):
+    request = ProxyRequest(scope, receive)
+
+    async def respond():
+        await request.read_body()
+        await send_response(await proxy_to_home(request, house_id, path), send)
+
+    # Like Django's handler: a client that goes away cancels the request
+    task = asyncio.create_task(respond())
+    watcher = asyncio.create_task(request.disconnected())
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        task.cancel()
+        watcher.cancel()
+        await asyncio.gather(task, watcher, return_exceptions=True)
+    if task.done() and not task.cancelled() and task.exception():
+        if not isinstance(task.exception(), RequestAborted):
+            raise task.exception()
+
+
+class ProxyRouter:
+    """
+    HTTP router: /homes/<house_id>/... to the proxy, the rest to 'application'.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.enabled = getattr(settings, "TUNNEL_ASGI_PROXY", True)
+
+    async def __call__(self, scope, receive, send):
+        if self.enabled and scope["type"] == "http":
+            path, root = scope["path"], scope.get("root_path", "")
+            match = HOMES.match(path[len(root):] if root and path.startswith(root) else path)
+            if match:
+                return await proxy(scope, receive, send, match["house_id"], match["path"])
+        return await self.application(scope, receive, send)
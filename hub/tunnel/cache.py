@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "MAX_BYTES": 64 * 1024 * 1024,        # in-memory budget
+    "MAX_ENTRY_BYTES": 8 * 1024 * 1024,   # larger bodies are never cached
+    "PLAYLIST_TTL": 1,                    # cap for .m3u8 playlists, which change constantly
+    "SEGMENT_TTL": 30,                    # heuristic TTL for media segments sent without freshness headers
+    "IGNORE_COOKIES": False,              # share responses to requests carrying cookies
+    "SPILL_DIR": None,                    # directory for entries evicted from memory
+    "SPILL_MAX_BYTES": 512 * 1024 * 1024,
+}
+
+PLAYLIST_SUFFIXES = ('.m3u8',)
+SEGMENT_SUFFIXES = ('.ts', '.m4s', '.aac', '.vtt')
+
+
+class CachedResponse:
+    def __init__(self, status, headers, body, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body        # bytes, or None once spilled to disk
+        self.path = None        # file holding the body once spilled
+        self.size = len(body)
+        self.expires = expires
+
+    async def read(self):
+        if self.body is not None:
+            return self.body
+        return await asyncio.to_thread(_read_file, self.path)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def freshness(path, headers, config):
+    """
+    Returns how many seconds a response may be served from cache, or 0 when
+    it must not be cached.
+    """
+    lower = {k.lower(): v for k, v in headers.items()}
+    if "set-cookie" in lower:
+        return 0
+    directives = {}
+    for part in lower.get("cache-control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    if {"no-store", "no-cache", "private"} & directives.keys():
+        return 0
+
+    ttl = None
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                ttl = int(directives[name])
+            except ValueError:
+                return 0
+            break
+    if ttl is None and "expires" in lower:
+        try:
+            ttl = parsedate_to_datetime(lower["expires"]).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0
+    if path.endswith(PLAYLIST_SUFFIXES):
+        ttl = min(ttl, config["PLAYLIST_TTL"]) if ttl is not None else config["PLAYLIST_TTL"]
+    elif ttl is None and path.endswith(SEGMENT_SUFFIXES):
+        ttl = config["SEGMENT_TTL"]
+    return max(ttl or 0, 0)
+
+
+class ResponseCache:
+    """
+    LRU cache of complete proxied responses, keyed by house id + method +
+    path + the request headers named in the response's Vary header.
+
+    Entries are kept in memory up to MAX_BYTES; least recently used entries
+    are evicted, or moved to SPILL_DIR when one is configured.
+    """
+
+    def __init__(self, **config):
+        self.config = {**DEFAULTS, **config}
+        self.entries = OrderedDict()   # key → CachedResponse held in memory
+        self.spilled = OrderedDict()   # key → CachedResponse held on disk
+        self.vary = {}                 # (house, method, path) → Vary header names
+        self.bytes = 0
+        self.spilled_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "spills": 0}
+        if self.config["SPILL_DIR"]:
+            os.makedirs(self.config["SPILL_DIR"], exist_ok=True)
+
+    def cacheable_request(self, method, headers):
+        if not self.config["ENABLED"] or method not in ("GET", "HEAD"):
+            return False
+        lower = {k.lower() for k in headers}
+        if "range" in lower or "authorization" in lower:
+            return False
+        if "cookie" in lower and not self.config["IGNORE_COOKIES"]:
+            return False
+        return True
+
+    def key(self, house_id, method, path, headers):
+        base = (house_id, method, path)
+        lower = {k.lower(): v for k, v in headers.items()}
+        return base + tuple(lower.get(name, "") for name in self.vary.get(base, ()))
+
+    async def get(self, house_id, method, path, headers):
+        """
+        Returns a fresh CachedResponse for the request, or None.
+        """
+        key = self.key(house_id, method, path, headers)
+        for store in (self.entries, self.spilled):
+            entry = store.get(key)
+            if entry is None:
+                continue
+            if entry.expires <= time.monotonic():
+                self._drop(key)
+                break
+            store.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        return None
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.bytes -= entry.size
+        entry = self.spilled.pop(key, None)
+        if entry:
+            self.spilled_bytes -= entry.size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def store(self, house_id, method, path, request_headers, status, headers, body):
+        """
+        Caches a complete response if its status and headers allow it.
+        """
+        ttl = freshness(path, headers, self.config)
+        if status != 200 or not ttl or len(body) > self.config["MAX_ENTRY_BYTES"]:
+            return
+        vary = next((v for k, v in headers.items() if k.lower() == "vary"), "")
+        if vary.strip() == "*":
+            return
+        base = (house_id, method, path)
+        self.vary[base] = tuple(sorted(v.strip().lower() for v in vary.split(",") if v.strip()))
+        key = self.key(house_id, method, path, request_headers)
+
+        self._drop(key)
+        self.entries[key] = CachedResponse(status, headers, body, time.monotonic() + ttl)
+        self.bytes += len(body)
+        self.stats["stores"] += 1
+        while self.bytes > self.config["MAX_BYTES"] and self.entries:
+            self._evict()
+
+    def _evict(self):
+        key, entry = self.entries.popitem(last=False)
+        self.bytes -= entry.size
+        self.stats["evictions"] += 1
+        spill_dir = self.config["SPILL_DIR"]
+        if not spill_dir or entry.expires <= time.monotonic():
+            return
+        entry.path = os.path.join(spill_dir, hashlib.sha256(repr(key).encode()).hexdigest())
+        try:
+            _write_file(entry.path, entry.body)
+        except OSError as exc:
+            logger.warning("⚠️ Cache spill failed: %s", exc)
+            return
+        entry.body = None
+        self.spilled[key] = entry
+        self.spilled_bytes += entry.size
+        self.stats["spills"] += 1
+        while self.spilled_bytes > self.config["SPILL_MAX_BYTES"] and self.spilled:
+            self._drop(next(iter(self.spilled)))
+
+    async def tee(self, house_id, method, path, request_headers, status, headers, body):
+        """
+        Relays an async body iterator unchanged, storing the complete body
+        once it has been fully sent (unless it grows past MAX_ENTRY_BYTES).
+        """
+        if freshness(path, headers, self.config) == 0 or status != 200:
+            async for chunk in body:
+                yield chunk
+            return
+        parts, size = [], 0
+        async for chunk in body:
+            if parts is not None:
+                size += len(chunk)
+                if size > self.config["MAX_ENTRY_BYTES"]:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.store(house_id, method, path, request_headers, status, headers, b"".join(parts))
+
+    def info(self):
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "spilled_entries": len(self.spilled),
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+
+response_cache = ResponseCache(**getattr(settings, "TUNNEL_CACHE", {}))
+
+
+def collect_metrics():
+    info = response_cache.info()
+    for key in ("hits", "misses", "stores", "evictions", "spills"):
+        yield (f"tunnel_cache_{key}_total", "counter", f"Response cache {key}.", [({}, info[key])])
+    for key in ("entries", "bytes", "spilled_entries", "spilled_bytes"):
+        yield (f"tunnel_cache_{key}", "gauge", f"Response cache {key.replace('_', ' ')}.", [({}, info[key])])
+
+
+metrics.register_collector(collect_metrics)
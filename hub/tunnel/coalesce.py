@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import re
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    # Only paths matching one of these patterns are coalesced
+    "PATHS": [r".*"],
+    # Request headers that must match for two requests to share a response
+    "KEY_HEADERS": ["accept", "accept-encoding", "accept-language"],
+    # Requests carrying any of these headers are never coalesced
+    "SKIP_HEADERS": ["cookie", "authorization", "range"],
+    # Once this much body has been relayed no new followers may join
+    "MAX_BUFFER_BYTES": 8 * 1024 * 1024,
+    # How far a reader may fall behind the fastest one before it is cut off
+    "MAX_LAG_BYTES": 1024 * 1024,
+}
+
+
+class FellBehind(Exception):
+    """
+    Ends the body of a reader that fell more than MAX_LAG_BYTES behind the
+    others sharing its response; it was cut off so they need not wait.
+    """
+
+
+def private(headers):
+    """
+    Whether a response is meant for one client only (it sets a cookie or is
+    Cache-Control: private), so it must not be shared.
+    """
+    lower = {k.lower(): v for k, v in headers.items()}
+    return "set-cookie" in lower or "private" in lower.get("cache-control", "").lower()
+
+
+class SharedResponse:
+    """
+    One in-flight tunnel response shared by every request that coalesced onto
+    it. The readers pull the leader's ResponseStream into a buffer on demand,
+    each SharedReader walking it at its own pace; chunks every reader has
+    passed are released. The body is pulled as the fastest reader asks for
+    it, so the agent's credit comes back as clients actually read; a reader
+    more than MAX_LAG_BYTES behind is cut off rather than holding the others
+    back. With a single reader nothing stays buffered.
+    """
+
+    def __init__(self, coalescer, key):
+        self.coalescer = coalescer
+        self.key = key
+        self.head = asyncio.get_running_loop().create_future()
+        self.status = None
+        self.headers = {}
+        self.agent_timings = {}  # the leader stream's trace timings
+        self.chunks = []
+        self.base = 0          # index of chunks[0] in the whole body
+        self.size = 0
+        self.buffered = 0      # bytes in chunks
+        self.readers = {}      # SharedReader → index of its next chunk
+        self.done = False
+        self.changed = asyncio.Event()
+        self.task = None       # opens the leader's stream
+        self.stream = None
+        self.body = None
+        self.fetching = None   # task reading the next chunk from the stream
+
+    def joinable(self):
+        return (self.base == 0 and self.size <= self.coalescer.config["MAX_BUFFER_BYTES"]
+                and not private(self.headers))
+
+    def lagging(self):
+        return self.buffered > self.coalescer.config["MAX_LAG_BYTES"]
+
+    def drop_laggards(self):
+        """
+        Detaches every reader more than MAX_LAG_BYTES behind the frontier.
+        """
+        behind = 0
+        for index in range(len(self.chunks), 0, -1):
+            behind += len(self.chunks[index - 1])
+            if behind > self.coalescer.config["MAX_LAG_BYTES"]:
+                break
+        else:
+            return
+        limit = self.base + index
+        for reader, position in list(self.readers.items()):
+            if position < limit:
+                logger.info("✂️ Cutting off a reader of %s that fell behind", self.key)
+                reader.fell_behind = True
+                self.coalescer.stats["detached"] += 1
+                self.detach(reader)
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def run(self, open_stream):
+        try:
+            stream = await open_stream()
+        except BaseException as exc:
+            self.done = True
+            self.coalescer.forget(self)
+            self.head.set_exception(exc)
+            self.head.exception()  # followers may all be gone; don't warn about it
+            return
+        self.stream, self.body = stream, stream.body()
+        self.status, self.headers = stream.status, stream.headers
+        self.agent_timings = stream.agent_timings
+        if private(self.headers):
+            self.coalescer.forget(self)
+        self.head.set_result(None)
+
+    def fetch(self):
+        """
+        Returns the task reading the next chunk, starting it if needed. It
+        runs on its own, so a reader that goes away does not abort it.
+        """
+        if self.fetching is None:
+            self.fetching = asyncio.create_task(self._next_chunk())
+        return self.fetching
+
+    async def _next_chunk(self):
+        try:
+            chunk = await self.body.__anext__()
+        except StopAsyncIteration:
+            self.done = True
+        except Exception as exc:
+            logger.warning("⚠️ Shared response %s ended early: %r", self.key, exc)
+            self.done = True
+        else:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.buffered += len(chunk)
+            if not self.joinable():
+                self.coalescer.forget(self)
+        finally:
+            self.fetching = None
+            if self.done:
+                self.coalescer.forget(self)
+            self._wake()
+
+    def _trim(self):
+        if not self.readers:
+            return
+        low = min(self.readers.values())
+        if low > self.base:
+            self.buffered -= sum(len(c) for c in self.chunks[:low - self.base])
+            del self.chunks[:low - self.base]
+            self.base = low
+            self.coalescer.forget(self)
+            self._wake()
+
+    def detach(self, reader):
+        if self.readers.pop(reader, None) is None:
+            return
+        self._trim()
+        if self.readers or self.done:
+            return
+        # Every client went away: stop pulling the body over the tunnel
+        self.done = True
+        self.coalescer.forget(self)
+        if self.task and not self.task.done():
+            self.task.cancel()
+        if self.fetching:
+            self.fetching.cancel()
+        if self.stream:
+            self.stream.close()
+
+
+class SharedReader:
+    """
+    One request's view of a SharedResponse. It holds its place in the shared
+    buffer from the moment it joins, so no chunk is released before it has
+    been read. Quacks like a ResponseStream (status, headers, body(), close()).
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.fell_behind = False
+        shared.readers[self] = shared.base
+
+    @property
+    def status(self):
+        return self.shared.status
+
+    @property
+    def headers(self):
+        return self.shared.headers
+
+    @property
+    def agent_timings(self):
+        return self.shared.agent_timings
+
+    async def body(self):
+        shared = self.shared
+        try:
+            while self in shared.readers:
+                index = shared.readers[self] - shared.base
+                if index < len(shared.chunks):
+                    chunk = shared.chunks[index]
+                    shared.readers[self] += 1
+                    shared._trim()
+                    yield chunk
+                elif shared.done:
+                    return
+                else:
+                    if shared.lagging():
+                        shared.drop_laggards()
+                    await asyncio.shield(shared.fetch())
+            if self.fell_behind:
+                raise FellBehind(shared.key)
+        finally:
+            self.close()
+
+    def close(self):
+        self.shared.detach(self)
+
+
+class Coalescer:
+    """
+    Single-flight for idempotent, cookie-independent requests: while a
+    response for a key is in flight, identical requests for the same house
+    wait on it instead of sending their own frame through the tunnel.
+    """
+
+    def __init__(self, **config):
+        self.config = {**DEFAULTS, **config}
+        self.paths = [re.compile(p) for p in self.config["PATHS"]]
+        self.inflight = {}
+        self.stats = {"leaders": 0, "followers": 0, "reissued": 0, "detached": 0}
+
+    def key(self, house_id, method, path, headers):
+        """
+        Returns the coalescing key for a request, or None if it must not be coalesced.
+        """
+        if not self.config["ENABLED"] or method not in ("GET", "HEAD"):
+            return None
+        lower = {k.lower(): v for k, v in headers.items()}
+        if any(h in lower for h in self.config["SKIP_HEADERS"]):
+            return None
+        if not any(p.fullmatch(path) for p in self.paths):
+            return None
+        return (house_id, method, path) + tuple(lower.get(h, "") for h in self.config["KEY_HEADERS"])
+
+    def forget(self, shared):
+        if self.inflight.get(shared.key) is shared:
+            del self.inflight[shared.key]
+
+    async def fetch(self, key, open_stream):
+        """
+        Returns (SharedReader, is_leader) once the response head is known.
+        Only the leader calls open_stream(), unless the response turns out to
+        be private: then each follower opens its own stream and gets that.
+        """
+        shared = self.inflight.get(key)
+        leader = shared is None or not shared.joinable()
+        if leader:
+            shared = SharedResponse(self, key)
+            self.inflight[key] = shared
+            shared.task = asyncio.create_task(shared.run(open_stream))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+        reader = SharedReader(shared)
+        try:
+            await asyncio.shield(shared.head)
+        except BaseException:
+            reader.close()
+            raise
+        if not leader and private(shared.headers):
+            # Someone else's cookies or private page; ask the agent ourselves
+            reader.close()
+            self.stats["reissued"] += 1
+            return await open_stream(), False
+        return reader, leader
+
+
+coalescer = Coalescer(**getattr(settings, "TUNNEL_COALESCE", {}))
+
+
+def collect_metrics():
+    for key, count in coalescer.stats.items():
+        yield (f"tunnel_coalesce_{key}_total", "counter", f"Coalesced requests that were {key}.",
+               [({}, count)])
+    yield ("tunnel_coalesce_inflight", "gauge", "Shared responses open for new followers.",
+           [({}, len(coalescer.inflight))])
+
+
+metrics.register_collector(collect_metrics)
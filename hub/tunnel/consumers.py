@@ -1,57 +1,338 @@
-import json, hashlib
+import base64, json, hashlib, logging, random, time
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.utils import timezone
+from django.conf import settings
 from .models import HouseTunnel
-from .utils import pending_responses
+from . import metrics, presence, protocol
+from .logs import kv, summarize
+from .utils import local_tunnels, pending_responses, send_patiently, cancel_stats, auth_admission
+from .utils import pick_tunnel
 from channels.db import database_sync_to_async
 
+logger = logging.getLogger(__name__)
+
+# How long a response frame may wait for room on a full reply channel
+REPLY_TIMEOUT = 15
+
+# Credit windows offered to agents that support flow control (see settings)
+FLOW_CONTROL = getattr(settings, "TUNNEL_FLOW_CONTROL", None)
+
+# Seconds between the pings of agents that asked for a heartbeat; each ping
+# refreshes the house's presence and last_seen
+HEARTBEAT_INTERVAL = getattr(settings, "TUNNEL_HEARTBEAT_INTERVAL", 30)
+
+# Connections an agent may keep per house (the pool is split into
+# interactive and bulk lanes by the agent)
+MAX_CONNECTIONS = getattr(settings, "TUNNEL_MAX_CONNECTIONS", 4)
+
+# Response size assumed for load balancing until the agent's response head
+# tells the real Content-Length
+EXPECTED_RESPONSE_BYTES = 16 * 1024
+
+# Concurrent authentications and the retry hint for those turned away (see settings)
+AUTH = {"MAX_CONCURRENT": 32, "RETRY_AFTER": 2, **getattr(settings, "TUNNEL_AUTH", {})}
+
 
 class TunnelConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        print("✅ WebSocket connected!") 
+        logger.info("✅ WebSocket connected!")
         await self.accept()
         self.house_id = None  # To keep track of which house_id is connected
+        self.framing = protocol.FRAMING_JSON
+        self.compression = None
+        self.codec = protocol.get_codec("json")    # frames and binary frame metadata
+        self.text = self.codec                     # text messages
+        self.request_streaming = False  # agent accepts request_body_chunk frames
+        self.stream_window = None       # per-request credit window, None without flow control
+        self.cancellation = False       # agent understands cancel frames
+        self.reply_channels = {}  # frame id → reply channel of the waiting view
+        self.held_requests = {}   # frame id → (frame, body chunks) buffered for legacy agents
+        self.lane = None          # "interactive" or "bulk" connection of the agent's pool
+        self.primary = False      # connection 0 of the pool, the one in the house's group
+        self.in_group = False     # receives the house's requests from other workers
+        self.outstanding = {}     # frame id → response bytes still expected
+        self.outstanding_bytes = 0
 
     async def disconnect(self, close_code):
-        if self.house_id:
+        self.reply_channels.clear()
+        self.held_requests.clear()
+        self.outstanding.clear()
+        self.outstanding_bytes = 0
+        if not self.house_id:
+            return
+        siblings = local_tunnels.get(self.house_id, [])
+        if self in siblings:
+            siblings.remove(self)
+        if not siblings:
+            local_tunnels.pop(self.house_id, None)
+        metrics.DISCONNECTS.inc(self.house_id)
+        if self.in_group:
+            await self.leave_group()
+        if self.primary and not any(s.primary for s in siblings):
+            # Other workers reach the house only through its primary connection,
+            # which may live on any worker; not when it was already re-made here
+            if siblings:
+                # The rest of the pool on this worker carries on: promote one
+                successor = siblings[0]
+                successor.primary = True
+                await successor.join_group()
+                await presence.mark_online(self.house_id)
+            else:
+                await presence.mark_offline(self.house_id)
+
+    async def join_group(self):
+        self.in_group = True
+        await self.channel_layer.group_add(f"house_{self.house_id}", self.channel_name)
+
+    async def leave_group(self):
+        self.in_group = False
+        await self.channel_layer.group_discard(f"house_{self.house_id}", self.channel_name)
+
+    def track(self, frame_id, remaining):
+        """
+        Records the response bytes still expected for a request (None when it is over).
+        """
+        self.outstanding_bytes -= self.outstanding.pop(frame_id, 0)
+        if remaining is not None:
+            self.outstanding[frame_id] = remaining
+            self.outstanding_bytes += remaining
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            # Binary frames are only ever response frames from the agent
             try:
-                tunnel = await database_sync_to_async(HouseTunnel.objects.get)(house_id=self.house_id)
-                tunnel.connected = False
-                await database_sync_to_async(tunnel.save)()
-                await self.channel_layer.group_discard(f"house_{self.house_id}", self.channel_name)
-            except HouseTunnel.DoesNotExist:
-                pass  # Safe fail
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+                data = protocol.frame_to_dict(bytes_data, self.codec)
+            except ValueError as exc:
+                logger.warning("⚠️ Dropping malformed binary frame", extra=kv(house=self.house_id, error=exc))
+                return
+        else:
+            data = self.text.loads(text_data)
         action = data.get("action")
 
         if action == "authenticate":
-            hid = data.get("house_id")
-            auth_hash = data.get("auth_hash")
+            if auth_admission["active"] >= AUTH["MAX_CONCURRENT"]:
+                # Reconnect storm: turn the agent away before touching the
+                # database, with a jittered hint so the retries spread out
+                auth_admission["rejected"] += 1
+                retry_after = round(AUTH["RETRY_AFTER"] * (1 + random.random()), 2)
+                await self.send(json.dumps({"status": "busy", "retry_after": retry_after}))
+                return await self.close(code=1013)  # "Try Again Later"
+            auth_admission["active"] += 1
+            auth_admission["admitted"] += 1
+            auth_admission["peak"] = max(auth_admission["peak"], auth_admission["active"])
             try:
-                tunnel = await database_sync_to_async(HouseTunnel.objects.get)(house_id=hid)
-            except HouseTunnel.DoesNotExist:
-                return await self.close()
-
-            expected = hashlib.sha256((hid + tunnel.secret_key).encode()).hexdigest()
-            if auth_hash != expected:
-                return await self.close()
-
-            tunnel.connected = True
-            tunnel.last_seen = timezone.now()
-            await database_sync_to_async(tunnel.save)()
-            await self.channel_layer.group_add(f"house_{hid}", self.channel_name)
-            self.house_id = hid  # track it for disconnect
-            await self.send(json.dumps({"status": "ok"}))
+                await self.authenticate(data)
+            finally:
+                auth_admission["active"] -= 1
+            return
+
+        if action == "ping" and self.house_id:
+            if self.primary:
+                await presence.mark_online(self.house_id)
+            await self.send(self.text.dumps_text({"action": "pong", "ts": data.get("ts")}))
             return
 
-        if action == "http_response":
+        if action in ("http_response", "http_response_start", "http_response_chunk",
+                      "http_response_end", "window_update"):
             frame_id = data.get("id")
-            future = pending_responses.get(frame_id)
-            if future:
-                future.set_result(data)
+            if frame_id in self.outstanding:
+                if action == "http_response_start":
+                    length = next((v for k, v in data.get("headers", {}).items()
+                                   if k.lower() == "content-length"), None)
+                    self.track(frame_id, int(length) if str(length).isdigit() else EXPECTED_RESPONSE_BYTES)
+                elif action == "http_response_chunk":
+                    self.track(frame_id, max(self.outstanding[frame_id] - len(data.get("body") or ""), 0))
+                elif action in ("http_response", "http_response_end"):
+                    self.track(frame_id, None)
+            if action == "http_response_end" and data.get("cancelled"):
+                # Late end of a request we cancelled; nobody is waiting for it
+                cancel_stats[self.house_id]["bytes_saved"] += data.get("bytes_saved", 0)
+            if action == "http_response_start" and self.stream_window:
+                # Tell the view its credit window and where to send window updates
+                data = {**data, "window": self.stream_window, "channel": self.channel_name}
+            stream = pending_responses.get(frame_id)
+            if stream and stream.local:
+                stream.feed(data)
+                return
+            if action in ("http_response", "http_response_end"):
+                reply_channel = self.reply_channels.pop(frame_id, None)
+            else:
+                reply_channel = self.reply_channels.get(frame_id)
+            if reply_channel:
+                await self.send_reply(reply_channel, data)
             return
+
+    async def authenticate(self, data):
+        """
+        Checks an agent's credentials, registers its tunnel and replies with
+        the negotiated options. Bad credentials close the websocket.
+        """
+        hid = data.get("house_id")
+        auth_hash = data.get("auth_hash")
+        connection = data.get("connection", 0)
+        if not isinstance(connection, int) or not 0 <= connection < MAX_CONNECTIONS:
+            logger.warning("⚠️ Refusing pool connection", extra=kv(house=hid, connection=connection))
+            return await self.close(code=1008)  # "Policy Violation"
+        try:
+            tunnel = await database_sync_to_async(
+                HouseTunnel.objects.only("secret_key").get
+            )(house_id=hid)
+        except HouseTunnel.DoesNotExist:
+            return await self.close()
+
+        expected = hashlib.sha256((hid + tunnel.secret_key).encode()).hexdigest()
+        if auth_hash != expected:
+            return await self.close()
+
+        # connected/last_seen reach the database with the next presence flush
+        self.house_id = hid  # track it for disconnect
+        self.lane = data.get("lane")
+        self.primary = connection == 0
+        siblings = local_tunnels.setdefault(hid, [])
+        siblings.append(self)
+        if self.primary:
+            # Only the primary connection joins the house's group, wherever the
+            # rest of the pool landed, so requests from other workers are
+            # delivered once; it hands them on to the least loaded connection
+            # of the pool it shares a worker with (see forward_http)
+            for sibling in siblings:
+                if sibling.in_group:
+                    # A stale primary not yet disconnected, or one promoted in its place
+                    sibling.primary = False
+                    await sibling.leave_group()
+            await self.join_group()
+            await presence.mark_online(hid)
+        metrics.CONNECTS.inc(hid)
+        self.framing = protocol.negotiate_framing(data.get("framing"))
+        self.compression = protocol.negotiate_compression(data.get("compression"))
+        self.codec = protocol.get_codec(protocol.negotiate_codec(
+            data.get("codecs"), self.framing == protocol.FRAMING_BINARY))
+        self.text = protocol.text_codec(self.codec)
+        self.request_streaming = bool(data.get("request_streaming"))
+        self.cancellation = bool(data.get("cancel"))
+        reply = {"status": "ok", "framing": self.framing, "compression": self.compression,
+                 "codec": self.codec.name, "max_connections": MAX_CONNECTIONS}
+        if data.get("heartbeat"):
+            reply["heartbeat"] = HEARTBEAT_INTERVAL
+        if data.get("flow_control") and FLOW_CONTROL:
+            self.stream_window = FLOW_CONTROL["STREAM_WINDOW"]
+            reply["flow_control"] = {
+                "stream_window": FLOW_CONTROL["STREAM_WINDOW"],
+                "tunnel_window": FLOW_CONTROL["TUNNEL_WINDOW"],
+            }
+        await self.send(json.dumps(reply))
+
+    async def send_reply(self, reply_channel, data):
+        """
+        Routes a response frame to the reply channel of the view waiting for it.
+        A full channel (slow downstream client) is retried until REPLY_TIMEOUT.
+        """
+        message = {"type": "tunnel.response", "frame": data}
+        if not await send_patiently(reply_channel, message, REPLY_TIMEOUT):
+            logger.warning("⚠️ Reply channel full, dropping response",
+                           extra=kv(house=self.house_id, id=data.get("id")))
+            self.reply_channels.pop(data.get("id"), None)
+
     async def forward_http(self, event):
-        print("📤 Forwarding event to house:", event)
-        await self.send(text_data=json.dumps(event))
\ No newline at end of file
+        frame = event["frame"]
+        if event.get("reply_channel") and not event.get("routed"):
+            # Came through the house's group: pick the connection of the pool
+            target = pick_tunnel(self.house_id, frame)
+            if target is not None and target is not self:
+                return await target.forward_http({**event, "routed": True})
+        self.track(frame["id"], EXPECTED_RESPONSE_BYTES)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 Forwarding frame to house", extra=kv(house=self.house_id, frame=summarize(frame)))
+        if "trace" in frame:
+            # Lets the trace tell channel layer delay from websocket transit
+            frame = {**frame, "trace": {**frame["trace"], "forwarded": time.time()}}
+        if event.get("reply_channel"):
+            self.reply_channels[frame["id"]] = event["reply_channel"]
+            if frame.get("body_stream"):
+                # The view sends the body chunks straight to this consumer
+                await self.send_reply(event["reply_channel"], {
+                    "action": "request_body_ready", "id": frame["id"],
+                    "channel": self.channel_name, "window": self.stream_window,
+                })
+        if not self.request_streaming:
+            if frame.get("body_stream"):
+                # Agent predates request streaming: send the request once the body is complete
+                self.held_requests[frame["id"]] = (frame, [])
+                return
+            if isinstance(frame.get("body"), bytes):
+                frame = {**frame, "body": frame["body"].decode("utf-8", "ignore")}
+            return await self.send(text_data=json.dumps(frame))
+        # The frame is encoded once, here; a binary codec sends the body as is
+        if self.codec.binary:
+            await self.send(bytes_data=protocol.pack_json_frame(
+                frame["id"], protocol.REQUEST, frame, codec=self.codec))
+            return
+        if isinstance(frame.get("body"), bytes):
+            frame = {**frame, "body": base64.b64encode(frame["body"]).decode("ascii"), "is_base64": True}
+        await self.send(text_data=self.text.dumps_text(frame))
+
+    async def forward_body(self, event):
+        """
+        Relays one chunk of a streamed request body to the agent; a None body
+        marks the end of it.
+        """
+        frame_id, chunk = event["id"], event["body"]
+        if not self.request_streaming:
+            held = self.held_requests.get(frame_id)
+            if held is None:
+                return
+            if chunk is not None:
+                held[1].append(chunk)
+                return
+            frame, chunks = self.held_requests.pop(frame_id)
+            frame = {**frame, "body_stream": False,
+                     "body": b"".join(chunks).decode("utf-8", "ignore")}
+            await self.send(text_data=json.dumps(frame))
+            return
+
+        if self.framing == protocol.FRAMING_BINARY:
+            if chunk is None:
+                await self.send(bytes_data=protocol.pack_frame(frame_id, protocol.REQUEST_END))
+            else:
+                await self.send(bytes_data=protocol.pack_frame(frame_id, protocol.REQUEST_CHUNK, chunk))
+        elif chunk is None:
+            await self.send(text_data=self.text.dumps_text({"action": "request_body_end", "id": frame_id}))
+        else:
+            await self.send(text_data=self.text.dumps_text({
+                "action": "request_body_chunk", "id": frame_id,
+                "body": base64.b64encode(chunk).decode("ascii"), "is_base64": True,
+            }))
+
+    async def window_update(self, event):
+        """
+        Returns response credit for a request to the agent.
+        """
+        if not self.stream_window:
+            return
+        credit = {"credit": event["credit"], "close": event.get("close", False)}
+        if self.framing == protocol.FRAMING_BINARY:
+            await self.send(bytes_data=protocol.pack_json_frame(
+                event["id"], protocol.WINDOW_UPDATE, credit, codec=self.codec))
+        else:
+            await self.send(text_data=self.text.dumps_text({"action": "window_update", "id": event["id"], **credit}))
+
+    async def tunnel_cancel(self, event):
+        """
+        Tells the agent to stop working on a request whose client went away.
+        """
+        frame_id = event["id"]
+        if frame_id not in self.outstanding:
+            # Sent to the house's group before the head told which connection has it
+            owner = next((c for c in local_tunnels.get(self.house_id, ())
+                          if frame_id in c.outstanding), None)
+            if owner is not None:
+                return await owner.tunnel_cancel(event)
+        self.track(frame_id, None)
+        self.held_requests.pop(frame_id, None)
+        if not self.cancellation:
+            # Older agents finish the request anyway; just release its credit
+            return await self.window_update({"id": frame_id, "credit": 0, "close": True})
+        cancel_stats[self.house_id]["cancelled"] += 1
+        if self.framing == protocol.FRAMING_BINARY:
+            await self.send(bytes_data=protocol.pack_frame(frame_id, protocol.CANCEL))
+        else:
+            await self.send(text_data=self.text.dumps_text({"action": "cancel", "id": frame_id}))
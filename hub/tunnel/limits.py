@@ -0,0 +1,157 @@
+"""
+Admission limits for proxied requests, checked before a frame is sent.
+
+Every house has a token bucket (requests per second with a burst), a cap on
+requests in flight and a cap on request body bytes queued towards it; the
+hub process as a whole has the same three limits. A request over a house
+limit is answered 429, one over a global limit 503, both at once and with a
+Retry-After header, instead of piling up futures that each wait for the
+agent until they time out.
+
+Limits are per hub process, like the rest of the tunnel state. A limit set
+to None is not enforced.
+"""
+import math
+import time
+from django.conf import settings
+from . import metrics
+
+DEFAULTS = {
+    "ENABLED": True,
+    # Requests per second per house, and how many may arrive at once
+    "HOUSE_RATE": 1000,
+    "HOUSE_BURST": 2000,
+    # Requests per house waiting on or relaying a tunnel response
+    "HOUSE_MAX_IN_FLIGHT": 256,
+    # Request body bytes per house on their way through the tunnel
+    "HOUSE_MAX_QUEUED_BYTES": 64 * 1024 * 1024,
+    # The same limits for all houses together
+    "GLOBAL_RATE": None,
+    "GLOBAL_BURST": None,
+    "GLOBAL_MAX_IN_FLIGHT": 10000,
+    "GLOBAL_MAX_QUEUED_BYTES": 1024 * 1024 * 1024,
+    # Retry-After (seconds) for requests turned away by an in-flight or byte cap
+    "RETRY_AFTER": 1,
+}
+
+
+class Rejected(Exception):
+    """
+    A request over a limit; 'status' is 429 (house) or 503 (global).
+    """
+
+    def __init__(self, limit, status, retry_after):
+        super().__init__(limit)
+        self.limit = limit
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def wait(self):
+        """
+        Seconds until a token is available; 0 if one is.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Usage:
+    """
+    Requests and body bytes in flight for one house, or for the process.
+    """
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.in_flight = 0
+        self.queued_bytes = 0
+
+
+class Ticket:
+    """
+    What an admitted request holds; release() gives it back, once.
+    """
+
+    def __init__(self, limiter, house_id, size):
+        self.limiter = limiter
+        self.house_id = house_id
+        self.size = size
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release(self)
+
+
+class Limiter:
+    def __init__(self, **config):
+        self.config = {**DEFAULTS, **config}
+        self.total = Usage(self.config["GLOBAL_RATE"], self.config["GLOBAL_BURST"])
+        self.houses = {}   # house_id → Usage
+
+    def _check(self, usage, prefix, status, size):
+        config = self.config
+        if usage.bucket:
+            wait = usage.bucket.wait()
+            if wait:
+                raise Rejected("rate", status, wait)
+        limit = config[f"{prefix}_MAX_IN_FLIGHT"]
+        if limit is not None and usage.in_flight >= limit:
+            raise Rejected("in_flight", status, config["RETRY_AFTER"])
+        limit = config[f"{prefix}_MAX_QUEUED_BYTES"]
+        # A body larger than the whole cap still goes through on its own
+        if limit is not None and size and usage.queued_bytes and usage.queued_bytes + size > limit:
+            raise Rejected("queued_bytes", status, config["RETRY_AFTER"])
+
+    def admit(self, house_id, size=0):
+        """
+        Admits a request with a body of 'size' bytes, or raises Rejected.
+        Returns a Ticket to release once the response is done.
+        """
+        if not self.config["ENABLED"]:
+            return None
+        house = self.houses.get(house_id)
+        if house is None:
+            house = self.houses[house_id] = Usage(self.config["HOUSE_RATE"], self.config["HOUSE_BURST"])
+        try:
+            self._check(house, "HOUSE", 429, size)
+            self._check(self.total, "GLOBAL", 503, size)
+        except Rejected as exc:
+            metrics.LIMITED.inc(house_id, exc.limit if exc.status == 429 else f"global_{exc.limit}")
+            raise
+        for usage in (house, self.total):
+            if usage.bucket:
+                usage.bucket.take()
+            usage.in_flight += 1
+            usage.queued_bytes += size
+        return Ticket(self, house_id, size)
+
+    def release(self, ticket):
+        for usage in (self.houses[ticket.house_id], self.total):
+            usage.in_flight -= 1
+            usage.queued_bytes -= ticket.size
+
+
+limiter = Limiter(**getattr(settings, "TUNNEL_LIMITS", {}))
+
+
+def collect_metrics():
+    yield ("tunnel_limit_in_flight", "gauge", "Admitted requests not yet finished, per house.",
+           [({"house": h}, u.in_flight) for h, u in limiter.houses.items()])
+    yield ("tunnel_limit_queued_bytes", "gauge", "Request body bytes of admitted requests, per house.",
+           [({"house": h}, u.queued_bytes) for h, u in limiter.houses.items()])
+
+
+metrics.register_collector(collect_metrics)
@@ -0,0 +1,178 @@
+"""
+Logging for the hub (mirrors client/logs.py).
+
+Records go to the "tunnel" logger tree (logging.getLogger(__name__) in the
+tunnel modules) and are handed to a bounded queue; a background thread
+formats and writes them, so a slow stdout never stalls the event loop. When
+the queue is full records are dropped and counted rather than waited on.
+
+Every record can carry structured fields (extra=kv(house=..., status=...)),
+rendered as key=value pairs or as one JSON object per line. DEBUG records,
+which describe individual frames, are sampled and rate limited, and frame
+bodies are only ever logged as a size and a short preview (see summarize()).
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from django.conf import settings
+from . import metrics
+
+DEFAULTS = {
+    "LEVEL": "INFO",             # threshold of the tunnel loggers
+    "FORMAT": "text",            # "text" (key=value fields) or "json"
+    "DEBUG_SAMPLE_RATE": 0.01,   # share of DEBUG records kept
+    "DEBUG_RATE_LIMIT": 50,      # DEBUG records kept per second at most; 0 = no limit
+    "BODY_PREVIEW": 64,          # characters of a body shown in frame summaries
+    "QUEUE_SIZE": 10000,         # records waiting to be written; more are dropped
+}
+
+config = {**DEFAULTS, **getattr(settings, "TUNNEL_LOGGING", {})}
+
+ROOT = "tunnel"
+
+_listener = None
+stats = {"dropped": 0, "sampled_out": 0}
+
+
+def kv(**fields):
+    """
+    Structured fields for a record: logger.info("msg", extra=kv(house=house_id)).
+    """
+    return {"fields": fields}
+
+
+def preview(body, limit=None):
+    """
+    Describes a body by its size and first `limit` characters.
+    """
+    limit = config["BODY_PREVIEW"] if limit is None else limit
+    if isinstance(body, (bytes, bytearray)):
+        text = bytes(body[:limit]).decode("utf-8", "replace")
+    else:
+        text = str(body)[:limit]
+    more = "…" if len(body) > limit else ""
+    return f"<{len(body)} bytes {text!r}{more}>"
+
+
+def summarize(frame):
+    """
+    A frame with its body replaced by a preview, safe to log.
+    """
+    if "body" not in frame or not isinstance(frame["body"], (str, bytes, bytearray)):
+        return frame
+    return {**frame, "body": preview(frame["body"])}
+
+
+def _value(value):
+    text = str(value)
+    return json.dumps(text) if not text or " " in text or '"' in text or "=" in text else text
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats a record and its fields as a text line or a JSON object.
+    """
+
+    def __init__(self, format="text"):
+        super().__init__()
+        self.json = format == "json"
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        message = record.getMessage()
+        if self.json:
+            entry = {"ts": round(record.created, 3), "level": record.levelname,
+                     "logger": record.name, "msg": message, **fields}
+            if record.exc_info:
+                entry["exc"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name} {message}"
+        if fields:
+            line += " " + " ".join(f"{k}={_value(v)}" for k, v in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DebugSampler(logging.Filter):
+    """
+    Keeps `rate` of the DEBUG records, at most `limit` per second. Records
+    of other levels always pass.
+    """
+
+    def __init__(self, rate, limit):
+        super().__init__()
+        self.rate = rate
+        self.limit = limit
+        self.second = 0
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.rate < 1 and random.random() >= self.rate:
+            stats["sampled_out"] += 1
+            return False
+        second = int(record.created)
+        if second != self.second:
+            self.second, self.count = second, 0
+        self.count += 1
+        if self.limit and self.count > self.limit:
+            stats["sampled_out"] += 1
+            return False
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without ever blocking the caller.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats["dropped"] += 1
+
+    def prepare(self, record):
+        # Only merge the arguments here; formatting happens on the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup():
+    """
+    Attaches the queue handler to the tunnel loggers and starts the writer
+    thread. Called once from TunnelConfig.ready().
+    """
+    global _listener
+    if _listener:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(StructuredFormatter(config["FORMAT"]))
+    records = queue.Queue(config["QUEUE_SIZE"])
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(DebugSampler(config["DEBUG_SAMPLE_RATE"], config["DEBUG_RATE_LIMIT"]))
+
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(config["LEVEL"])
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def collect_metrics():
+    yield ("tunnel_log_records_dropped_total", "counter",
+           "Log records dropped because the log queue was full.", [({}, stats["dropped"])])
+    yield ("tunnel_log_records_sampled_out_total", "counter",
+           "DEBUG log records left out by sampling or rate limiting.", [({}, stats["sampled_out"])])
+
+
+metrics.register_collector(collect_metrics)
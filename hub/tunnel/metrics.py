@@ -0,0 +1,148 @@
+"""
+Prometheus metrics for the hub (the metric classes mirror client/metrics.py).
+
+Counters, gauges and histograms are plain dicts keyed by label values. All
+updates happen on the event loop thread, so the hot path pays one dict
+lookup per update and takes no locks. render() produces the Prometheus text
+exposition format; collectors registered with register_collector() add
+samples computed at scrape time (cache, coalescing, compression, ...).
+"""
+import bisect
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}   # label values → value
+        _metrics.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            # per-bucket counts (last one is +Inf), sum
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def register_collector(collect):
+    """
+    Registers a function called at every scrape. It returns an iterable of
+    (name, kind, help, samples) where samples is a list of (labels dict, value).
+    """
+    _collectors.append(collect)
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Hub metrics
+
+# Label values for what a client controls are bounded: requests for houses
+# that are not online share one label, and unusual methods are "other"
+OFFLINE_HOUSE = "offline"
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+
+def method_label(method):
+    return method if method in METHODS else "other"
+
+
+REQUESTS = Counter("tunnel_requests_total", "Proxied requests by response status.",
+                   ("house", "method", "status"))
+LATENCY = Histogram("tunnel_request_duration_seconds",
+                    "Seconds per stage: presence lookup, tunnel round trip to the "
+                    "response head, body relay, and total.", ("house", "stage"))
+BYTES = Counter("tunnel_bytes_total", "Request (in) and response (out) body bytes.",
+                ("house", "direction"))
+IN_FLIGHT = Gauge("tunnel_in_flight_requests", "Requests waiting on or relaying a tunnel response.",
+                  ("house",))
+TIMEOUTS = Counter("tunnel_timeouts_total", "Requests that timed out waiting for the agent.",
+                   ("house", "stage"))
+LIMITED = Counter("tunnel_limited_total", "Requests turned away by an admission limit (see limits.py).",
+                  ("house", "limit"))
+CONNECTS = Counter("tunnel_connects_total", "Tunnel authentications.", ("house",))
+DISCONNECTS = Counter("tunnel_disconnects_total", "Tunnel disconnections.", ("house",))
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from . import metrics
+from .models import HouseTunnel
+from .utils import local_tunnels
+
+logger = logging.getLogger(__name__)
+
+# Seconds a known presence answer is trusted before asking again
+PRESENCE_TTL = getattr(settings, "TUNNEL_PRESENCE_TTL", 30)
+
+# Seconds an "offline" answer is trusted, kept short so reconnects show up quickly
+OFFLINE_TTL = getattr(settings, "TUNNEL_PRESENCE_OFFLINE_TTL", 2)
+
+# Optional Django cache alias (e.g. a Redis cache) shared by all hub workers
+PRESENCE_CACHE = getattr(settings, "TUNNEL_PRESENCE_CACHE", None)
+
+# Seconds between bulk writes of connected/last_seen to the database
+FLUSH_INTERVAL = getattr(settings, "TUNNEL_PRESENCE_FLUSH_INTERVAL", 1)
+
+# Houses per UPDATE statement (keeps SQLite under its bound parameter limit)
+FLUSH_BATCH = 500
+
+# house_id → (online, expires_at) for this process; expired entries are
+# swept at most every PRESENCE_TTL seconds, so lookups of made-up house ids
+# do not pile up
+_presence = {}
+_next_sweep = 0.0
+
+# house_id → connected, waiting for the next flush; the latest state wins
+_writes = {}
+_flusher = None
+write_stats = {"flushes": 0, "rows": 0, "errors": 0}
+
+
+def _shared_cache():
+    return caches[PRESENCE_CACHE] if PRESENCE_CACHE else None
+
+
+def _key(house_id):
+    return f"tunnel:presence:{house_id}"
+
+
+def _remember(house_id, online):
+    global _next_sweep
+    now = time.monotonic()
+    if now >= _next_sweep:
+        for key in [k for k, (_, expires_at) in _presence.items() if expires_at <= now]:
+            del _presence[key]
+        _next_sweep = now + PRESENCE_TTL
+    ttl = PRESENCE_TTL if online else OFFLINE_TTL
+    _presence[house_id] = (online, now + ttl)
+    return ttl
+
+
+def record(house_id, connected):
+    """
+    Queues a connected/last_seen update for house_id. Updates are written in
+    bulk every FLUSH_INTERVAL seconds, at most one UPDATE per state per batch,
+    so database load does not grow with heartbeats or reconnects.
+    """
+    global _flusher
+    _writes[house_id] = connected
+    if _flusher is None or _flusher.done() or _flusher.get_loop() is not asyncio.get_running_loop():
+        _flusher = asyncio.get_running_loop().create_task(_flush_forever())
+
+
+def _write(updates):
+    now = timezone.now()
+    by_state = {}
+    for house_id, connected in updates.items():
+        by_state.setdefault(connected, []).append(house_id)
+    with transaction.atomic():
+        for connected, house_ids in by_state.items():
+            for i in range(0, len(house_ids), FLUSH_BATCH):
+                # update() skips auto_now, so last_seen is set explicitly
+                HouseTunnel.objects.filter(house_id__in=house_ids[i:i + FLUSH_BATCH]).update(
+                    connected=connected, last_seen=now)
+
+
+async def flush():
+    """
+    Writes the queued presence updates now.
+    """
+    if not _writes:
+        return
+    updates = dict(_writes)
+    _writes.clear()
+    try:
+        await sync_to_async(_write)(updates)
+    except Exception as exc:
+        write_stats["errors"] += 1
+        logger.warning("⚠️ Presence flush failed: %r", exc)
+        for house_id, connected in updates.items():
+            _writes.setdefault(house_id, connected)  # newer updates win
+        return
+    write_stats["flushes"] += 1
+    write_stats["rows"] += len(updates)
+
+
+async def _flush_forever():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush()
+
+
+def collect_metrics():
+    yield ("tunnel_presence_flushes_total", "counter", "Bulk presence writes.",
+           [({}, write_stats["flushes"])])
+    yield ("tunnel_presence_rows_total", "counter", "House rows updated by bulk presence writes.",
+           [({}, write_stats["rows"])])
+    yield ("tunnel_presence_pending", "gauge", "Presence updates waiting for the next flush.",
+           [({}, len(_writes))])
+
+
+metrics.register_collector(collect_metrics)
+
+
+async def mark_online(house_id):
+    """
+    Records that house_id just authenticated a tunnel (or is still there).
+    """
+    record(house_id, True)
+    ttl = _remember(house_id, True)
+    cache = _shared_cache()
+    if cache:
+        await cache.aset(_key(house_id), True, ttl)
+
+
+async def mark_offline(house_id):
+    """
+    Records that house_id's tunnel went away.
+    """
+    record(house_id, False)
+    ttl = _remember(house_id, False)
+    cache = _shared_cache()
+    if cache:
+        await cache.aset(_key(house_id), False, ttl)
+
+
+async def is_online(house_id):
+    """
+    Answers whether house_id has a connected tunnel, checking this process,
+    then the shared cache, and only then the database.
+    """
+    if house_id in local_tunnels:
+        return True
+
+    entry = _presence.get(house_id)
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
+
+    cache = _shared_cache()
+    if cache:
+        online = await cache.aget(_key(house_id))
+        if online is not None:
+            _remember(house_id, online)
+            return online
+
+    online = await sync_to_async(
+        HouseTunnel.objects.filter(house_id=house_id, connected=True).exists
+    )()
+    ttl = _remember(house_id, online)
+    if cache:
+        await cache.aset(_key(house_id), online, ttl)
+    return online
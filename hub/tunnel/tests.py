@@ -1,3 +1,632 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import sys
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from . import presence, protocol, tracing, views
+from .cache import DEFAULTS as CACHE_DEFAULTS, freshness
+from .coalesce import Coalescer, FellBehind
+from .consumers import TunnelConsumer
+from .limits import Limiter, Rejected
+from .models import Clients, HouseTunnel
+from .utils import ResponseStream, cancel_stats, local_tunnels
+
+# The agent's modules live in client/; appended, not prepended, because
+# client/secrets.py would shadow the stdlib module
+sys.path.append(str(Path(__file__).resolve().parents[2] / "client"))
+import protocol as agent_protocol  # noqa: E402
+from tunnel_agent import FlowControl, FrameWriter, HubBusy, SlotScheduler, keep_connected  # noqa: E402
+
+REQ_ID = "0b7e5d8c-3f1a-4c2e-9d6b-5a4f3e2d1c0b"
+
+
+async def settle():
+    """Lets every task that can run, run."""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class FlowControlTests(SimpleTestCase):
+    async def test_stream_window_waits_for_credit(self):
+        flow = FlowControl(stream_window=100, tunnel_window=1000)
+        await flow.acquire("a", 60)
+        waiter = asyncio.create_task(flow.acquire("a", 60))
+        await settle()
+        self.assertFalse(waiter.done())
+        flow.credit("a", 60)
+        await waiter
+        self.assertEqual(flow.outstanding, {"a": 60})
+        self.assertEqual(flow.total, 60)
+
+    async def test_first_chunk_may_exceed_the_window(self):
+        flow = FlowControl(stream_window=100, tunnel_window=150)
+        await asyncio.wait_for(flow.acquire("a", 500), 1)
+        self.assertEqual(flow.total, 500)
+
+    async def test_tunnel_window_is_shared(self):
+        flow = FlowControl(stream_window=100, tunnel_window=150)
+        await flow.acquire("a", 100)
+        waiter = asyncio.create_task(flow.acquire("b", 100))
+        await settle()
+        self.assertFalse(waiter.done())
+        flow.credit("a", 0, close=True)
+        await waiter
+        self.assertEqual(flow.outstanding, {"b": 100})
+        self.assertEqual(flow.total, 100)
+
+    async def test_credit_never_goes_below_zero(self):
+        flow = FlowControl(stream_window=100, tunnel_window=1000)
+        await flow.acquire("a", 40)
+        flow.credit("a", 100)
+        self.assertEqual(flow.outstanding, {})
+        self.assertEqual(flow.total, 0)
+
+    async def test_closed_request_stops_waiting(self):
+        flow = FlowControl(stream_window=100, tunnel_window=1000)
+        flow.open.add("a")
+        await flow.acquire("a", 100)
+        waiter = asyncio.create_task(flow.acquire("a", 100))
+        await settle()
+        flow.credit("a", 0, close=True)
+        await asyncio.wait_for(waiter, 1)
+        self.assertIn("a", flow.closed)
+        self.assertEqual(flow.total, 0)
+        flow.finish("a")
+        self.assertNotIn("a", flow.closed)
+
+
+class RecordingBackoff:
+    """A Backoff that records its calls and never waits."""
+
+    def __init__(self):
+        self.calls = []
+
+    def next(self, retry_after=None):
+        self.calls.append(("next", retry_after))
+        return 0
+
+    def reset(self):
+        self.calls.append(("reset",))
+
+
+class ReconnectTests(SimpleTestCase):
+    async def run_attempts(self, outcomes, stable_after):
+        """
+        Runs keep_connected over one attempt per outcome: "closed" (clean
+        close after authenticating), "busy" or "error".
+        """
+        backoff = RecordingBackoff()
+        outcomes = list(outcomes)
+
+        async def connect(connected):
+            if not outcomes:
+                raise asyncio.CancelledError()
+            outcome = outcomes.pop(0)
+            if outcome == "busy":
+                raise HubBusy(5)
+            if outcome == "error":
+                raise OSError("connection refused")
+            connected()
+
+        with self.assertLogs("agent"), self.assertRaises(asyncio.CancelledError):
+            await keep_connected(connect, backoff, stable_after)
+        return backoff.calls
+
+    async def test_clean_close_backs_off(self):
+        calls = await self.run_attempts(["closed"] * 3, stable_after=60)
+        self.assertEqual(calls, [("next", None)] * 3)
+
+    async def test_backoff_resets_after_a_stable_connection(self):
+        calls = await self.run_attempts(["error", "closed"], stable_after=0)
+        self.assertEqual(calls, [("next", None), ("reset",), ("next", None)])
+
+    async def test_busy_honours_retry_after(self):
+        calls = await self.run_attempts(["busy"], stable_after=0)
+        self.assertEqual(calls, [("next", 5)])
+
+
+class SlotSchedulerTests(SimpleTestCase):
+    async def hold(self, limit, cls, log, release):
+        async with limit.slot(cls):
+            log.append(cls)
+            await release.wait()
+
+    async def test_bulk_share_leaves_room_for_interactive(self):
+        limit = SlotScheduler(slots=2, weights={"interactive": 8, "bulk": 1}, bulk_share=0.5)
+        log, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(self.hold(limit, "bulk", log, release)) for _ in range(3)]
+        await settle()
+        self.assertEqual(log, ["bulk"])
+        tasks.append(asyncio.create_task(self.hold(limit, "interactive", log, release)))
+        await settle()
+        self.assertEqual(log, ["bulk", "interactive"])
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(limit.busy, {"interactive": 0, "bulk": 0})
+
+    async def test_interactive_overtakes_waiting_bulk(self):
+        limit = SlotScheduler(slots=1, weights={"interactive": 8, "bulk": 1}, bulk_share=1)
+        log, gate, release = [], asyncio.Event(), asyncio.Event()
+        release.set()
+        first = asyncio.create_task(self.hold(limit, "interactive", log, gate))
+        await settle()
+        waiting = [asyncio.create_task(self.hold(limit, cls, log, release))
+                   for cls in ("bulk", "bulk", "interactive")]
+        await settle()
+        gate.set()
+        await asyncio.gather(first, *waiting)
+        self.assertEqual(log, ["interactive", "interactive", "bulk", "bulk"])
+
+    async def test_cancelled_waiter_does_not_hold_a_slot(self):
+        limit = SlotScheduler(slots=1, weights={"interactive": 8, "bulk": 1})
+        log, gate, release = [], asyncio.Event(), asyncio.Event()
+        release.set()
+        first = asyncio.create_task(self.hold(limit, "interactive", log, gate))
+        await settle()
+        cancelled = asyncio.create_task(self.hold(limit, "interactive", log, release))
+        last = asyncio.create_task(self.hold(limit, "bulk", log, release))
+        await settle()
+        cancelled.cancel()
+        gate.set()
+        await asyncio.gather(first, last)
+        self.assertEqual(log, ["interactive", "bulk"])
+        self.assertEqual(limit.busy, {"interactive": 0, "bulk": 0})
+
+
+class FakeSocket:
+    """Records sent messages; the first send blocks until `gate` is set."""
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def send(self, message):
+        if not self.sent:
+            self.sent.append(message)
+            await self.gate.wait()
+        else:
+            self.sent.append(message)
+
+
+class FrameWriterTests(SimpleTestCase):
+    async def test_queued_messages_go_by_weighted_fair_queuing(self):
+        ws = FakeSocket()
+        writer = FrameWriter(ws, weights={"interactive": 8, "bulk": 1})
+        writer.priorities = {"b": "bulk", "i": "interactive"}
+        first = asyncio.create_task(writer.send(b"first", "i"))
+        await settle()
+        queued = []
+        for name, req_id in (("b1", "b"), ("b2", "b"), ("i1", "i"), ("i2", "i")):
+            queued.append(asyncio.create_task(writer.send(name.encode() * 500, req_id)))
+            await settle()
+        ws.gate.set()
+        await asyncio.gather(first, *queued)
+        self.assertEqual([m[:2] for m in ws.sent], [b"fi", b"i1", b"i2", b"b1", b"b2"])
+        self.assertFalse(writer.sending)
+
+    async def test_cancelled_sender_passes_its_turn_on(self):
+        ws = FakeSocket()
+        writer = FrameWriter(ws)
+        first = asyncio.create_task(writer.send(b"first"))
+        await settle()
+        dropped = asyncio.create_task(writer.send(b"dropped"))
+        kept = asyncio.create_task(writer.send(b"kept"))
+        await settle()
+        dropped.cancel()
+        ws.gate.set()
+        await asyncio.gather(first, kept)
+        self.assertEqual(ws.sent, [b"first", b"kept"])
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_pack_unpack_round_trip(self):
+        data = protocol.pack_frame(REQ_ID, protocol.RESPONSE_CHUNK, b"body", protocol.FLAG_ZLIB)
+        self.assertEqual(protocol.unpack_frame(data), (REQ_ID, protocol.RESPONSE_CHUNK, protocol.FLAG_ZLIB, b"body"))
+
+    def test_unpack_rejects_bad_frames(self):
+        data = protocol.pack_frame(REQ_ID, protocol.RESPONSE_CHUNK, b"body")
+        with self.assertRaises(ValueError):
+            protocol.unpack_frame(data[:10])
+        with self.assertRaises(ValueError):
+            protocol.unpack_frame(data[:-1])
+
+    def test_chunk_frame_keeps_raw_body_and_compression(self):
+        data = agent_protocol.pack_frame(REQ_ID, agent_protocol.RESPONSE_CHUNK, b"\x00\xff", agent_protocol.FLAG_ZLIB)
+        self.assertEqual(protocol.frame_to_dict(data), {
+            "action": "http_response_chunk", "id": REQ_ID, "body": b"\x00\xff", "compression": "zlib",
+        })
+
+    def test_head_round_trips_with_every_codec(self):
+        head = {"status": 200, "headers": {"Content-Type": "text/html", "X-Count": "3"}}
+        for name in agent_protocol.SUPPORTED_CODECS:
+            with self.subTest(codec=name):
+                data = agent_protocol.pack_json_frame(REQ_ID, agent_protocol.RESPONSE_START, head,
+                                                      codec=agent_protocol.get_codec(name))
+                frame = protocol.frame_to_dict(data, protocol.get_codec(name))
+                self.assertEqual(frame, {"action": "http_response_start", "id": REQ_ID, **head})
+
+    def test_request_frame_carries_raw_body_with_binary_codecs(self):
+        frame = {"action": "proxy_request", "id": REQ_ID, "method": "POST", "path": "api/",
+                 "headers": {}, "body": b"\x00\x01"}
+        for name in protocol.SUPPORTED_CODECS:
+            codec = protocol.get_codec(name)
+            if not codec.binary:
+                continue
+            with self.subTest(codec=name):
+                data = protocol.pack_json_frame(REQ_ID, protocol.REQUEST, frame, codec=codec)
+                self.assertEqual(agent_protocol.frame_to_dict(data, agent_protocol.get_codec(name)), frame)
+
+
+class LimiterTests(SimpleTestCase):
+    def limiter(self, **config):
+        return Limiter(**{"HOUSE_RATE": None, "GLOBAL_RATE": None, **config})
+
+    def test_in_flight_caps_per_house_and_global(self):
+        limiter = self.limiter(HOUSE_MAX_IN_FLIGHT=2, GLOBAL_MAX_IN_FLIGHT=3)
+        tickets = [limiter.admit("A"), limiter.admit("A")]
+        with self.assertRaises(Rejected) as caught:
+            limiter.admit("A")
+        self.assertEqual((caught.exception.status, caught.exception.limit), (429, "in_flight"))
+        tickets.append(limiter.admit("B"))
+        with self.assertRaises(Rejected) as caught:
+            limiter.admit("C")
+        self.assertEqual(caught.exception.status, 503)
+        tickets[0].release()
+        tickets[0].release()  # once only
+        self.assertEqual(limiter.houses["A"].in_flight, 1)
+        limiter.admit("A")
+
+    def test_queued_bytes(self):
+        limiter = self.limiter(HOUSE_MAX_QUEUED_BYTES=100)
+        ticket = limiter.admit("A", 80)
+        with self.assertRaises(Rejected) as caught:
+            limiter.admit("A", 30)
+        self.assertEqual(caught.exception.limit, "queued_bytes")
+        ticket.release()
+        # A body over the whole cap still goes through on its own
+        limiter.admit("A", 500)
+        self.assertEqual(limiter.total.queued_bytes, 500)
+
+    def test_rate(self):
+        limiter = self.limiter(HOUSE_RATE=1, HOUSE_BURST=2)
+        limiter.admit("A").release()
+        limiter.admit("A").release()
+        with self.assertRaises(Rejected) as caught:
+            limiter.admit("A")
+        self.assertEqual((caught.exception.limit, caught.exception.retry_after), ("rate", 1))
+
+    def test_disabled(self):
+        self.assertIsNone(self.limiter(ENABLED=False, HOUSE_MAX_IN_FLIGHT=0).admit("A"))
+
+
+class FreshnessTests(SimpleTestCase):
+    config = CACHE_DEFAULTS
+
+    def test_private_and_uncacheable_responses(self):
+        for headers in ({"Set-Cookie": "sid=1", "Cache-Control": "max-age=60"},
+                        {"Cache-Control": "private, max-age=60"},
+                        {"Cache-Control": "no-store"},
+                        {"Cache-Control": "max-age=soon"},
+                        {"Expires": "Thu, 01 Jan 1970 00:00:00 GMT"},
+                        {}):
+            with self.subTest(headers=headers):
+                self.assertEqual(freshness("api/items", headers, self.config), 0)
+
+    def test_max_age(self):
+        self.assertEqual(freshness("a.js", {"cache-control": "public, max-age=60"}, self.config), 60)
+        self.assertEqual(freshness("a.js", {"Cache-Control": "max-age=60, s-maxage=5"}, self.config), 5)
+
+    def test_media_defaults(self):
+        self.assertEqual(freshness("cam/index.m3u8", {"Cache-Control": "max-age=60"}, self.config),
+                         self.config["PLAYLIST_TTL"])
+        self.assertEqual(freshness("cam/seg1.ts", {}, self.config), self.config["SEGMENT_TTL"])
+
+
+class FakeStream:
+    """A ResponseStream with a canned body; counts the chunks pulled from it."""
+
+    def __init__(self, chunks, headers=None):
+        self.status = 200
+        self.headers = headers or {"Content-Type": "video/mp2t"}
+        self.agent_timings = {}
+        self.chunks = chunks
+        self.pulled = 0
+        self.closed = False
+
+    async def body(self):
+        for chunk in self.chunks:
+            self.pulled += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class CoalescerTests(SimpleTestCase):
+    def setUp(self):
+        self.streams = []
+
+    def opener(self, chunks, headers=None):
+        async def open_stream():
+            await asyncio.sleep(0)
+            stream = FakeStream(chunks, headers)
+            self.streams.append(stream)
+            return stream
+        return open_stream
+
+    async def read(self, stream):
+        return b"".join([chunk async for chunk in stream.body()])
+
+    async def test_followers_share_the_leaders_stream(self):
+        coalescer = Coalescer()
+        open_stream = self.opener([b"a" * 10, b"b" * 10])
+        (one, leader), (two, follower) = await asyncio.gather(
+            coalescer.fetch("k", open_stream), coalescer.fetch("k", open_stream))
+        self.assertEqual((leader, follower), (True, False))
+        self.assertEqual(await asyncio.gather(self.read(one), self.read(two)), [b"a" * 10 + b"b" * 10] * 2)
+        self.assertEqual(len(self.streams), 1)
+        self.assertEqual(coalescer.inflight, {})
+
+    async def test_lone_reader_pulls_on_demand(self):
+        coalescer = Coalescer()
+        reader, _ = await coalescer.fetch("k", self.opener([b"x" * 1024] * 100))
+        body = reader.body()
+        await body.__anext__()
+        await settle()
+        self.assertEqual(self.streams[0].pulled, 1)
+        self.assertEqual(reader.shared.buffered, 0)
+        await body.aclose()
+        self.assertTrue(self.streams[0].closed)
+
+    async def test_stalled_reader_is_cut_off(self):
+        coalescer = Coalescer(MAX_LAG_BYTES=4096)
+        open_stream = self.opener([b"x" * 1024] * 1000)
+        (slow, _), (fast, _) = await asyncio.gather(
+            coalescer.fetch("k", open_stream), coalescer.fetch("k", open_stream))
+        stalled = slow.body()
+        await stalled.__anext__()
+        with self.assertLogs("tunnel.coalesce"):
+            self.assertEqual(len(await self.read(fast)), 1024 * 1000)
+        self.assertEqual(coalescer.stats["detached"], 1)
+        self.assertEqual(slow.shared.buffered, 0)
+        with self.assertRaises(FellBehind):
+            await stalled.__anext__()
+
+    async def test_readers_within_the_lag_keep_up(self):
+        coalescer = Coalescer(MAX_LAG_BYTES=4096)
+        open_stream = self.opener([b"x" * 1024] * 100)
+        (one, _), (two, _) = await asyncio.gather(
+            coalescer.fetch("k", open_stream), coalescer.fetch("k", open_stream))
+        self.assertEqual(await asyncio.gather(self.read(one), self.read(two)), [b"x" * 1024 * 100] * 2)
+        self.assertEqual(coalescer.stats["detached"], 0)
+        self.assertEqual(self.streams[0].pulled, 100)
+
+    async def test_private_responses_are_not_shared(self):
+        for headers in ({"Set-Cookie": "sessionid=abc"}, {"Cache-Control": "private"}):
+            with self.subTest(headers=headers):
+                self.streams = []
+                coalescer = Coalescer()
+                open_stream = self.opener([b"page"], headers)
+                (one, _), (two, _) = await asyncio.gather(
+                    coalescer.fetch("k", open_stream), coalescer.fetch("k", open_stream))
+                self.assertEqual(len(self.streams), 2)
+                self.assertIs(two, self.streams[1])
+                self.assertEqual(coalescer.stats["reissued"], 1)
+                self.assertEqual(coalescer.inflight, {})
+                self.assertEqual(await self.read(one), b"page")
+
+    async def test_failed_open_reaches_every_waiter(self):
+        coalescer = Coalescer()
+
+        async def open_stream():
+            await asyncio.sleep(0)
+            raise TimeoutError()
+        results = await asyncio.gather(coalescer.fetch("k", open_stream), coalescer.fetch("k", open_stream),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(r, TimeoutError) for r in results))
+        self.assertEqual(coalescer.inflight, {})
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        presence._presence.clear()
+        presence._writes.clear()
+        self.addCleanup(presence._presence.clear)
+        self.addCleanup(presence._writes.clear)
+        user = Clients.objects.create(email="owner@example.com", userid="owner", password="x")
+        self.house = HouseTunnel.objects.create(user=user, house_id="ABC123", secret_key="x")
+
+    def tearDown(self):
+        if presence._flusher:
+            presence._flusher.cancel()
+
+    async def test_offline_answer_expires(self):
+        now = presence.time.monotonic()
+        self.assertFalse(await presence.is_online("ABC123"))
+        await HouseTunnel.objects.filter(pk=self.house.pk).aupdate(connected=True)
+        self.assertFalse(await presence.is_online("ABC123"))
+        with mock.patch.object(presence.time, "monotonic", return_value=now + presence.OFFLINE_TTL + 1):
+            self.assertTrue(await presence.is_online("ABC123"))
+
+    async def test_expired_entries_are_swept(self):
+        now = presence.time.monotonic()
+        for i in range(100):
+            presence._remember(f"GONE{i:02}", False)
+        later = now + presence.PRESENCE_TTL + 1
+        with mock.patch.object(presence.time, "monotonic", return_value=later):
+            self.assertFalse(await presence.is_online("ZZZ999"))
+        self.assertEqual(list(presence._presence), ["ZZZ999"])
+
+    async def test_flush_writes_the_latest_state_once(self):
+        rows = presence.write_stats["rows"]
+        await presence.mark_online("ABC123")
+        await presence.mark_offline("ABC123")
+        await presence.mark_online("ABC123")
+        self.assertEqual(presence._writes, {"ABC123": True})
+        await presence.flush()
+        self.assertEqual(presence._writes, {})
+        self.assertEqual(presence.write_stats["rows"], rows + 1)
+        self.assertTrue((await HouseTunnel.objects.aget(pk=self.house.pk)).connected)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class PoolTests(TestCase):
+    def setUp(self):
+        presence._presence.clear()
+        self.addCleanup(presence._presence.clear)
+        self.addCleanup(presence._writes.clear)
+        self.addCleanup(local_tunnels.clear)
+        get_channel_layer().groups.clear()  # left over by earlier tests' connections
+        user = Clients.objects.create(email="owner@example.com", userid="owner", password="x")
+        HouseTunnel.objects.create(user=user, house_id="ABC123", secret_key="x")
+
+    def tearDown(self):
+        if presence._flusher:
+            presence._flusher.cancel()
+
+    async def connect(self, connection):
+        agent = WebsocketCommunicator(TunnelConsumer.as_asgi(), "/ws/tunnel/")
+        with self.assertLogs("tunnel.consumers"):
+            await agent.connect()
+        await agent.send_to(text_data=json.dumps({
+            "action": "authenticate", "house_id": "ABC123", "connection": connection,
+            "auth_hash": hashlib.sha256(b"ABC123x").hexdigest()}))
+        self.assertEqual(json.loads(await agent.receive_from())["status"], "ok")
+        return agent
+
+    def group(self):
+        return set(get_channel_layer().groups.get("house_ABC123", {}))
+
+    def online(self):
+        return presence._presence["ABC123"][0]
+
+    async def test_only_the_primary_joins_the_group(self):
+        await self.connect(0)
+        await self.connect(1)
+        first, second = local_tunnels["ABC123"]
+        self.assertEqual((first.primary, second.primary), (True, False))
+        self.assertEqual(self.group(), {first.channel_name})
+
+    async def test_secondary_elsewhere_leaving_keeps_the_house_online(self):
+        primary = await self.connect(0)
+        here = local_tunnels.pop("ABC123")  # the rest of the pool lands on another worker
+        secondary = await self.connect(1)
+        await secondary.disconnect()
+        local_tunnels["ABC123"] = here
+        self.assertTrue(self.online())
+        self.assertEqual(self.group(), {here[0].channel_name})
+        await primary.disconnect()
+        self.assertFalse(self.online())
+
+    async def test_sibling_takes_over_from_a_departed_primary(self):
+        primary = await self.connect(0)
+        await self.connect(1)
+        sibling = local_tunnels["ABC123"][1]
+        await primary.disconnect()
+        self.assertTrue(sibling.primary)
+        self.assertEqual(self.group(), {sibling.channel_name})
+        self.assertTrue(self.online())
+        await self.connect(0)
+        returned = local_tunnels["ABC123"][1]
+        self.assertEqual((sibling.primary, returned.primary), (False, True))
+        self.assertEqual(self.group(), {returned.channel_name})
+
+    async def test_out_of_range_connection_is_refused(self):
+        agent = WebsocketCommunicator(TunnelConsumer.as_asgi(), "/ws/tunnel/")
+        with self.assertLogs("tunnel.consumers"):
+            await agent.connect()
+            await agent.send_to(text_data=json.dumps({"action": "authenticate", "house_id": "ABC123",
+                                                      "connection": 99, "auth_hash": ""}))
+            self.assertEqual((await agent.receive_output())["code"], 1008)
+
+
+class RecordingConsumer:
+    """Stands in for the TunnelConsumer a local ResponseStream notifies."""
+
+    stream_window = None
+
+    def __init__(self):
+        self.events = []
+
+    async def tunnel_cancel(self, event):
+        self.events.append(event)
+
+    async def window_update(self, event):
+        self.events.append(event)
+
+
+class CancellationTests(SimpleTestCase):
+    def stream(self, *frames, status=200, headers=None):
+        self.consumer = RecordingConsumer()
+        stream = ResponseStream(REQ_ID, "ABC123", consumer=self.consumer)
+        stream.feed({"action": "http_response_start", "id": REQ_ID, "status": status, "headers": headers or {}})
+        for frame in frames:
+            stream.feed({"id": REQ_ID, **frame})
+        return stream
+
+    async def test_stream_closed_early_cancels_the_request(self):
+        stream = self.stream({"action": "http_response_chunk", "body": "part"})
+        await stream.wait_head(1)
+        body = stream.body()
+        self.assertEqual(await body.__anext__(), b"part")
+        await body.aclose()
+        await settle()
+        self.assertEqual(self.consumer.events, [{"type": "tunnel.cancel", "id": REQ_ID}])
+
+    async def test_finished_stream_is_not_cancelled(self):
+        stream = self.stream({"action": "http_response_chunk", "body": "all"}, {"action": "http_response_end"})
+        await stream.wait_head(1)
+        self.assertEqual([chunk async for chunk in stream.body()], [b"all"])
+        await settle()
+        self.assertEqual(self.consumer.events, [])
+
+    async def test_redirect_is_not_counted_as_cancelled(self):
+        stream = self.stream({"action": "http_response_chunk", "body": "Moved"}, {"action": "http_response_end"},
+                             status=302, headers={"Location": "/next"})
+
+        async def send_and_wait(house_id, frame, body=None, trace=None):
+            await stream.wait_head(1)
+            return stream
+        with mock.patch("tunnel.views.presence.is_online", mock.AsyncMock(return_value=True)), \
+                mock.patch("tunnel.views.send_and_wait", send_and_wait), self.assertLogs("tunnel"):
+            response = await self.async_client.post("/homes/ABC123/login")
+        await settle()
+        self.assertEqual((response.status_code, response["Location"]), (302, "/homes/ABC123/next"))
+        self.assertEqual(self.consumer.events, [])
+
+    async def test_consumer_counts_cancels_and_bytes_saved(self):
+        consumer = TunnelConsumer()
+        consumer.accept, consumer.send = mock.AsyncMock(), mock.AsyncMock()
+        with self.assertLogs("tunnel.consumers"):
+            await consumer.connect()
+        consumer.house_id, consumer.cancellation = "CANCEL", True
+        consumer.track(REQ_ID, 8192)
+        self.addCleanup(cancel_stats.pop, "CANCEL", None)
+        await consumer.tunnel_cancel({"type": "tunnel.cancel", "id": REQ_ID})
+        self.assertEqual(consumer.outstanding_bytes, 0)
+        consumer.send.assert_awaited_once_with(text_data=json.dumps({"action": "cancel", "id": REQ_ID}))
+        await consumer.receive(text_data=json.dumps({"action": "http_response_end", "id": REQ_ID,
+                                                     "cancelled": True, "bytes_saved": 4096}))
+        self.assertEqual(cancel_stats["CANCEL"], {"cancelled": 1, "bytes_saved": 4096})
+
+
+class TracesViewTests(SimpleTestCase):
+    def get(self, query):
+        request = RequestFactory().get("/api/admin/traces/", query)
+        request.user = mock.Mock(is_active=True, is_staff=True)
+        return views.traces(request)
+
+    def test_limit_is_clamped_to_the_buffer(self):
+        with mock.patch.object(tracing, "traces", [{"house_id": "ABC123"}] * 5), \
+                mock.patch.dict(tracing.config, BUFFER_SIZE=3):
+            self.assertEqual(len(json.loads(self.get({"limit": "50"}).content)["traces"]), 3)
+            self.assertEqual(len(json.loads(self.get({"limit": "-2"}).content)["traces"]), 1)
+
+    def test_bad_limit_is_rejected(self):
+        self.assertEqual(self.get({"limit": "lots"}).status_code, 400)
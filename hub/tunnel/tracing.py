@@ -0,0 +1,128 @@
+import random
+import time
+from collections import deque
+from django.conf import settings
+
+DEFAULTS = {
+    "SAMPLE_RATE": 0.01,      # share of requests kept in the ring buffer
+    "BUFFER_SIZE": 1000,      # traces kept, newest replace oldest
+    "SERVER_TIMING": False,   # add a Server-Timing header to every proxied response
+}
+
+config = {**DEFAULTS, **getattr(settings, "TUNNEL_TRACING", {})}
+
+# Finished sampled traces, oldest first
+traces = deque(maxlen=config["BUFFER_SIZE"])
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Trace:
+    """
+    Timing of one proxied request across the hub, the channel layer, the
+    websocket and the agent.
+
+    Hub stages are measured with the monotonic clock. Hops between machines
+    (view → consumer → agent → hub) compare wall-clock stamps carried in the
+    frames, so they are only as accurate as the clocks are in sync.
+    """
+
+    def __init__(self, trace_id, house_id, method, path, sampled):
+        self.id = trace_id
+        self.house_id = house_id
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.marks = {}      # stage → ms since t0
+        self.agent = {}      # timings reported by the agent
+        self.head_at = None  # wall clock when the response head arrived
+
+    def mark(self, stage):
+        self.marks[stage] = _ms(time.perf_counter() - self.t0)
+
+    def context(self):
+        """
+        The trace object embedded in the proxy_request frame.
+        """
+        return {"id": self.id, "sent": time.time()}
+
+    def head(self, agent_timings):
+        self.mark("head")
+        self.head_at = time.time()
+        self.agent.update(agent_timings or {})
+
+    def breakdown(self):
+        """
+        Milliseconds spent per stage, in request order.
+        """
+        m, a = self.marks, self.agent
+        stages = {"presence": m.get("presence")}
+        if "sent" in m:
+            stages["dispatch"] = round(m["sent"] - m.get("presence", 0), 3)
+        if "forwarded" in a and "sent" in a:
+            stages["channel_layer"] = _ms(a["forwarded"] - a["sent"])
+        if "received" in a and "forwarded" in a:
+            stages["ws_to_agent"] = _ms(a["received"] - a["forwarded"])
+        for key in ("queue_ms", "connect_ms", "ttfb_ms"):
+            if key in a:
+                stages[f"agent_{key[:-3]}"] = a[key]
+        if "head_sent" in a and self.head_at:
+            stages["ws_to_hub"] = _ms(self.head_at - a["head_sent"])
+        if "head" in m:
+            stages["head"] = m["head"]
+        if "end" in m and "head" in m:
+            stages["body"] = round(m["end"] - m["head"], 3)
+        for key in ("body_read_ms", "encode_ms"):
+            if key in a:
+                stages[f"agent_{key[:-3]}"] = a[key]
+        if "end" in m:
+            stages["total"] = m["end"]
+        return {k: v for k, v in stages.items() if v is not None}
+
+    def server_timing(self):
+        """
+        The stages known once the head arrived, as a Server-Timing header value.
+        """
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.breakdown().items())
+
+    def finish(self, status, agent_timings=None):
+        self.mark("end")
+        self.agent.update(agent_timings or {})
+        if self.sampled:
+            traces.append({
+                "id": self.id,
+                "house_id": self.house_id,
+                "method": self.method,
+                "path": self.path,
+                "status": status,
+                "started_at": self.started_at,
+                "stages_ms": self.breakdown(),
+            })
+
+
+def start(house_id, method, path, trace_id):
+    """
+    Returns a Trace for a request when it is sampled or Server-Timing is on,
+    else None.
+    """
+    sampled = random.random() < config["SAMPLE_RATE"]
+    if not sampled and not config["SERVER_TIMING"]:
+        return None
+    return Trace(trace_id, house_id, method, path, sampled)
+
+
+def recent(house_id=None, limit=100):
+    """
+    Newest sampled traces first, optionally for one house.
+    """
+    out = []
+    for trace in reversed(traces):
+        if house_id is None or trace["house_id"] == house_id:
+            out.append(trace)
+            if len(out) >= limit:
+                break
+    return out
@@ -1,25 +1,408 @@
 import asyncio
+import base64
+import logging
+import time
+from collections import defaultdict, deque
+from channels.exceptions import ChannelFull
 from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics, protocol
+from .logs import kv
 
-# Frame → Future registry
+logger = logging.getLogger(__name__)
+
+# Request bodies up to this size travel inline in the proxy_request frame;
+# larger ones are streamed to the agent in chunks of this size
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Frame id → ResponseStream registry of the streams open in this process
 pending_responses = {}
 
-async def send_and_wait(house_id, frame, timeout=15):
+# house_id → TunnelConsumers holding that house's websockets in this process
+# (an agent may keep a pool of connections; see pick_tunnel)
+local_tunnels = {}
+
+# Requests for paths like these, or with a Range header, are bulk transfers
+# and go to the agent's bulk connections
+BULK_SUFFIXES = ('.ts', '.m4s', '.mp4', '.webm', '.mkv', '.mov', '.aac', '.mp3')
+
+# How send_and_wait reached the house: directly ("local") or via the channel layer ("remote")
+dispatch_counts = {"local": 0, "remote": 0}
+
+# house_id → requests cancelled because the client went away or timed out,
+# and the response bytes the agent did not have to send
+cancel_stats = defaultdict(lambda: {"cancelled": 0, "bytes_saved": 0})
+
+# Authentications in progress in this process, and those turned away
+# because too many were (see TunnelConsumer.receive)
+auth_admission = {"active": 0, "peak": 0, "admitted": 0, "rejected": 0}
+
+# house_id → tunnel compression totals, as seen by this process
+compression_stats = defaultdict(lambda: {
+    "frames": 0, "raw_bytes": 0, "wire_bytes": 0, "agent_cpu_ms": 0.0, "hub_cpu_ms": 0.0,
+})
+
+
+def decode_body(data, house_id=None):
+    """
+    Returns the body carried by a response frame as bytes, decompressing it
+    when the agent compressed it.
+    """
+    body = data.get("body", b"")
+    if data.get("is_base64"):
+        body = base64.b64decode(body)
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    method = data.get("compression")
+    if method:
+        started = time.process_time()
+        body = protocol.decompress(body, method)
+        stats = compression_stats[house_id]
+        stats["frames"] += 1
+        stats["hub_cpu_ms"] += (time.process_time() - started) * 1000
+    return body
+
+
+async def send_patiently(channel, message, timeout=15):
     """
-    Send 'frame' to the WebSocket group for house_id,
-    wait for a matching response (frame.id) in pending_responses.
+    Sends a message to a single channel, retrying while it is full (slow
+    peer) until timeout. Returns False when the message had to be dropped.
     """
     channel_layer = get_channel_layer()
-    future = asyncio.get_event_loop().create_future()
-    pending_responses[frame["id"]] = future
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await channel_layer.send(channel, message)
+            return True
+        except ChannelFull:
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+
+def compression_report():
+    """
+    Per-house compression ratio and CPU time.
+    """
+    return {
+        house_id: {**stats, "ratio": round(stats["raw_bytes"] / stats["wire_bytes"], 3)
+                   if stats["wire_bytes"] else None}
+        for house_id, stats in compression_stats.items()
+    }
+
+
+def collect_metrics():
+    """
+    Scrape-time samples of this module's registries and counters.
+    """
+    yield ("tunnel_pending_responses", "gauge", "Response streams open in this process.",
+           [({}, len(pending_responses))])
+    yield ("tunnel_local_tunnels", "gauge", "Tunnel websockets held by this process.",
+           [({}, sum(len(consumers) for consumers in local_tunnels.values()))])
+    yield ("tunnel_dispatch_total", "counter", "send_and_wait calls by route.",
+           [({"route": route}, count) for route, count in dispatch_counts.items()])
+    for key, name, help in (
+        ("raw_bytes", "tunnel_compression_raw_bytes_total", "Body bytes before tunnel compression."),
+        ("wire_bytes", "tunnel_compression_wire_bytes_total", "Body bytes after tunnel compression."),
+    ):
+        yield (name, "counter", help,
+               [({"house": house}, stats[key]) for house, stats in compression_stats.items()])
+    for key, name, help in (
+        ("agent_cpu_ms", "tunnel_compression_agent_cpu_seconds_total", "Agent CPU spent compressing."),
+        ("hub_cpu_ms", "tunnel_compression_hub_cpu_seconds_total", "Hub CPU spent decompressing."),
+    ):
+        yield (name, "counter", help,
+               [({"house": house}, stats[key] / 1000) for house, stats in compression_stats.items()])
+    yield ("tunnel_authenticating", "gauge", "Tunnel authentications in progress.",
+           [({}, auth_admission["active"])])
+    yield ("tunnel_auth_total", "counter", "Tunnel authentications admitted or rejected as busy.",
+           [({"result": "admitted"}, auth_admission["admitted"]),
+            ({"result": "rejected"}, auth_admission["rejected"])])
+    yield ("tunnel_cancelled_total", "counter", "Requests cancelled because the client went away.",
+           [({"house": house}, stats["cancelled"]) for house, stats in cancel_stats.items()])
+    yield ("tunnel_cancel_bytes_saved_total", "counter", "Response bytes agents did not send after a cancel.",
+           [({"house": house}, stats["bytes_saved"]) for house, stats in cancel_stats.items()])
+
+
+metrics.register_collector(collect_metrics)
+
+
+def is_bulk(frame):
+    """
+    Whether a proxy_request frame is a media transfer rather than interactive traffic.
+    """
+    if any(k.lower() == "range" for k in frame.get("headers", {})):
+        return True
+    return frame.get("path", "").split("?", 1)[0].lower().endswith(BULK_SUFFIXES)
+
+
+def pick_tunnel(house_id, frame):
+    """
+    Chooses which of the house's connections in this process carries a
+    request: one of the lane the request belongs to (bulk or interactive)
+    when the agent has one, with the fewest response bytes outstanding.
+
+    Returns the TunnelConsumer, or None when this process holds none.
+    """
+    consumers = local_tunnels.get(house_id)
+    if not consumers:
+        return None
+    if len(consumers) == 1:
+        return consumers[0]
+    lane = "bulk" if is_bulk(frame) else "interactive"
+    preferred = [c for c in consumers if c.lane in (lane, None)] or consumers
+    return min(preferred, key=lambda c: c.outstanding_bytes)
 
-    await channel_layer.group_send(
-        f"house_{house_id}",
-        {"type": "forward.http", "frame": frame}
-    )
+
+def cancel_report():
+    """
+    Per-house cancelled requests and response bytes saved.
+    """
+    return {house_id: dict(stats) for house_id, stats in cancel_stats.items()}
+
+
+class ResponseStream:
+    """
+    Response to a proxied frame. The consumer holding the house's websocket
+    routes the agent's `http_response_start` / `http_response_chunk` /
+    `http_response_end` frames to this stream's reply channel on the channel
+    layer, so the consumer and the waiting view may live in different workers.
+
+    When the consumer lives in this process the stream is local: it has no
+    reply channel and the consumer feeds it directly.
+
+    With flow control negotiated the agent may only send `window` body bytes
+    the stream has not handed on yet; body() grants more credit as the client
+    consumes chunks. Uploads are bounded the same way by the agent's credit.
+
+    A stream closed before its end frame (client gone, timeout) tells the
+    agent to cancel the request.
+    """
+
+    def __init__(self, frame_id, house_id=None, reply_channel=None, consumer=None):
+        self.id = frame_id
+        self.house_id = house_id
+        self.reply_channel = reply_channel
+        self.local = reply_channel is None
+        self.queue = asyncio.Queue() if self.local else None
+        self.buffer = deque()
+        self.status = None
+        self.headers = {}
+        self.consumer = consumer          # local TunnelConsumer
+        self.consumer_channel = None      # channel name of a remote TunnelConsumer
+        self.window = None                # response credit window, None without flow control
+        self.unacked = 0                  # bytes consumed since the last window_update
+        self.ended = False                # end frame seen
+        self.closed = False
+        self.agent_timings = {}           # trace timings reported by the agent
+        self.upload = None                # task streaming the request body to the agent
+        self.upload_window = consumer.stream_window if consumer else None
+        self.upload_outstanding = 0       # uploaded bytes the agent has not credited back
+        self.upload_changed = asyncio.Event()
+        self.body_channel = None if self.local else asyncio.get_running_loop().create_future()
+
+    def feed(self, data):
+        self.queue.put_nowait(data)
+
+    async def next_frame(self, timeout):
+        while not self.buffer:
+            if self.local:
+                data = await asyncio.wait_for(self.queue.get(), timeout)
+            else:
+                message = await asyncio.wait_for(
+                    get_channel_layer().receive(self.reply_channel), timeout
+                )
+                data = message["frame"]
+            action = data.get("action")
+            if action == "request_body_ready":
+                # The consumer holding the websocket tells us where to send the body
+                self.consumer_channel = data["channel"]
+                self.upload_window = data.get("window")
+                if not self.body_channel.done():
+                    self.body_channel.set_result(data["channel"])
+            elif action == "window_update":
+                # The agent consumed part of the uploaded body
+                if data.get("close"):
+                    self.upload_outstanding = 0
+                else:
+                    self.upload_outstanding -= data.get("credit", 0)
+                self.upload_changed.set()
+                self.upload_changed = asyncio.Event()
+            elif action == "http_response":
+                # Single-frame response from an agent that does not stream
+                self.buffer.extend((
+                    {**data, "action": "http_response_start"},
+                    {**data, "action": "http_response_chunk"},
+                    {"action": "http_response_end", "id": data.get("id")},
+                ))
+            else:
+                self.buffer.append(data)
+        return self.buffer.popleft()
+
+    async def wait_head(self, timeout):
+        data = await self.next_frame(timeout)
+        self.status = data.get("status", 200)
+        self.headers = data.get("headers", {})
+        self.window = data.get("window")
+        self.consumer_channel = data.get("channel", self.consumer_channel)
+        self.agent_timings.update(data.get("trace") or {})
+
+    async def body(self, timeout=15):
+        """
+        Yields the body chunks as bytes until the end frame arrives.
+        """
+        try:
+            while True:
+                data = await self.next_frame(timeout)
+                if data.get("action") == "http_response_end":
+                    self.ended = True
+                    self.agent_timings.update(data.get("trace") or {})
+                    if data.get("error"):
+                        logger.warning("⚠️ Agent aborted stream",
+                                       extra=kv(house=self.house_id, id=self.id, error=data["error"]))
+                    if data.get("compression"):
+                        self.account_compression(data["compression"])
+                    return
+                chunk = decode_body(data, self.house_id)
+                if chunk:
+                    yield chunk
+                    # The client took the chunk; let the agent send more
+                    await self.grant(len(chunk))
+        finally:
+            self.close()
+
+    async def grant(self, size):
+        """
+        Counts consumed body bytes and returns them to the agent as credit
+        once half the window has been consumed.
+        """
+        if not self.window:
+            return
+        self.unacked += size
+        if self.unacked >= self.window // 2:
+            credit, self.unacked = self.unacked, 0
+            await self.window_update(credit)
+
+    async def window_update(self, credit, close=False):
+        await self.notify({"type": "window.update", "id": self.id, "credit": credit, "close": close})
+
+    async def notify(self, event):
+        """
+        Sends a channel event about this stream to the consumer holding the tunnel.
+        """
+        try:
+            if self.consumer is not None:
+                await getattr(self.consumer, event["type"].replace(".", "_"))(event)
+            elif self.consumer_channel:
+                await send_patiently(self.consumer_channel, event)
+            else:
+                # Head not seen yet, so we do not know which consumer holds the tunnel
+                await get_channel_layer().group_send(f"house_{self.house_id}", event)
+        except Exception as exc:
+            logger.warning(f"⚠️ {event['type']} failed", extra=kv(house=self.house_id, id=self.id, error=repr(exc)))
+
+    def account_compression(self, report):
+        stats = compression_stats[self.house_id]
+        stats["raw_bytes"] += report.get("raw_bytes", 0)
+        stats["wire_bytes"] += report.get("wire_bytes", 0)
+        stats["agent_cpu_ms"] += report.get("cpu_ms", 0.0)
+
+    def close(self):
+        pending_responses.pop(self.id, None)
+        if self.upload and not self.upload.done():
+            self.upload.cancel()
+        if self.closed:
+            return
+        self.closed = True
+        if not self.ended:
+            # Nobody will read the rest: stop the agent working on it
+            event = {"type": "tunnel.cancel", "id": self.id}
+        elif self.window:
+            # Release what is left of this stream from the tunnel window
+            event = {"type": "window.update", "id": self.id, "credit": self.unacked, "close": True}
+        else:
+            return
+        asyncio.get_running_loop().create_task(self.notify(event))
+
+    async def upload_credit(self, size, timeout):
+        """
+        Waits until the agent's window has room for `size` more body bytes.
+        """
+        while (self.upload_window and self.upload_outstanding
+               and self.upload_outstanding + size > self.upload_window):
+            await asyncio.wait_for(self.upload_changed.wait(), timeout)
+        self.upload_outstanding += size
+
+    async def send_body(self, body, timeout=15):
+        """
+        Streams an async iterator of request body chunks to the consumer
+        holding the house's websocket, followed by an end marker (None).
+        """
+        async def send(event):
+            if self.consumer is not None:
+                await self.consumer.forward_body(event)
+            elif not await send_patiently(channel, event, timeout):
+                raise TimeoutError("tunnel consumer is not reading the request body")
+
+        try:
+            if self.consumer is None:
+                channel = await asyncio.wait_for(asyncio.shield(self.body_channel), timeout)
+            async for chunk in body:
+                await self.upload_credit(len(chunk), timeout)
+                await send({"type": "forward.body", "id": self.id, "body": chunk})
+            await send({"type": "forward.body", "id": self.id, "body": None})
+        except Exception as exc:
+            logger.warning("⚠️ Request body upload failed",
+                           extra=kv(house=self.house_id, id=self.id, error=repr(exc)))
+
+
+async def send_and_wait(house_id, frame, timeout=15, body=None, trace=None):
+    """
+    Send 'frame' to the house and wait for the response head
+    (status + headers) of the matching stream (frame.id).
+
+    If this process holds the house's websocket the frame is handed to the
+    consumer directly (the least loaded of its pool, see pick_tunnel) and the response is fed straight into the stream.
+    Otherwise the frame goes to the house's group on the channel layer and
+    the response is routed back over a reply channel created for this
+    request, so any worker may hold the house's websocket.
+
+    When 'body' (an async iterator of bytes) is given, the frame is marked
+    `body_stream` and the chunks are sent after it while the head is awaited,
+    so the agent can start uploading to the local server before the hub has
+    read the whole request.
+
+    'trace' (tracing.Trace) gets the moment the frame was handed off marked.
+
+    Returns the ResponseStream; the caller consumes its body() and the
+    stream unregisters itself once the body is exhausted or closed.
+    """
+    if body is not None:
+        frame = {**frame, "body_stream": True}
+    consumer = pick_tunnel(house_id, frame)
+    if consumer and getattr(settings, "TUNNEL_LOCAL_FASTPATH", True):
+        dispatch_counts["local"] += 1
+        stream = ResponseStream(frame["id"], house_id, consumer=consumer)
+        pending_responses[frame["id"]] = stream
+        send = consumer.forward_http({"type": "forward.http", "frame": frame})
+    else:
+        dispatch_counts["remote"] += 1
+        channel_layer = get_channel_layer()
+        stream = ResponseStream(frame["id"], house_id, await channel_layer.new_channel())
+        pending_responses[frame["id"]] = stream
+        send = channel_layer.group_send(
+            f"house_{house_id}",
+            {"type": "forward.http", "frame": frame, "reply_channel": stream.reply_channel}
+        )
 
     try:
-        response = await asyncio.wait_for(future, timeout)
-        return response
-    finally:
-        pending_responses.pop(frame["id"], None)
+        await send
+        if trace:
+            trace.mark("sent")
+        if body is not None:
+            stream.upload = asyncio.create_task(stream.send_body(body, timeout))
+        await stream.wait_head(timeout)
+    except BaseException:
+        stream.close()
+        raise
+    return stream
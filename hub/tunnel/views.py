@@ -1,16 +1,27 @@
-import hashlib, uuid, json
+import asyncio, hashlib, logging, time, uuid, json
+from django.conf import settings
 from django.utils import timezone
-from django.http import JsonResponse, StreamingHttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse, HttpResponseRedirect
 from .models import HouseTunnel, RegistrationToken, Clients
-from .utils import send_and_wait
+from .utils import send_and_wait, compression_report, cancel_report, is_bulk, BODY_CHUNK_SIZE
+from .cache import response_cache
+from .coalesce import coalescer
+from .limits import limiter, Rejected
+from . import metrics, presence, tracing
+from .logs import kv, summarize
 from django.views.decorators.csrf import csrf_exempt
-from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
 from rest_framework.response import Response
 from django.utils import timezone
 from datetime import timedelta
 import secrets
-import base64
-import traceback
+
+logger = logging.getLogger(__name__)
+
+# Queued bytes charged to an upload of unknown length: what one request may
+# have on its way through the tunnel at once
+UNKNOWN_UPLOAD_BYTES = (getattr(settings, "TUNNEL_FLOW_CONTROL", None) or {}).get(
+    "STREAM_WINDOW", BODY_CHUNK_SIZE)
 
 
 @csrf_exempt
@@ -52,45 +63,203 @@ def register_or_get_id(request):
     })
 
 
+def build_response(status, resp_headers, body):
+    """
+    Wraps a proxied response (head + async body iterator) for Django.
+    """
+    content_type = resp_headers.get('Content-Type', 'application/octet-stream')
+    resp = StreamingHttpResponse(body, status=status, content_type=content_type)
+
+    # Set important headers
+    for k, v in resp_headers.items():
+        if k.lower() not in {'content-encoding', 'transfer-encoding', 'connection'}:
+            resp[k] = v
+
+    # Ensure HLS CORS support
+    resp["Access-Control-Allow-Origin"] = "*"
+    resp["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+    resp["Access-Control-Allow-Headers"] = "*"
+    return resp
+
+
+async def cached_body(cached):
+    yield await cached.read()
+
+
+async def request_body(request, house_id):
+    """
+    Yields the request body in BODY_CHUNK_SIZE pieces. Requests of the ASGI
+    proxy route (see asgi.py) stream it from the client as it arrives.
+    """
+    if hasattr(request, "body_chunks"):
+        async for chunk in request.body_chunks():
+            metrics.BYTES.inc(house_id, "in", amount=len(chunk))
+            yield chunk
+        return
+    while True:
+        chunk = request.read(BODY_CHUNK_SIZE)
+        if not chunk:
+            return
+        metrics.BYTES.inc(house_id, "in", amount=len(chunk))
+        yield chunk
+
+
+def log_request(request, house_id, path, status, started, sent=0):
+    """
+    One summary line per proxied request.
+    """
+    logger.info("request", extra=kv(
+        house=house_id, method=request.method, path=path, status=status, bytes=sent,
+        ms=round((time.perf_counter() - started) * 1000, 1),
+    ))
+
+
+async def metered(body, house_id, started, finish=None):
+    """
+    Relays a response body, recording bytes out, body and total latency,
+    and the end of the request's in-flight time. 'finish' is called with
+    the bytes relayed once the body is done.
+    """
+    relay_started = time.perf_counter()
+    sent = 0
+    try:
+        async for chunk in body:
+            metrics.BYTES.inc(house_id, "out", amount=len(chunk))
+            sent += len(chunk)
+            yield chunk
+    except asyncio.TimeoutError:
+        metrics.TIMEOUTS.inc(house_id, "body")
+        raise
+    finally:
+        now = time.perf_counter()
+        metrics.IN_FLIGHT.dec(house_id)
+        metrics.LATENCY.observe(now - relay_started, house_id, "body")
+        metrics.LATENCY.observe(now - started, house_id, "total")
+        if finish:
+            finish(sent)
+
+
 @csrf_exempt
 async def proxy_to_home(request, house_id, path):
     try:
-        print(f"entered view proxy → house_id={house_id!r}, path={path!r}")
+        started = time.perf_counter()
+        ticket = None
+        stream = None  # until its body is handed to the response
+        house_label = metrics.OFFLINE_HOUSE  # until presence confirms the house
+        frame_id = str(uuid.uuid4())
+        trace = tracing.start(house_id, request.method, path,
+                              request.headers.get('X-Request-ID') or frame_id)
 
-        # 1) Find connected tunnel
-        tunnel = await sync_to_async(
-            HouseTunnel.objects.filter(house_id=house_id, connected=True).first
-        )()
-        if not tunnel:
+        # 1) Check the house is online (cached; see presence.py)
+        if not await presence.is_online(house_id):
+            metrics.REQUESTS.inc(house_label, metrics.method_label(request.method), 503)
+            log_request(request, house_id, path, 503, started)
             return JsonResponse({'error': 'home offline'}, status=503)
+        house_label = house_id
+        metrics.LATENCY.observe(time.perf_counter() - started, house_id, "presence")
+        if trace:
+            trace.mark("presence")
 
         # 2) Prepare headers
         headers = dict(request.headers)
+        # Hop-by-hop: the tunnel frames the body itself, and the agent's
+        # client sets its own when it streams the body on
+        headers.pop('Transfer-Encoding', None)
         if request.COOKIES:
             headers['Cookie'] = "; ".join(f"{k}={v}" for k, v in request.COOKIES.items())
         if 'Range' in request.headers:
             headers['Range'] = request.headers['Range']
 
-        # 3) Build frame
+        # 3) Serve from the response cache when possible
+        cacheable = response_cache.cacheable_request(request.method, headers)
+        if cacheable:
+            cached = await response_cache.get(house_id, request.method, path, headers)
+            if cached:
+                metrics.REQUESTS.inc(house_id, metrics.method_label(request.method), cached.status)
+                metrics.BYTES.inc(house_id, "out", amount=cached.size)
+                metrics.LATENCY.observe(time.perf_counter() - started, house_id, "total")
+                if trace:
+                    trace.finish(cached.status)
+                log_request(request, house_id, path, cached.status, started, cached.size)
+                resp = build_response(cached.status, cached.headers, cached_body(cached))
+                resp["X-Cache"] = "HIT"
+                return resp
+
+        # 4) Admission limits: turn away what the house (or the hub) cannot take now
+        length = (request.META.get('CONTENT_LENGTH') or '0').strip()
+        if not length.isdigit():
+            metrics.REQUESTS.inc(house_id, metrics.method_label(request.method), 400)
+            if trace:
+                trace.finish(400)
+            log_request(request, house_id, path, 400, started)
+            return JsonResponse({'error': 'invalid Content-Length'}, status=400)
+        size = int(length)
+        streamed = size > BODY_CHUNK_SIZE or getattr(request, "streams_body", False)
+        if streamed and not size:
+            size = UNKNOWN_UPLOAD_BYTES
+        try:
+            ticket = limiter.admit(house_id, size)
+        except Rejected as exc:
+            metrics.REQUESTS.inc(house_id, metrics.method_label(request.method), exc.status)
+            if trace:
+                trace.finish(exc.status)
+            log_request(request, house_id, path, exc.status, started)
+            resp = JsonResponse({'error': 'too many requests' if exc.status == 429 else 'hub busy',
+                                 'limit': exc.limit}, status=exc.status)
+            resp['Retry-After'] = str(exc.retry_after)
+            return resp
+
+        # 5) Build frame
         frame = {
             'action':  'proxy_request',
-            'id':      str(uuid.uuid4()),
+            'id':      frame_id,
             'method':  request.method,
             'path':    path,
             'headers': headers,
-            'body':    request.body.decode('utf-8', 'ignore'),
         }
-        print(" → Sending frame:", frame)
+        # The agent schedules bulk transfers behind interactive requests
+        frame['priority'] = "bulk" if is_bulk(frame) else "interactive"
+        # Small bodies ride inline; larger ones are streamed after the frame
+        upload = None
+        if streamed:
+            upload = request_body(request, house_id)
+        else:
+            # Raw bytes; the consumer encodes them for the agent's codec
+            frame['body'] = request.body
+            metrics.BYTES.inc(house_id, "in", amount=len(request.body))
+        if trace:
+            frame['trace'] = trace.context()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("→ Sending frame", extra=kv(house=house_id, frame=summarize(frame)))
 
-        # 4) Send & wait
-        response = await send_and_wait(house_id, frame)
-        print(" ← Got response:", {k: response.get(k) for k in ('status','headers','is_base64')})
+        # 6) Send & wait for the response head; identical concurrent requests
+        #    share one tunnel round trip (see coalesce.py)
+        leader = True
+        coalesce_key = coalescer.key(house_id, request.method, path, headers)
+        head_started = time.perf_counter()
+        metrics.IN_FLIGHT.inc(house_id)
+        try:
+            if coalesce_key:
+                stream, leader = await coalescer.fetch(
+                    coalesce_key, lambda: send_and_wait(house_id, frame, body=upload, trace=trace)
+                )
+            else:
+                stream = await send_and_wait(house_id, frame, body=upload, trace=trace)
+        except BaseException:
+            metrics.IN_FLIGHT.dec(house_id)
+            if ticket:
+                ticket.release()
+            raise
+        metrics.LATENCY.observe(time.perf_counter() - head_started, house_id, "head")
+        logger.debug("← Got response head", extra=kv(house=house_id, id=frame_id, status=stream.status))
 
-        # 5) Handle redirects
-        status       = response.get('status', 200)
-        resp_headers = response.get('headers', {})
-        is_base64    = response.get('is_base64', False)
-        raw_body     = response.get('body', b'')
+        # 7) Handle redirects
+        status       = stream.status
+        resp_headers = stream.headers
+        metrics.REQUESTS.inc(house_id, metrics.method_label(request.method), status)
+        agent_timings = stream.agent_timings
+        if trace:
+            trace.head(agent_timings)
 
         if 300 <= status < 400 and 'Location' in resp_headers:
             loc = resp_headers['Location']
@@ -99,35 +268,55 @@ async def proxy_to_home(request, house_id, path):
             redirect = HttpResponseRedirect(loc)
             if 'Set-Cookie' in resp_headers:
                 redirect['Set-Cookie'] = resp_headers['Set-Cookie']
+            # Read the (small) redirect body to its end, so closing the
+            # stream is not a cancellation the agent and cancel_stats see
+            async for _ in stream.body():
+                pass
+            metrics.IN_FLIGHT.dec(house_id)
+            if ticket:
+                ticket.release()
+            if trace:
+                trace.finish(status)
+            log_request(request, house_id, path, status, started)
+            stream.close()
             return redirect
 
-        # 6) Decode body
-        if is_base64:
-            body_bytes = base64.b64decode(raw_body)
-        else:
-            body_bytes = raw_body.encode('utf-8') if isinstance(raw_body, str) else raw_body
-
-        # 7) Construct response
-        content_type = resp_headers.get('Content-Type', 'application/octet-stream')
-
-        # Use StreamingHttpResponse (not full buffer)
-        resp = StreamingHttpResponse((body_bytes,), status=status, content_type=content_type)
-
-        # Set important headers
-        for k, v in resp_headers.items():
-            if k.lower() not in {'content-encoding', 'transfer-encoding', 'connection'}:
-                resp[k] = v
-
-        # Ensure HLS CORS support
-        resp["Access-Control-Allow-Origin"] = "*"
-        resp["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-        resp["Access-Control-Allow-Headers"] = "*"
+        # 8) Construct response; body chunks are relayed as the agent forwards them
+        def finish(sent):
+            if ticket:
+                ticket.release()
+            if trace:
+                trace.finish(status, agent_timings)
+            log_request(request, house_id, path, status, started, sent)
 
+        body = metered(stream.body(), house_id, started, finish)
+        if cacheable and leader:
+            body = response_cache.tee(house_id, request.method, path, headers,
+                                      status, resp_headers, body)
+        resp = build_response(status, resp_headers, body)
+        if cacheable:
+            resp["X-Cache"] = "MISS"
+        if trace and tracing.config["SERVER_TIMING"]:
+            resp["Server-Timing"] = trace.server_timing()
         return resp
 
     except Exception as e:
-        print("‼️ proxy_to_home exception:", e)
-        traceback.print_exc()
+        if stream is not None:
+            # Got a head we could not relay (e.g. a bad header value); the
+            # body will never be read, so stop the agent and the accounting
+            stream.close()
+            metrics.IN_FLIGHT.dec(house_id)
+        if ticket:
+            ticket.release()
+        if isinstance(e, asyncio.TimeoutError):
+            metrics.TIMEOUTS.inc(house_id, "head")
+        metrics.REQUESTS.inc(house_label, metrics.method_label(request.method), 502)
+        if trace:
+            trace.finish(502)
+        # Timeouts are routine when an agent is slow; keep their tracebacks out of the log
+        logger.warning("‼️ proxy_to_home exception: %r", e, extra=kv(house=house_id, path=path),
+                       exc_info=not isinstance(e, asyncio.TimeoutError))
+        log_request(request, house_id, path, 502, started)
         return JsonResponse({
             'error': 'proxy error',
             'detail': str(e),
@@ -151,4 +340,50 @@ def create_registration_token(request):
         else:
             return HttpResponseRedirect('web_interface:login')
     else:
-        return JsonResponse({'error': "Method Not Allowed"})
\ No newline at end of file
+        return JsonResponse({'error': "Method Not Allowed"})
+
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(response_cache.info())
+
+
+@staff_member_required
+def compression_stats(request):
+    return JsonResponse(compression_report())
+
+
+@staff_member_required
+def traces(request):
+    """
+    Newest sampled request traces (?house=<id> to filter, ?limit=100, at
+    most the size of the trace buffer).
+    """
+    try:
+        limit = int(request.GET.get('limit', 100))
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    limit = min(max(limit, 1), tracing.config["BUFFER_SIZE"])
+    return JsonResponse({'traces': tracing.recent(request.GET.get('house'), limit)})
+
+
+@staff_member_required
+def cancel_stats(request):
+    return JsonResponse(cancel_report())
+
+
+async def metrics_view(request):
+    """
+    Prometheus scrape endpoint (TUNNEL_METRICS). Runs on the event loop,
+    where every metric is updated, so it reads consistent values. The
+    per-house labels name every connected house, so only staff and scrapers
+    presenting TUNNEL_METRICS_TOKEN as a bearer token get them.
+    """
+    if not getattr(settings, "TUNNEL_METRICS", True):
+        raise Http404
+    token = getattr(settings, "TUNNEL_METRICS_TOKEN", None)
+    scheme, _, offered = request.headers.get("Authorization", "").partition(" ")
+    scraper = bool(token) and scheme.lower() == "bearer" and secrets.compare_digest(offered, token)
+    if not scraper and not (await request.auser()).is_staff:
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")